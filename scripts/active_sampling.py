@@ -0,0 +1,348 @@
+"""
+SYNOPSIS
+    Model-guided active sampling of training trajectories.
+
+DESCRIPTION
+    Instead of simulating uniformly sampled waypoint sets, data generation runs
+    in rounds. Each round trains a small bootstrap ensemble of value-function
+    MLPs on the data collected so far and builds the minsnap coefficients of a
+    large batch of candidate seeds, which is cheap compared to simulating them.
+    The candidates are scored by the disagreement (standard deviation) of the
+    ensemble's predicted log cost, and only the highest scoring ones, plus a
+    small uniformly chosen share for exploration, are sent to the simulator.
+    As in TrajDataset, every coefficient is mapped onto (-1, 1) with the
+    per-feature range of the training data of the round before it reaches the
+    ensemble, for training, test and candidates alike.
+
+    Every round is written to its own resumable store (see traj_store.py) under
+    the output directory; TrajDataset and TrajStore accept the list of round
+    stores, so training.py can train on all rounds together. A fixed share of
+    the initial round is held out to report test loss after every round, and
+    the loop stops early once it reaches the target loss.
+
+    Contains:
+    a) candidate_features - minsnap coefficients of candidate seeds
+    b) train_ensemble - bootstrap ensemble of MLPs
+    c) ensemble_disagreement - score of candidates
+    d) active_learning - the round loop
+"""
+
+import json
+import multiprocessing
+import os
+
+import jax
+import numpy as np
+import optax
+import ruamel.yaml as yaml
+from flax.training import train_state
+
+from rotorpy.controllers.quadrotor_control import SE3Control
+from rotorpy.vehicles.multirotor import Multirotor
+from rotorpy.world import World
+
+from mlp_jax import MLP
+from model_learning import ArrayLoader, NormalizeTransform, feature_statistics, train_epoch
+from rotorpy_data import (
+    coeff_layout,
+    generate_data,
+    quad_params,
+    sample_minsnap_trajectory,
+    save_path,
+    summary_columns,
+)
+from traj_store import TrajStore, TrajStoreWriter
+
+HISTORY_FILE = "history.json"
+
+
+def _features_of_seeds(world, seeds, sampling_args):
+    features = []
+    for seed in seeds:
+        _, traj = sample_minsnap_trajectory(world, seed=seed, **sampling_args)
+        features.append(np.concatenate((traj.c_opt_xyz.ravel(), traj.c_opt_yaw.ravel())))
+    return np.array(features)
+
+
+def _features_task(args):
+    return _features_of_seeds(*args)
+
+
+def candidate_features(world, seeds, sampling_args, parallel=True, chunk_size=64):
+    """
+    Polynomial coefficients of the minsnap trajectories of the candidate seeds, in the column order of the data file.
+    Inputs:
+        world: Instance of World class containing the map extents and any obstacles.
+        seeds: array of candidate seeds.
+        sampling_args: keyword arguments of sample_minsnap_trajectory other than world and seed.
+        parallel: If True, the trajectories are built on a worker pool.
+        chunk_size: Number of seeds per pool task.
+    Outputs:
+        features: (len(seeds), num_coefficients) array.
+    """
+    if not parallel:
+        return _features_of_seeds(world, seeds, sampling_args)
+    tasks = [
+        (world, seeds[i : i + chunk_size], sampling_args)
+        for i in range(0, len(seeds), chunk_size)
+    ]
+    with multiprocessing.Pool(min(multiprocessing.cpu_count(), 40)) as pool:
+        return np.concatenate(pool.map(_features_task, tasks), axis=0)
+
+
+def train_ensemble(
+    coeffs,
+    costs,
+    num_members=5,
+    num_hidden=[100, 100, 20],
+    learning_rate=0.001,
+    num_epochs=100,
+    batch_size=256,
+    seed=0,
+):
+    """
+    Train an ensemble of MLPs, each on its own bootstrap resample of the data and from its own initialization, with
+    the ArrayLoader and train_epoch of training.py.
+    Inputs:
+        coeffs: (N, num_coefficients) training inputs, normalized per feature.
+        costs: (N,) training targets (log costs).
+        num_members: Number of ensemble members.
+        num_hidden, learning_rate, num_epochs, batch_size: as in configs/params.yaml.
+        seed: Seed of the initializations and resamples.
+    Outputs:
+        model: the MLP module.
+        params: list of the parameters of the members.
+    """
+    model = MLP(num_hidden=num_hidden, num_outputs=1)
+    rng = np.random.default_rng(seed)
+    params = []
+    for member in range(num_members):
+        state = train_state.TrainState.create(
+            apply_fn=model.apply,
+            params=model.init(jax.random.PRNGKey(seed + member), coeffs[:1]),
+            tx=optax.sgd(learning_rate=learning_rate, momentum=0.9),
+        )
+        sample = rng.integers(0, len(coeffs), size=len(coeffs))
+        # Full batches only, so each epoch is one compiled scan; an early round may hold fewer samples than batch_size
+        data_loader = ArrayLoader(
+            coeffs[sample], costs[sample], min(batch_size, len(sample)), seed=int(rng.integers(2**31))
+        )
+        for _ in range(num_epochs):
+            state, _ = train_epoch(state, data_loader.epoch())
+        params.append(state.params)
+    return model, params
+
+
+def ensemble_predictions(model, params, coeffs):
+    """
+    Outputs:
+        predictions: (num_members, N) predicted log costs.
+    """
+    apply = jax.jit(model.apply)
+    return np.stack([np.asarray(apply(p, coeffs)).ravel() for p in params])
+
+
+def ensemble_disagreement(model, params, coeffs):
+    """
+    Standard deviation of the members' predictions, the score of the candidates.
+    """
+    return np.std(ensemble_predictions(model, params, coeffs), axis=0)
+
+
+def select_candidates(scores, num_selected, exploration=0.1, rng=None):
+    """
+    Indices of the candidates to simulate: the highest scores, plus a share chosen uniformly among the rest.
+    Inputs:
+        scores: (N,) candidate scores.
+        num_selected: Number of candidates to select.
+        exploration: Share of the selection chosen uniformly at random.
+        rng: numpy Generator.
+    Outputs:
+        indices: (num_selected,) array of candidate indices.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    num_random = int(round(exploration * num_selected))
+    ranked = np.argsort(-scores)
+    top = ranked[: num_selected - num_random]
+    rest = ranked[num_selected - num_random :]
+    return np.concatenate((top, rng.choice(rest, size=min(num_random, len(rest)), replace=False)))
+
+
+def active_learning(
+    output_dir,
+    world,
+    vehicle,
+    controller,
+    num_initial,
+    num_rounds,
+    num_candidates,
+    num_per_round,
+    sampling_args,
+    rho=0,
+    robust_c=[0, 1, 0.1, 0.5],
+    test_size=0.2,
+    target_loss=None,
+    exploration=0.1,
+    num_members=5,
+    num_hidden=[100, 100, 20],
+    learning_rate=0.001,
+    num_epochs=100,
+    batch_size=256,
+    parallel=True,
+    rollout_batch_size=1,
+    seed=0,
+):
+    """
+    Runs active data generation in rounds.
+    Inputs:
+        output_dir: Directory holding one store per round and history.json.
+        world, vehicle, controller: as for rotorpy_data.generate_data.
+        num_initial: Number of uniformly sampled trajectories of round 0.
+        num_rounds: Number of active rounds after round 0.
+        num_candidates: Number of candidate seeds scored per round.
+        num_per_round: Number of candidates simulated per round.
+        sampling_args: keyword arguments of sample_minsnap_trajectory other than world and seed.
+        rho: robust_c of the cost column the model is trained on.
+        test_size: Share of round 0 held out to measure test loss.
+        target_loss: Stop once the test loss of the ensemble mean is at or below this value.
+        exploration: Share of each round chosen uniformly among the candidates.
+        num_members, num_hidden, learning_rate, num_epochs, batch_size: ensemble training settings.
+        parallel, rollout_batch_size: as for rotorpy_data.generate_data.
+        seed: Seed of round 0, of the test split and of the ensembles. Round r scores the candidate seeds
+            num_initial + (r - 1) * num_candidates + range(num_candidates), so no seed is simulated twice.
+    Outputs:
+        history: list of dicts with the round, number of rollouts so far and test loss after that round.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    def round_path(r):
+        return os.path.join(output_dir, "round_{:03d}".format(r))
+
+    def simulate(r, seeds):
+        writer = TrajStoreWriter(
+            round_path(r),
+            columns=summary_columns(sampling_args["num_waypoints"], robust_c),
+            seed_column="traj_number",
+            cost_columns=["cost_{}".format(i) for i in robust_c],
+            coeff_layout=coeff_layout(sampling_args["num_waypoints"]),
+        )
+        generate_data(
+            writer,
+            world,
+            vehicle,
+            controller,
+            len(seeds),
+            parallel=parallel,
+            robust_c=robust_c,
+            rollout_batch_size=rollout_batch_size,
+            seeds=seeds,
+            **sampling_args
+        )
+
+    # Round 0: uniform sampling, with a held out test split
+    simulate(0, np.arange(num_initial))
+    initial = TrajStore(round_path(0))
+    test_mask = np.zeros(len(initial), dtype=bool)
+    test_mask[rng.choice(len(initial), size=int(test_size * len(initial)), replace=False)] = True
+    test_coeffs = np.asarray(initial.view(initial.coeff_columns))[test_mask]
+    test_costs = np.log(initial.column("cost_{}".format(rho)))[test_mask]
+
+    history = []
+    for r in range(num_rounds + 1):
+        store = TrajStore([round_path(i) for i in range(r + 1)])
+        train_mask = np.ones(len(store), dtype=bool)
+        train_mask[: len(initial)] = ~test_mask
+        coeffs = np.asarray(store.view(store.coeff_columns))[train_mask]
+        costs = np.log(store.column("cost_{}".format(rho)))[train_mask]
+        stats = feature_statistics(coeffs)
+        input_transform = NormalizeTransform(stats["min"], stats["max"])
+        coeffs = input_transform(coeffs)
+
+        model, params = train_ensemble(
+            coeffs,
+            costs,
+            num_members=num_members,
+            num_hidden=num_hidden,
+            learning_rate=learning_rate,
+            num_epochs=num_epochs,
+            batch_size=batch_size,
+            seed=seed + r * num_members,
+        )
+        prediction = ensemble_predictions(model, params, input_transform(test_coeffs)).mean(axis=0)
+        test_loss = float(optax.l2_loss(prediction, test_costs).mean())
+        history.append({"round": r, "num_rollouts": len(store), "test_loss": test_loss})
+        print("Round {}: {} rollouts, test loss {:.4f}".format(r, len(store), test_loss))
+        with open(os.path.join(output_dir, HISTORY_FILE), "w") as f:
+            json.dump(history, f, indent=2)
+
+        if r == num_rounds or (target_loss is not None and test_loss <= target_loss):
+            break
+
+        # Score the candidates of the next round and simulate the most informative ones
+        candidates = num_initial + r * num_candidates + np.arange(num_candidates)
+        features = candidate_features(world, candidates, sampling_args, parallel=parallel)
+        scores = ensemble_disagreement(model, params, input_transform(features))
+        selected = select_candidates(scores, num_per_round, exploration=exploration, rng=rng)
+        print(
+            "Round {}: simulating {} of {} candidates, mean disagreement {:.4f} (all candidates {:.4f}).".format(
+                r + 1, len(selected), num_candidates, scores[selected].mean(), scores.mean()
+            )
+        )
+        simulate(r + 1, candidates[selected])
+
+    return history
+
+
+def main(num_initial=20000, num_rounds=10, num_candidates=50000, num_per_round=5000, target_loss=None):
+    """
+    Active data generation with the datagen settings of rotorpy_data.main and the network of configs/params.yaml.
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configs", "params.yaml")) as f:
+        yaml_data = yaml.load(f, Loader=yaml.RoundTripLoader)
+
+    world_size = 10
+    world = World.empty(
+        [
+            -world_size / 2,
+            world_size / 2,
+            -world_size / 2,
+            world_size / 2,
+            -world_size / 2,
+            world_size / 2,
+        ]
+    )
+    vehicle = Multirotor(quad_params)
+    controller = SE3Control(quad_params)
+    sampling_args = dict(
+        num_waypoints=4,
+        start_waypoint=None,
+        end_waypoint=None,
+        world_buffer=2,
+        min_distance=1,
+        max_distance=4,
+        vavg=2,
+        random_yaw=False,
+        yaw_min=-0.85 * np.pi,
+        yaw_max=0.85 * np.pi,
+    )
+
+    active_learning(
+        os.path.join(save_path, "active_drag1"),
+        world,
+        vehicle,
+        controller,
+        num_initial,
+        num_rounds,
+        num_candidates,
+        num_per_round,
+        sampling_args,
+        target_loss=target_loss,
+        num_hidden=list(yaml_data["num_hidden"]),
+        learning_rate=yaml_data["learning_rate"],
+        batch_size=yaml_data["batch_size"],
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,618 @@
+"""
+SYNOPSIS
+    Lock-step batch rollout engine for many min-snap trajectories at once.
+
+DESCRIPTION
+    Advances N quadrotors that share the same RotorPy Multirotor dynamics and
+    SE3Control law together as (N, state_dim) NumPy arrays. The outputs use the
+    same 'state'/'flat'/'control' keys as Environment.run so that compute_cost
+    can consume them unchanged, either on the padded batch or per trajectory
+    through split_batch_result.
+
+    Contains:
+    a) BatchMultirotor - vectorized Multirotor forward dynamics (RK4 integration)
+    b) BatchSE3Control - vectorized SE3Control law
+    c) BatchMinSnapReference - vectorized evaluation of MinSnap flat outputs
+    d) batch_rollout - lock-step simulation of N trajectories
+    e) benchmark - throughput and accuracy comparison against Environment.run
+"""
+
+import time
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+from rotorpy.simulate import ExitStatus
+
+from divergence import EXIT_STATUS, NOT_DIVERGED
+
+
+def quat_to_rotmat(q):
+    """
+    Batched rotation matrices from [i,j,k,w] quaternions. Quaternions are
+    normalized first, matching scipy's Rotation.from_quat.
+    Inputs:
+        q: (N, 4) array of quaternions.
+    Outputs:
+        R: (N, 3, 3) array of rotation matrices.
+    """
+    q = q / np.linalg.norm(q, axis=1, keepdims=True)
+    x, y, z, w = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    R = np.empty((q.shape[0], 3, 3))
+    R[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    R[:, 0, 1] = 2 * (x * y - z * w)
+    R[:, 0, 2] = 2 * (x * z + y * w)
+    R[:, 1, 0] = 2 * (x * y + z * w)
+    R[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    R[:, 1, 2] = 2 * (y * z - x * w)
+    R[:, 2, 0] = 2 * (x * z - y * w)
+    R[:, 2, 1] = 2 * (y * z + x * w)
+    R[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return R
+
+
+class BatchMultirotor(object):
+    """
+    Vectorized version of rotorpy.vehicles.multirotor.Multirotor.
+
+    The physical parameters are copied from an existing Multirotor instance so
+    the batch and per-trajectory simulations always use the same vehicle. Only
+    the 'cmd_motor_speeds' control abstraction (the one SE3Control drives) is
+    supported. Each simulator step is integrated with `substeps` classical RK4
+    steps instead of scipy's adaptive RK45, which keeps all N vehicles in lock
+    step.
+    """
+
+    state_dim = 20
+
+    def __init__(self, vehicle, substeps=4):
+        if vehicle.control_abstraction != "cmd_motor_speeds":
+            raise ValueError(
+                "BatchMultirotor only supports the cmd_motor_speeds control abstraction."
+            )
+        if getattr(vehicle, "_enable_ground", False):
+            raise ValueError("BatchMultirotor does not model ground contact.")
+
+        self.num_rotors = vehicle.num_rotors
+        self.mass = vehicle.mass
+        self.g = vehicle.g
+        self.inertia = vehicle.inertia
+        self.inv_inertia = vehicle.inv_inertia
+        self.weight = vehicle.weight
+        self.rotor_geometry = vehicle.rotor_geometry  # (num_rotors, 3)
+        self.rotor_dir = np.asarray(vehicle.rotor_dir, dtype=float)
+        self.rotor_speed_min = vehicle.rotor_speed_min
+        self.rotor_speed_max = vehicle.rotor_speed_max
+        self.k_eta = vehicle.k_eta
+        self.k_m = vehicle.k_m
+        self.k_h = vehicle.k_h
+        self.k_flap = vehicle.k_flap
+        self.tau_m = vehicle.tau_m
+        self.motor_noise = vehicle.motor_noise
+        self.drag_diag = np.diag(vehicle.drag_matrix).copy()
+        self.rotor_drag_diag = np.diag(vehicle.rotor_drag_matrix).copy()
+        self.aero = vehicle.aero
+        self.substeps = substeps
+
+    @staticmethod
+    def pack_state(state, num_drones):
+        """
+        Convert a single RotorPy state dict into an (N, 20) batch state array.
+        """
+        s = np.zeros((num_drones, BatchMultirotor.state_dim))
+        s[:, 0:3] = state["x"]
+        s[:, 3:6] = state["v"]
+        s[:, 6:10] = state["q"]
+        s[:, 10:13] = state["w"]
+        s[:, 13:16] = state["wind"]
+        s[:, 16:] = state["rotor_speeds"]
+        return s
+
+    @staticmethod
+    def unpack_state(s):
+        """
+        Split an (..., 20) batch state array into the RotorPy state dict layout.
+        """
+        return {
+            "x": s[..., 0:3],
+            "v": s[..., 3:6],
+            "q": s[..., 6:10],
+            "w": s[..., 10:13],
+            "wind": s[..., 13:16],
+            "rotor_speeds": s[..., 16:],
+        }
+
+    def compute_body_wrench(self, body_rates, rotor_speeds, body_airspeed_vector):
+        """
+        Batched Multirotor.compute_body_wrench.
+        Inputs:
+            body_rates: (N, 3) body rates.
+            rotor_speeds: (N, num_rotors) rotor speeds.
+            body_airspeed_vector: (N, 3) airspeed in the body frame.
+        Outputs:
+            FtotB, MtotB: (N, 3) force and moment in the body frame.
+        """
+        N = body_rates.shape[0]
+        # Local airspeed at each rotor hub, (N, num_rotors, 3)
+        local_airspeeds = body_airspeed_vector[:, None, :] + np.cross(
+            body_rates[:, None, :], self.rotor_geometry[None, :, :]
+        )
+
+        # Rotor forces in the body frame, (N, num_rotors, 3)
+        F = np.zeros((N, self.num_rotors, 3))
+        F[:, :, 2] = self.k_eta * rotor_speeds**2
+        M_flap = np.zeros((N, self.num_rotors, 3))
+
+        if self.aero:
+            airspeed_norm = np.linalg.norm(body_airspeed_vector, axis=1, keepdims=True)
+            D = -airspeed_norm * self.drag_diag * body_airspeed_vector
+            # Rotor drag (H force) at each hub.
+            F += -rotor_speeds[:, :, None] * (self.rotor_drag_diag * local_airspeeds)
+            # Flapping moment, -k_flap * w_i * (v_i x e3).
+            M_flap[:, :, 0] = -self.k_flap * rotor_speeds * local_airspeeds[:, :, 1]
+            M_flap[:, :, 1] = self.k_flap * rotor_speeds * local_airspeeds[:, :, 0]
+            # Translational lift.
+            F[:, :, 2] += self.k_h * (
+                local_airspeeds[:, :, 0] ** 2 + local_airspeeds[:, :, 1] ** 2
+            )
+        else:
+            D = np.zeros((N, 3))
+
+        M_force = np.sum(np.cross(self.rotor_geometry[None, :, :], F), axis=1)
+        M_yaw = self.rotor_dir * self.k_m * rotor_speeds**2
+
+        FtotB = np.sum(F, axis=1) + D
+        MtotB = M_force + np.sum(M_flap, axis=1)
+        MtotB[:, 2] += np.sum(M_yaw, axis=1)
+        return FtotB, MtotB
+
+    def s_dot(self, s, cmd_rotor_speeds):
+        """
+        Batched state derivative for constant commanded rotor speeds.
+        """
+        q = s[:, 6:10]
+        v = s[:, 3:6]
+        w = s[:, 10:13]
+        wind = s[:, 13:16]
+        rotor_speeds = s[:, 16:]
+
+        R = quat_to_rotmat(q)
+
+        s_dot = np.zeros_like(s)
+        s_dot[:, 0:3] = v
+
+        # Quaternion derivative, 0.5 * G(q)^T w
+        q0, q1, q2, q3 = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+        w0, w1, w2 = w[:, 0], w[:, 1], w[:, 2]
+        s_dot[:, 6] = 0.5 * (q3 * w0 - q2 * w1 + q1 * w2)
+        s_dot[:, 7] = 0.5 * (q2 * w0 + q3 * w1 - q0 * w2)
+        s_dot[:, 8] = 0.5 * (-q1 * w0 + q0 * w1 + q3 * w2)
+        s_dot[:, 9] = 0.5 * (-q0 * w0 - q1 * w1 - q2 * w2)
+
+        body_airspeed_vector = np.einsum("nji,nj->ni", R, v - wind)
+        FtotB, MtotB = self.compute_body_wrench(w, rotor_speeds, body_airspeed_vector)
+        Ftot = np.einsum("nij,nj->ni", R, FtotB)
+        s_dot[:, 3:6] = (self.weight + Ftot) / self.mass
+
+        Iw = w @ self.inertia.T
+        s_dot[:, 10:13] = (MtotB - np.cross(w, Iw)) @ self.inv_inertia.T
+
+        s_dot[:, 16:] = (cmd_rotor_speeds - rotor_speeds) / self.tau_m
+        return s_dot
+
+    def step(self, s, cmd_motor_speeds, t_step):
+        """
+        Integrate the batch forward by t_step with constant motor speed commands.
+        Inputs:
+            s: (N, 20) batch state.
+            cmd_motor_speeds: (N, num_rotors) commanded motor speeds.
+            t_step: step size in seconds.
+        Outputs:
+            s: (N, 20) batch state after t_step.
+        """
+        cmd = np.clip(cmd_motor_speeds, self.rotor_speed_min, self.rotor_speed_max)
+        h = t_step / self.substeps
+        for _ in range(self.substeps):
+            k1 = self.s_dot(s, cmd)
+            k2 = self.s_dot(s + 0.5 * h * k1, cmd)
+            k3 = self.s_dot(s + 0.5 * h * k2, cmd)
+            k4 = self.s_dot(s + h * k3, cmd)
+            s = s + (h / 6.0) * (k1 + 2 * k2 + 2 * k3 + k4)
+
+        s[:, 6:10] /= np.linalg.norm(s[:, 6:10], axis=1, keepdims=True)
+        if self.motor_noise != 0:
+            s[:, 16:] += np.random.normal(
+                scale=np.abs(self.motor_noise), size=s[:, 16:].shape
+            )
+        s[:, 16:] = np.clip(s[:, 16:], self.rotor_speed_min, self.rotor_speed_max)
+        return s
+
+
+class BatchSE3Control(object):
+    """
+    Vectorized version of rotorpy.controllers.quadrotor_control.SE3Control.
+
+    Gains and allocation matrices are copied from an existing SE3Control
+    instance so the batch law is identical to the per-trajectory one.
+    """
+
+    def __init__(self, controller):
+        self.mass = controller.mass
+        self.g = controller.g
+        self.inertia = controller.inertia
+        self.kp_pos = np.asarray(controller.kp_pos, dtype=float)
+        self.kd_pos = np.asarray(controller.kd_pos, dtype=float)
+        self.kp_att = controller.kp_att
+        self.kd_att = controller.kd_att
+        self.kp_vel = np.asarray(controller.kp_vel, dtype=float)
+        self.TM_to_f = controller.TM_to_f
+        self.k_eta = controller.k_eta
+
+    def update(self, t, state, flat_output):
+        """
+        Batched SE3Control.update.
+        Inputs:
+            t: present time in seconds (unused, kept for API parity).
+            state: dict of (N, ...) arrays with keys x, v, q, w.
+            flat_output: dict of (N, ...) arrays with keys x, x_dot, x_ddot, yaw, yaw_dot.
+        Outputs:
+            control_input: dict of (N, ...) arrays with the same keys as SE3Control.update.
+        """
+        N = state["x"].shape[0]
+
+        pos_err = state["x"] - flat_output["x"]
+        dpos_err = state["v"] - flat_output["x_dot"]
+        F_des = self.mass * (
+            -self.kp_pos * pos_err
+            - self.kd_pos * dpos_err
+            + flat_output["x_ddot"]
+            + np.array([0, 0, self.g])
+        )
+
+        R = quat_to_rotmat(state["q"])
+        b3 = R[:, :, 2]
+        u1 = np.sum(F_des * b3, axis=1)
+
+        b3_des = F_des / np.linalg.norm(F_des, axis=1, keepdims=True)
+        yaw_des = flat_output["yaw"]
+        c1_des = np.stack([np.cos(yaw_des), np.sin(yaw_des), np.zeros(N)], axis=1)
+        b2_des = np.cross(b3_des, c1_des)
+        b2_des /= np.linalg.norm(b2_des, axis=1, keepdims=True)
+        b1_des = np.cross(b2_des, b3_des)
+        R_des = np.stack([b1_des, b2_des, b3_des], axis=2)
+
+        S_err = 0.5 * (
+            np.transpose(R_des, (0, 2, 1)) @ R - np.transpose(R, (0, 2, 1)) @ R_des
+        )
+        att_err = np.stack([-S_err[:, 1, 2], S_err[:, 0, 2], -S_err[:, 0, 1]], axis=1)
+
+        w_des = np.zeros((N, 3))
+        w_des[:, 2] = flat_output["yaw_dot"]
+        w_err = state["w"] - w_des
+
+        cmd_w = -self.kp_att * att_err - self.kd_att * w_err
+        u2 = cmd_w @ self.inertia.T + np.cross(state["w"], state["w"] @ self.inertia.T)
+
+        TM = np.concatenate((u1[:, None], u2), axis=1)
+        cmd_rotor_thrusts = TM @ self.TM_to_f.T
+        cmd_motor_speeds = cmd_rotor_thrusts / self.k_eta
+        cmd_motor_speeds = np.sign(cmd_motor_speeds) * np.sqrt(np.abs(cmd_motor_speeds))
+
+        return {
+            "cmd_motor_speeds": cmd_motor_speeds,
+            "cmd_motor_thrusts": cmd_rotor_thrusts,
+            "cmd_thrust": u1,
+            "cmd_moment": u2,
+            "cmd_q": Rotation.from_matrix(R_des).as_quat(),
+            "cmd_w": cmd_w,
+            "cmd_v": -self.kp_vel * pos_err + flat_output["x_dot"],
+            "cmd_acc": F_des / self.mass,
+        }
+
+
+class BatchMinSnapReference(object):
+    """
+    Evaluates the flat outputs of N MinSnap trajectories at once.
+
+    Trajectories may have different segment counts and durations; shorter ones
+    are padded with segments that are never selected.
+    """
+
+    def __init__(self, trajectories):
+        N = len(trajectories)
+        if any(traj.null for traj in trajectories):
+            raise ValueError("BatchMinSnapReference requires at least two distinct waypoints.")
+        M = max(traj.x_poly.shape[0] for traj in trajectories)
+
+        self.t_start = np.zeros((N, M))
+        self.t_end = np.full((N, M), np.inf)
+        self.t_final = np.zeros(N)
+        self.x_poly = np.zeros((N, M, 3, 8))
+        self.x_dot_poly = np.zeros((N, M, 3, 7))
+        self.x_ddot_poly = np.zeros((N, M, 3, 6))
+        self.x_dddot_poly = np.zeros((N, M, 3, 5))
+        self.x_ddddot_poly = np.zeros((N, M, 3, 4))
+        self.yaw_poly = np.zeros((N, M, 8))
+        self.yaw_dot_poly = np.zeros((N, M, 7))
+        self.yaw_ddot_poly = np.zeros((N, M, 6))
+
+        for n, traj in enumerate(trajectories):
+            m = traj.x_poly.shape[0]
+            self.t_start[n, :m] = traj.t_keyframes[:-1]
+            self.t_end[n, :m] = traj.t_keyframes[:-1] + traj.delta_t
+            self.t_final[n] = traj.t_keyframes[-1]
+            self.x_poly[n, :m] = traj.x_poly
+            self.x_dot_poly[n, :m] = traj.x_dot_poly
+            self.x_ddot_poly[n, :m] = traj.x_ddot_poly
+            self.x_dddot_poly[n, :m] = traj.x_dddot_poly
+            self.x_ddddot_poly[n, :m] = traj.x_ddddot_poly
+            self.yaw_poly[n, :m] = traj.yaw_poly[:, 0, :]
+            self.yaw_dot_poly[n, :m] = traj.yaw_dot_poly[:, 0, :]
+            self.yaw_ddot_poly[n, :m] = traj.yaw_ddot_poly[:, 0, :]
+
+    @staticmethod
+    def _polyval(coeffs, t):
+        """
+        Horner evaluation of highest-degree-first coefficients along the last axis.
+        """
+        t = t.reshape(t.shape + (1,) * (coeffs.ndim - 2))
+        out = np.zeros(coeffs.shape[:-1])
+        for i in range(coeffs.shape[-1]):
+            out = out * t + coeffs[..., i]
+        return out
+
+    def update(self, t, idx=None):
+        """
+        Flat outputs of trajectories `idx` (all if None) at the shared time t.
+        """
+        if idx is None:
+            idx = np.arange(self.t_final.shape[0])
+        t = np.clip(t, self.t_start[idx, 0], self.t_final[idx])
+        seg = np.argmax(self.t_end[idx] >= t[:, None], axis=1)
+        tau = t - self.t_start[idx, seg]
+
+        return {
+            "x": self._polyval(self.x_poly[idx, seg], tau),
+            "x_dot": self._polyval(self.x_dot_poly[idx, seg], tau),
+            "x_ddot": self._polyval(self.x_ddot_poly[idx, seg], tau),
+            "x_dddot": self._polyval(self.x_dddot_poly[idx, seg], tau),
+            "x_ddddot": self._polyval(self.x_ddddot_poly[idx, seg], tau),
+            "yaw": self._polyval(self.yaw_poly[idx, seg], tau),
+            "yaw_dot": self._polyval(self.yaw_dot_poly[idx, seg], tau),
+            "yaw_ddot": self._polyval(self.yaw_ddot_poly[idx, seg], tau),
+        }
+
+
+def _safety_exit(state):
+    """
+    Batched rotorpy.simulate.safety_exit for an obstacle-free world.
+    Returns an (N,) object array of ExitStatus or None.
+    """
+    status = np.full(state["v"].shape[0], None, dtype=object)
+    over_speed = np.any(np.abs(state["v"]) > 20, axis=1)
+    over_spin = np.any(np.abs(state["w"]) > 100, axis=1) & ~over_speed
+    status[over_speed] = ExitStatus.OVER_SPEED
+    status[over_spin] = ExitStatus.OVER_SPIN
+    return status
+
+
+def batch_rollout(
+    vehicle, controller, trajectories, initial_states, sim_rate=100, t_final=None, substeps=4, divergence_monitor=None
+):
+    """
+    Simulate N trajectories in lock step, mirroring Environment.run(terminate=False)
+    in an obstacle-free world without wind.
+    Inputs:
+        vehicle: Multirotor instance shared by all trajectories.
+        controller: SE3Control instance shared by all trajectories.
+        trajectories: list of N MinSnap trajectories.
+        initial_states: list of N RotorPy initial state dicts.
+        sim_rate: simulator rate in Hz.
+        t_final: (N,) array of end times. Defaults to each trajectory's last keyframe time.
+        substeps: number of RK4 steps per simulator step.
+        divergence_monitor: optional divergence.DivergenceMonitor; rollouts it flags stop early, like a terminate
+            function passed to Environment.run.
+    Outputs:
+        result: dict with keys
+            time, (N, T) array of sample times
+            state, flat, control: dicts of (N, T, ...) arrays, same keys as Environment.run
+            num_samples, (N,) number of valid samples per trajectory; entries past it repeat the last valid sample
+            exit, list of N ExitStatus values
+            divergence, (N,) divergence codes from divergence_monitor (all NOT_DIVERGED without one)
+    """
+    N = len(trajectories)
+    dynamics = BatchMultirotor(vehicle, substeps=substeps)
+    control_law = BatchSE3Control(controller)
+    reference = BatchMinSnapReference(trajectories)
+    if t_final is None:
+        t_final = reference.t_final
+    t_final = np.asarray(t_final, dtype=float)
+    t_step = 1 / sim_rate
+
+    s = np.zeros((N, BatchMultirotor.state_dim))
+    for n, x0 in enumerate(initial_states):
+        s[n] = BatchMultirotor.pack_state({k: np.asarray(v) for k, v in x0.items()}, 1)[0]
+    # No wind profile, so the wind state is zero.
+    s[:, 13:16] = 0.0
+
+    t = 0.0
+    flat = reference.update(np.full(N, t))
+    control = control_law.update(t, BatchMultirotor.unpack_state(s), flat)
+
+    times, states, flats, controls = [np.full(N, t)], [s.copy()], [flat], [control]
+    num_samples = np.ones(N, dtype=int)
+    exit_status = np.full(N, None, dtype=object)
+    divergence = np.zeros(N, dtype=int)
+    active = np.arange(N)
+    if divergence_monitor is not None:
+        divergence_monitor.start(N, dynamics.rotor_speed_min, dynamics.rotor_speed_max)
+
+    while True:
+        # Same exit checks, in the same order, as rotorpy.simulate.
+        state_active = BatchMultirotor.unpack_state(s[active])
+        status = _safety_exit(state_active)
+        if divergence_monitor is not None and t > 0:
+            codes = divergence_monitor.update(
+                t_step, state_active["x"], flats[-1]["x"][active], state_active["rotor_speeds"], active
+            )
+            diverged = np.array([st is None for st in status]) & (codes != NOT_DIVERGED)
+            divergence[active[diverged]] = codes[diverged]
+            status[diverged] = [EXIT_STATUS[code] for code in codes[diverged]]
+        timed_out = np.array([st is None for st in status]) & (t >= t_final[active])
+        status[timed_out] = ExitStatus.TIMEOUT
+        done = np.array([st is not None for st in status])
+        exit_status[active[done]] = status[done]
+        active = active[~done]
+        if active.size == 0:
+            break
+
+        t = t + t_step
+        s[active] = dynamics.step(s[active], controls[-1]["cmd_motor_speeds"][active], t_step)
+        flat = {k: v.copy() for k, v in flats[-1].items()}
+        control = {k: v.copy() for k, v in controls[-1].items()}
+        flat_active = reference.update(np.full(active.size, t), active)
+        control_active = control_law.update(t, BatchMultirotor.unpack_state(s[active]), flat_active)
+        for k in flat:
+            flat[k][active] = flat_active[k]
+        for k in control:
+            control[k][active] = control_active[k]
+
+        sample_time = times[-1].copy()
+        sample_time[active] = t
+        times.append(sample_time)
+        states.append(s.copy())
+        flats.append(flat)
+        controls.append(control)
+        num_samples[active] += 1
+
+    def stack(samples):
+        return np.stack(samples, axis=1)
+
+    return {
+        "time": stack(times),
+        "state": BatchMultirotor.unpack_state(stack(states)),
+        "flat": {k: stack([f[k] for f in flats]) for k in flats[0]},
+        "control": {k: stack([c[k] for c in controls]) for k in controls[0]},
+        "num_samples": num_samples,
+        "exit": list(exit_status),
+        "divergence": divergence,
+    }
+
+
+def split_batch_result(result):
+    """
+    Split a batch_rollout result into N per-trajectory results trimmed to their
+    valid samples, laid out like the output of Environment.run.
+    """
+    out = []
+    for n, T in enumerate(result["num_samples"]):
+        out.append(
+            {
+                "time": result["time"][n, :T],
+                "state": {k: v[n, :T] for k, v in result["state"].items()},
+                "flat": {k: v[n, :T] for k, v in result["flat"].items()},
+                "control": {k: v[n, :T] for k, v in result["control"].items()},
+                "exit": result["exit"][n],
+            }
+        )
+    return out
+
+
+def benchmark(num_trajectories=64, num_waypoints=4, world_size=10, seed=0):
+    """
+    Compare throughput and accuracy of batch_rollout against one
+    Environment.run per trajectory on the datagen setup of rotorpy_data.main.
+    Inputs:
+        num_trajectories: number of min-snap trajectories to simulate.
+        num_waypoints: number of waypoints per trajectory.
+        world_size: edge length of the empty cubic world.
+        seed: seed for waypoint sampling.
+    Outputs:
+        stats: dict with wall times, simulations per second and deviations.
+    """
+    from rotorpy.controllers.quadrotor_control import SE3Control
+    from rotorpy.environments import Environment
+    from rotorpy.trajectories.minsnap import MinSnap
+    from rotorpy.vehicles.hummingbird_params import quad_params
+    from rotorpy.vehicles.multirotor import Multirotor
+    from rotorpy.world import World
+    from cost_labels import compute_cost
+    from rotorpy_data import sample_waypoints
+
+    half = world_size / 2
+    world = World.empty([-half, half, -half, half, -half, half])
+    vehicle = Multirotor(quad_params)
+    controller = SE3Control(quad_params)
+
+    np.random.seed(seed)
+    trajectories, initial_states = [], []
+    for _ in range(num_trajectories):
+        waypoints = sample_waypoints(num_waypoints, world, min_distance=1, max_distance=4)
+        trajectories.append(
+            MinSnap(points=waypoints, yaw_angles=np.zeros(len(waypoints)), v_avg=2, verbose=False)
+        )
+        initial_states.append(
+            {
+                "x": waypoints[0],
+                "v": np.zeros(3),
+                "q": np.array([0, 0, 0, 1]),
+                "w": np.zeros(3),
+                "wind": np.array([0, 0, 0]),
+                "rotor_speeds": np.array([1788.53, 1788.53, 1788.53, 1788.53]),
+            }
+        )
+
+    def environment_runs(vehicle):
+        results = []
+        for traj, x0 in zip(trajectories, initial_states):
+            sim_instance = Environment(vehicle=vehicle, controller=controller, trajectory=traj, wind_profile=None, sim_rate=100)
+            sim_instance.vehicle.initial_state = x0
+            results.append(sim_instance.run(t_final=traj.t_keyframes[-1], use_mocap=False, terminate=False, plot=False))
+        return results
+
+    start = time.time()
+    reference = environment_runs(vehicle)
+    serial_time = time.time() - start
+    # RotorPy's default RK45 tolerances (rtol=1e-3) are loose enough to move the
+    # cost by several percent on saturated trajectories, so also compare against
+    # a tightly integrated reference.
+    converged = environment_runs(
+        Multirotor(quad_params, integrator_kwargs={"method": "RK45", "rtol": 1e-8, "atol": 1e-10})
+    )
+
+    start = time.time()
+    batch = split_batch_result(batch_rollout(vehicle, controller, trajectories, initial_states))
+    batch_time = time.time() - start
+
+    def deviations(results):
+        pos_dev, cost_err = [], []
+        for ref, res in zip(results, batch):
+            T = min(len(ref["time"]), len(res["time"]))
+            pos_dev.append(np.max(np.abs(ref["state"]["x"][:T] - res["state"]["x"][:T])))
+            cost_ref = compute_cost(ref, robust_c=1)
+            cost_err.append(abs(compute_cost(res, robust_c=1) - cost_ref) / abs(cost_ref))
+        return np.max(pos_dev), np.max(cost_err), np.median(cost_err)
+
+    max_pos_dev, max_cost_rel_err, median_cost_rel_err = deviations(reference)
+    max_pos_dev_conv, max_cost_rel_err_conv, median_cost_rel_err_conv = deviations(converged)
+
+    stats = {
+        "num_trajectories": num_trajectories,
+        "environment_run_seconds": serial_time,
+        "batch_rollout_seconds": batch_time,
+        "environment_run_sims_per_second": num_trajectories / serial_time,
+        "batch_rollout_sims_per_second": num_trajectories / batch_time,
+        "speedup": serial_time / batch_time,
+        "max_position_deviation": max_pos_dev,
+        "max_cost_relative_error": max_cost_rel_err,
+        "median_cost_relative_error": median_cost_rel_err,
+        "max_position_deviation_converged": max_pos_dev_conv,
+        "max_cost_relative_error_converged": max_cost_rel_err_conv,
+        "median_cost_relative_error_converged": median_cost_rel_err_conv,
+    }
+    for k, v in stats.items():
+        print("{}: {}".format(k, v))
+    return stats
+
+
+if __name__ == "__main__":
+    benchmark()
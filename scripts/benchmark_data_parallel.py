@@ -0,0 +1,134 @@
+"""
+SYNOPSIS
+    Scaling benchmark of data-parallel training over XLA CPU devices.
+
+DESCRIPTION
+    The number of XLA devices on the CPU is fixed when JAX initializes its
+    backends, so every device count is measured in a fresh process: the
+    benchmark runs itself once per device count with --devices, and each run
+    trains the network of configs/params.yaml on the given coefficient dataset
+    with model_learning.train_model, split across that many devices. It reports
+    the time per epoch, the training throughput and the speedup and parallel
+    efficiency against one device.
+
+        python benchmark_data_parallel.py --data <csv or store> --max-devices 8
+
+    Contains:
+    a) measure - time training on the devices of the current process
+    b) main - device count sweep
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import jax
+import optax
+import ruamel.yaml as yaml
+from flax.training import train_state
+
+from mlp_jax import MLP
+from model_learning import ArrayLoader, TrajDataset, data_parallel_mesh, set_host_device_count, train_model
+
+
+def measure(data, num_devices, batch_size, num_hidden, learning_rate, num_epochs=5, rho=0):
+    """
+    Time data-parallel training on the first num_devices devices of this process.
+    Inputs:
+        data: path of the coefficient dataset, as taken by TrajDataset.
+        num_devices: number of devices to split the batches across.
+        batch_size, num_hidden, learning_rate: as in configs/params.yaml.
+        num_epochs: number of timed epochs, after one epoch of compilation.
+        rho: cost column to train on.
+    Outputs:
+        result: dict with the timings.
+    """
+    dataset = TrajDataset(file_path=data, rho=rho)
+    data_loader = ArrayLoader.from_dataset(dataset, batch_size=batch_size, shuffle=True)
+    model = MLP(num_hidden=num_hidden, num_outputs=1)
+    state = train_state.TrainState.create(
+        apply_fn=model.apply,
+        params=model.init(jax.random.PRNGKey(427), data_loader.coeffs[:batch_size]),
+        tx=optax.sgd(learning_rate=learning_rate, momentum=0.9),
+    )
+    mesh = data_parallel_mesh(num_devices) if num_devices > 1 else None
+
+    state = train_model(state, data_loader, num_epochs=1, mesh=mesh)
+    jax.block_until_ready(state)
+    start_time = time.perf_counter()
+    state = train_model(state, data_loader, num_epochs=num_epochs, mesh=mesh)
+    jax.block_until_ready(state)
+    seconds = time.perf_counter() - start_time
+
+    return {
+        "devices": num_devices,
+        "samples": data_loader.num_samples,
+        "batch_size": batch_size,
+        "epochs": num_epochs,
+        "seconds_per_epoch": seconds / num_epochs,
+        "samples_per_second": len(data_loader) * batch_size * num_epochs / seconds,
+    }
+
+
+def _device_counts(max_devices):
+    counts, n = [], 1
+    while n < max_devices:
+        counts.append(n)
+        n *= 2
+    return counts + [max_devices]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Data-parallel training scaling benchmark.")
+    parser.add_argument("--data", required=True, help="Coefficient dataset, a csv file or a store directory.")
+    parser.add_argument("--max-devices", type=int, default=os.cpu_count(), help="Largest device count to measure.")
+    parser.add_argument("--devices", type=int, default=None, help="Measure only this device count, in this process.")
+    parser.add_argument("--epochs", type=int, default=5)
+    parser.add_argument("--rho", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=None, help="Defaults to configs/params.yaml.")
+    parser.add_argument("--output", default=None, help="json file to write the results to.")
+    args = parser.parse_args(argv)
+
+    if args.devices is not None:
+        # Before the first JAX computation of this process
+        set_host_device_count(args.devices)
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configs", "params.yaml")) as f:
+            yaml_data = yaml.load(f, Loader=yaml.RoundTripLoader)
+        result = measure(
+            args.data,
+            args.devices,
+            args.batch_size or yaml_data["batch_size"],
+            list(yaml_data["num_hidden"]),
+            yaml_data["learning_rate"],
+            num_epochs=args.epochs,
+            rho=args.rho,
+        )
+        print(json.dumps(result))
+        return result
+
+    results = []
+    for num_devices in _device_counts(args.max_devices):
+        command = [sys.executable, os.path.abspath(__file__), "--data", args.data, "--devices", str(num_devices),
+                   "--epochs", str(args.epochs), "--rho", str(args.rho)]
+        if args.batch_size is not None:
+            command += ["--batch-size", str(args.batch_size)]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    base = results[0]["seconds_per_epoch"]
+    print("{:>8} {:>12} {:>14} {:>8} {:>11}".format("devices", "s/epoch", "samples/s", "speedup", "efficiency"))
+    for result in results:
+        result["speedup"] = base / result["seconds_per_epoch"]
+        result["efficiency"] = result["speedup"] / result["devices"]
+        print("{devices:>8} {seconds_per_epoch:>12.3f} {samples_per_second:>14.0f} {speedup:>8.2f} {efficiency:>11.2f}".format(**result))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+SYNOPSIS
+    Vectorized cost labels for simulated trajectories.
+
+DESCRIPTION
+    The trajectory cost is the sum over time of the tracking cost (squared
+    position, velocity and yaw errors) plus robust_c times the control cost
+    (squared thrust and moment commands). Since robust_c only scales the
+    control term, the costs for every robust_c follow from one pass that sums
+    the two terms separately.
+
+    All functions work on a single rollout, laid out like the output of
+    Environment.run, or on a batch of rollouts with a leading batch axis as
+    returned by batch_rollout.
+
+    Contains:
+    a) compute_yaw_from_quaternion - batched quaternion to yaw conversion
+    b) compute_costs - costs for all robust_c values in one pass
+    c) compute_cost - cost for a single robust_c value
+"""
+
+import numpy as np
+
+
+def compute_yaw_from_quaternion(quaternions):
+    """
+    Yaw angle of the attitude, i.e. the rotation about the world z axis left
+    after removing the minimal rotation that tilts e3 onto the body z axis b3.
+    Inputs:
+        quaternions: (..., 4) array of quaternions [i, j, k, w]. Need not be normalized.
+    Outputs:
+        yaw: (...) array of yaw angles.
+    """
+    q = np.asarray(quaternions, dtype=float)
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    x, y, z, w = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+
+    # First column of the rotation matrix, and b3, its third column
+    r00 = 1 - 2 * (y * y + z * z)
+    r10 = 2 * (x * y + z * w)
+    r20 = 2 * (x * z - y * w)
+    bx = 2 * (x * z + y * w)
+    by = 2 * (y * z - x * w)
+    bz = 1 - 2 * (x * x + y * y)
+
+    # Entries (0, 0) and (1, 0) of H^T R, where H is the tilt rotation built from b3
+    bxy = bx * by / (1 + bz)
+    hyaw_00 = (1 - bx * bx / (1 + bz)) * r00 - bxy * r10 - bx * r20
+    hyaw_10 = -bxy * r00 + (1 - by * by / (1 + bz)) * r10 - by * r20
+    return np.arctan2(hyaw_10, hyaw_00)
+
+
+def compute_costs(sim_result, robust_c=[0, 1, 0.1, 0.5], num_samples=None):
+    """
+    Computes the cost for every robust_c value in one pass.
+    Inputs:
+        sim_result: The output of a simulator instance, or of batch_rollout.
+        robust_c: Weights of the control cost.
+        num_samples: For batched results, (N,) number of valid samples per rollout. Defaults to
+            sim_result['num_samples'] if present; samples past it are ignored.
+    Outputs:
+        costs: (len(robust_c),) array, or (N, len(robust_c)) for batched results.
+    """
+    actual_pos = sim_result["state"]["x"]  # Position
+    actual_vel = sim_result["state"]["v"]  # Velocity
+    actual_yaw = compute_yaw_from_quaternion(sim_result["state"]["q"])  # Yaw angle
+
+    des_pos = sim_result["flat"]["x"]  # Desired position
+    des_vel = sim_result["flat"]["x_dot"]  # Desired velocity
+    desired_yaw = compute_yaw_from_quaternion(sim_result["control"]["cmd_q"])  # Desired yaw
+
+    cmd_thrust = sim_result["control"]["cmd_thrust"]  # Desired thrust
+    cmd_moment = sim_result["control"]["cmd_moment"]  # Desired body moment
+
+    # Squared norms per sample
+    tracking_cost = (
+        np.sum((actual_pos - des_pos) ** 2, axis=-1)
+        + np.sum((actual_vel - des_vel) ** 2, axis=-1)
+        + (actual_yaw - desired_yaw) ** 2
+    )
+    control_cost = np.reshape(cmd_thrust, tracking_cost.shape) ** 2 + np.sum(cmd_moment**2, axis=-1)
+
+    if num_samples is None:
+        num_samples = sim_result.get("num_samples")
+    if num_samples is not None:
+        valid = np.arange(tracking_cost.shape[-1]) < np.asarray(num_samples)[:, None]
+        tracking_cost = np.where(valid, tracking_cost, 0.0)
+        control_cost = np.where(valid, control_cost, 0.0)
+
+    tracking_sum = np.sum(tracking_cost, axis=-1)
+    control_sum = np.sum(control_cost, axis=-1)
+    return tracking_sum[..., None] + control_sum[..., None] * np.asarray(robust_c, dtype=float)
+
+
+def compute_cost(sim_result, robust_c=1.0):
+    """
+    Computes the cost from the output of a simulator instance.
+    Inputs:
+        sim_result: The output of a simulator instance.
+        robust_c: Weight of the control cost.
+    Outputs:
+        cost: The cost of the trajectory.
+    """
+    return compute_costs(sim_result, [robust_c])[..., 0]
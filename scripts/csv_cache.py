@@ -0,0 +1,146 @@
+"""
+SYNOPSIS
+    Binary cache of the training csv files.
+
+DESCRIPTION
+    Parsing a data_diff_rho_drag{N}.csv file with np.loadtxt takes minutes for
+    a few hundred thousand rows. The first load_csv of a file parses it once
+    and saves the array as .npy next to it, together with a .json describing
+    the source file: its size, modification time and sha256 hash, and the
+    csv header. Later loads memory-map the .npy file instead.
+
+    Before a cache is used, the size and modification time of the csv file
+    are compared with the recorded ones. If either differs, the file is
+    hashed: an unchanged hash (e.g. a copied or touched file) only refreshes
+    the recorded signature, any other change rebuilds the cache. With
+    verify=True the hash is checked on every load.
+
+    Contains:
+    a) load_csv - header and memory-mapped data of a csv file
+    b) content_hash - sha256 of a file
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+CACHE_VERSION = 1
+
+
+def content_hash(path, chunk_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _cache_paths(path, cache_dir):
+    cache_dir = os.path.dirname(os.path.abspath(path)) if cache_dir is None else cache_dir
+    base = os.path.join(cache_dir, os.path.basename(path))
+    return base + ".npy", base + ".json"
+
+
+def _atomic_write_json(path, obj):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _read_header(path):
+    with open(path) as f:
+        return f.readline().strip().split(",")
+
+
+def _cache_status(path, npy_path, meta_path, verify):
+    """
+    Outputs:
+        meta: the recorded metadata if the cache is valid for the current file, otherwise None.
+        refreshed: whether the recorded signature is out of date although the content is not.
+    """
+    if not (os.path.exists(npy_path) and os.path.exists(meta_path)):
+        return None, False
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None, False
+    if meta.get("version") != CACHE_VERSION:
+        return None, False
+
+    size, mtime_ns = _signature(path)
+    if size != meta["size"]:
+        return None, False
+    if mtime_ns == meta["mtime_ns"] and not verify:
+        return meta, False
+    if content_hash(path) != meta["sha256"]:
+        return None, False
+    return meta, mtime_ns != meta["mtime_ns"]
+
+
+def load_csv(path, cache_dir=None, verify=False, dtype=np.float64):
+    """
+    Header and data of a csv file with one header line, through the binary cache.
+    Inputs:
+        path: csv file.
+        cache_dir: directory of the cache files, by default the directory of the csv file. If it is not writable,
+            the file is parsed without caching.
+        verify: check the content hash even if size and modification time match.
+        dtype: dtype of the data.
+    Outputs:
+        header: list of column names.
+        data: (num_rows, num_columns) array, memory-mapped from the cache.
+    """
+    npy_path, meta_path = _cache_paths(path, cache_dir)
+    meta, refreshed = _cache_status(path, npy_path, meta_path, verify)
+    if meta is not None and np.dtype(meta["dtype"]) == np.dtype(dtype):
+        if refreshed:
+            meta["size"], meta["mtime_ns"] = _signature(path)
+            try:
+                _atomic_write_json(meta_path, meta)
+            except OSError:
+                pass
+        return meta["header"], np.load(npy_path, mmap_mode="r")
+
+    signature = _signature(path)
+    sha256 = content_hash(path)
+    header = _read_header(path)
+    data = np.loadtxt(path, delimiter=",", skiprows=1, dtype=dtype, ndmin=2)
+    if _signature(path) != signature:
+        # Modified while being parsed, the next load tries again
+        return header, data
+
+    try:
+        os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+        # The metadata goes first and comes back last, so a cache is never described by a stale record
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        tmp_path = npy_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, data)
+        os.replace(tmp_path, npy_path)
+        _atomic_write_json(
+            meta_path,
+            {
+                "version": CACHE_VERSION,
+                "source": os.path.abspath(path),
+                "size": signature[0],
+                "mtime_ns": signature[1],
+                "sha256": sha256,
+                "header": header,
+                "shape": list(data.shape),
+                "dtype": np.dtype(dtype).str,
+            },
+        )
+    except OSError as e:
+        print("Not caching {}: {}".format(path, e))
+        return header, data
+    return header, np.load(npy_path, mmap_mode="r")
@@ -0,0 +1,155 @@
+"""
+SYNOPSIS
+    Online divergence monitor for early termination of hopeless rollouts.
+
+DESCRIPTION
+    A rollout is considered diverged once its state is no longer finite, its
+    position is further than max_position_error from the reference, or its
+    rotors have been pinned at a speed limit for longer than
+    max_saturation_time. A diverged rollout is stopped at that point instead
+    of being simulated to the end of its trajectory; RotorPy's own safety
+    exits (over speed, over spin) stop it too.
+
+    Costs of a stopped rollout only cover the part that was simulated, so they
+    would show up as deceptively cheap labels. Such rows are flagged as
+    censored and their cost is replaced by the cost rate so far extrapolated
+    to the full duration, clipped to cost_cap. A rollout whose cost is not
+    finite gets cost_cap itself, so every label stays finite and can be
+    trained on; cost_cap is therefore required. Each row also records the
+    simulated time that was skipped, and model_learning.TrajDataset can leave
+    the censored rows out altogether (drop_censored=True).
+
+    Contains:
+    a) DivergenceMonitor - divergence checks for one rollout or a batch
+    b) censored_costs - capped cost labels of stopped rollouts
+"""
+
+import numpy as np
+from rotorpy.simulate import ExitStatus
+
+# Divergence codes, see REASONS
+NOT_DIVERGED, NON_FINITE, TRACKING_ERROR, ROTOR_SATURATION = 0, 1, 2, 3
+REASONS = {
+    NOT_DIVERGED: None,
+    NON_FINITE: "non_finite",
+    TRACKING_ERROR: "tracking_error",
+    ROTOR_SATURATION: "rotor_saturation",
+}
+# Exit status reported to RotorPy's simulate for each divergence code
+EXIT_STATUS = {NON_FINITE: ExitStatus.NAN_VALUE, TRACKING_ERROR: ExitStatus.FLY_AWAY, ROTOR_SATURATION: ExitStatus.OVER_SPIN}
+
+
+def _check_cost_cap(cost_cap):
+    if cost_cap is None:
+        raise ValueError("A cost_cap is required, censored rows would otherwise get unbounded labels.")
+    cap = np.asarray(cost_cap, dtype=float)
+    if not np.all(np.isfinite(cap) & (cap > 0)):
+        raise ValueError("cost_cap must be finite and positive, got {}.".format(cost_cap))
+    return cost_cap
+
+
+class DivergenceMonitor(object):
+    """
+    Divergence checks, run after every simulator step.
+    """
+
+    def __init__(self, cost_cap, max_position_error=3.0, max_saturation_time=0.5):
+        """
+        Inputs:
+            cost_cap: Upper bound of the cost labels of censored rows, a finite positive scalar or one value per
+                robust_c. It is also the label of rollouts whose cost is not finite.
+            max_position_error: Distance in meters from the reference position beyond which a rollout has diverged.
+            max_saturation_time: Seconds a rotor may stay at its minimum or maximum speed before a rollout has diverged.
+        """
+        self.max_position_error = max_position_error
+        self.max_saturation_time = max_saturation_time
+        self.cost_cap = _check_cost_cap(cost_cap)
+
+    def config(self):
+        """
+        Settings of the monitor, as recorded in a job manifest.
+        """
+        return {
+            "max_position_error": self.max_position_error,
+            "max_saturation_time": self.max_saturation_time,
+            "cost_cap": np.asarray(self.cost_cap).tolist(),
+        }
+
+    def start(self, num_rollouts, rotor_speed_min, rotor_speed_max):
+        """
+        Reset the per-rollout state before a (batch of) rollout(s).
+        """
+        self.rotor_speed_min = rotor_speed_min
+        self.rotor_speed_max = rotor_speed_max
+        self.saturated_time = np.zeros(num_rollouts)
+
+    def update(self, t_step, x, x_des, rotor_speeds, idx=None):
+        """
+        Check rollouts after a simulator step.
+        Inputs:
+            t_step: step size in seconds.
+            x: (N, 3) positions.
+            x_des: (N, 3) reference positions.
+            rotor_speeds: (N, num_rotors) rotor speeds.
+            idx: indices of the rollouts given, out of the ones passed to start(). All if None.
+        Outputs:
+            codes: (N,) divergence codes, NOT_DIVERGED for rollouts that go on.
+        """
+        if idx is None:
+            idx = np.arange(self.saturated_time.shape[0])
+        # Rotor speeds lag the clipped commands, so a saturated rotor only gets close to its limit
+        saturated = np.any(
+            (rotor_speeds >= 0.999 * self.rotor_speed_max) | (rotor_speeds <= self.rotor_speed_min + 1e-3 * self.rotor_speed_max),
+            axis=1,
+        )
+        self.saturated_time[idx] = np.where(saturated, self.saturated_time[idx] + t_step, 0.0)
+
+        codes = np.full(x.shape[0], NOT_DIVERGED)
+        codes[self.saturated_time[idx] > self.max_saturation_time] = ROTOR_SATURATION
+        with np.errstate(invalid="ignore"):
+            codes[np.linalg.norm(x - x_des, axis=1) > self.max_position_error] = TRACKING_ERROR
+        codes[~(np.all(np.isfinite(x), axis=1) & np.all(np.isfinite(rotor_speeds), axis=1))] = NON_FINITE
+        return codes
+
+    def terminate_fn(self, vehicle, trajectory, t_step):
+        """
+        Exit check for one rollout in the form RotorPy's simulate takes as `terminate`. After the run, self.code
+        holds the divergence code of the rollout.
+        """
+        self.start(1, vehicle.rotor_speed_min, vehicle.rotor_speed_max)
+        self.code = NOT_DIVERGED
+
+        def terminate(t, state):
+            if t == 0:
+                return None
+            code = self.update(
+                t_step,
+                np.asarray(state["x"])[None],
+                np.asarray(trajectory.update(t)["x"])[None],
+                np.asarray(state["rotor_speeds"])[None],
+            )[0]
+            if code != NOT_DIVERGED:
+                self.code = int(code)
+                return EXIT_STATUS[self.code]
+            return None
+
+        return terminate
+
+
+def censored_costs(costs, t_stop, t_final, cost_cap):
+    """
+    Cost labels of rollouts stopped at t_stop instead of t_final: the costs so far scaled up to the full duration,
+    clipped to cost_cap. Always finite.
+    Inputs:
+        costs: (..., len(robust_c)) costs over the simulated part.
+        t_stop, t_final: (...) times the rollouts stopped at and should have ended at.
+        cost_cap: finite scalar or (len(robust_c),) upper bound.
+    Outputs:
+        costs: (..., len(robust_c)) cost labels.
+    """
+    cap = np.asarray(_check_cost_cap(cost_cap), dtype=float)
+    scale = np.asarray(t_final, dtype=float) / np.maximum(np.asarray(t_stop, dtype=float), 1e-12)
+    with np.errstate(invalid="ignore", over="ignore"):
+        costs = np.minimum(np.asarray(costs, dtype=float) * np.maximum(scale, 1.0)[..., None], cap)
+    # A rollout that went non-finite has no usable cost, so it gets the cap
+    return np.where(np.isfinite(costs), costs, cap)
@@ -0,0 +1,445 @@
+"""
+SYNOPSIS
+    Parallel hyperparameter sweep of the value-function MLP with successive
+    halving.
+
+DESCRIPTION
+    configs/params.yaml fixes one network size, batch size and learning rate.
+    The sweep takes a search space over these instead, picks a set of trial
+    configurations from it and trains them concurrently on a process pool.
+
+    The dataset is read and normalized once in the main process and placed in
+    shared memory; the workers map it without copying. Trials are pruned by
+    successive halving: every trial is trained for min_epochs, only the best
+    1 / eta by validation loss go on to eta times as many epochs, and so on up
+    to max_epochs. A surviving trial resumes from its state at the end of the
+    previous rung, so no epoch is trained twice.
+
+    The output directory receives a leaderboard (leaderboard.csv), the full
+    record of the sweep with the loss of every trial at every rung and the
+    wall time spent on it (sweep.json), and the model bundle of the best trial
+    (best_bundle, see model_bundle.py).
+
+        python hyperparameter_sweep.py --data <csv or store> --output-dir <dir>
+
+    Contains:
+    a) trial_configs - trial configurations of a search space
+    b) SharedArrays - arrays in shared memory for the workers
+    c) successive_halving - the pruned, parallel training of all trials
+    d) run_sweep - sweep over a dataset with leaderboard and best bundle
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import jax
+import numpy as np
+import optax
+import ruamel.yaml as yaml
+from flax import serialization
+from flax.training import train_state
+from sklearn.model_selection import train_test_split
+
+from mlp_jax import MLP
+from model_bundle import save_model
+from model_learning import ArrayLoader, TrajDataset, eval_step, train_epoch
+
+LEADERBOARD_FILE = "leaderboard.csv"
+SWEEP_FILE = "sweep.json"
+BEST_BUNDLE = "best_bundle"
+
+# Search space around configs/params.yaml
+DEFAULT_SPACE = {
+    "num_hidden": [[100, 100, 20], [200, 200, 50], [100, 100], [64, 64, 16]],
+    "batch_size": [128, 256, 512],
+    "learning_rate": [3e-4, 1e-3, 3e-3],
+}
+
+
+def trial_configs(space, num_trials=None, seed=0):
+    """
+    Trial configurations of a search space: the whole grid, or num_trials distinct grid points chosen at random.
+    Inputs:
+        space: dict mapping each hyperparameter to the list of its values.
+        num_trials: number of trials, None for the whole grid.
+        seed: seed of the choice.
+    Outputs:
+        configs: list of dicts with one value per hyperparameter.
+    """
+    names = sorted(space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*[space[name] for name in names])]
+    if num_trials is None or num_trials >= len(grid):
+        return grid
+    chosen = np.random.default_rng(seed).choice(len(grid), size=num_trials, replace=False)
+    return [grid[i] for i in sorted(chosen)]
+
+
+class SharedArrays(object):
+    """
+    numpy arrays copied once into shared memory. The specs can be sent to other processes, which attach to the same
+    memory with SharedArrays.attach.
+    """
+
+    def __init__(self, arrays):
+        self._blocks = []
+        self.specs = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+            self._blocks.append(block)
+            self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+    @staticmethod
+    def attach(specs):
+        """
+        Outputs:
+            blocks: the SharedMemory handles, to be kept alive as long as the arrays are used.
+            arrays: dict of read-only arrays backed by the shared memory.
+        """
+        blocks, arrays = [], {}
+        for name, (block_name, shape, dtype) in specs.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            array.flags.writeable = False
+            blocks.append(block)
+            arrays[name] = array
+        return blocks, arrays
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+
+# Objects shared by all trials run in a worker process, set by _init_worker
+_worker_context = {}
+
+
+def _init_worker(specs, single_threaded=False):
+    """
+    Pool initializer: maps the shared dataset. Runs before the first JAX computation of the worker.
+    """
+    if single_threaded:
+        # The trials already use every core, one XLA thread pool per worker would oversubscribe them
+        os.environ["XLA_FLAGS"] = " ".join(
+            [os.environ.get("XLA_FLAGS", ""), "--xla_cpu_multi_thread_eigen=false"]
+        ).strip()
+    blocks, arrays = SharedArrays.attach(specs)
+    _worker_context.update(blocks=blocks, **arrays)
+
+
+def _validation_loss(state, coeffs, costs, batch_size):
+    losses, sizes = [], []
+    for batch in ArrayLoader(coeffs, costs, batch_size, shuffle=False):
+        losses.append(float(eval_step(state, batch)))
+        sizes.append(batch[0].shape[0])
+    loss = np.average(losses, weights=sizes)
+    return float(loss) if np.isfinite(loss) else math.inf
+
+
+def _train_trial(task):
+    """
+    Train one trial from epochs_done to num_epochs in a worker.
+    Inputs:
+        task: (trial, config, epochs_done, num_epochs, state_bytes, seed), state_bytes being the serialized train state
+            at epochs_done, or None to start from a new initialization.
+    Outputs:
+        result: dict with the validation loss, the wall time of the task and the serialized train state.
+    """
+    trial, config, epochs_done, num_epochs, state_bytes, seed = task
+    start_time = time.perf_counter()
+    ctx = _worker_context
+
+    model = MLP(num_hidden=list(config["num_hidden"]), num_outputs=1)
+    state = train_state.TrainState.create(
+        apply_fn=model.apply,
+        params=model.init(jax.random.PRNGKey(seed + trial), ctx["train_coeffs"][:1]),
+        tx=optax.sgd(learning_rate=config["learning_rate"], momentum=0.9),
+    )
+    if state_bytes is not None:
+        state = serialization.from_bytes(state, state_bytes)
+
+    # A resumed trial must not replay the permutations of its earlier epochs
+    data_loader = ArrayLoader(
+        ctx["train_coeffs"], ctx["train_costs"], config["batch_size"], seed=(seed + trial) * 100003 + epochs_done
+    )
+    for _ in range(num_epochs - epochs_done):
+        state, losses = train_epoch(state, data_loader.epoch())
+    train_loss = float(losses.mean())
+
+    return {
+        "trial": trial,
+        "epochs": num_epochs,
+        "train_loss": train_loss if np.isfinite(train_loss) else math.inf,
+        "val_loss": _validation_loss(state, ctx["val_coeffs"], ctx["val_costs"], config["batch_size"]),
+        "wall_time": time.perf_counter() - start_time,
+        "state_bytes": serialization.to_bytes(state),
+    }
+
+
+def rung_epochs(min_epochs, max_epochs, eta=3):
+    """
+    Epoch budgets of the rungs: min_epochs, eta * min_epochs, ..., up to max_epochs.
+    """
+    budgets = [min_epochs]
+    while budgets[-1] < max_epochs:
+        budgets.append(min(budgets[-1] * eta, max_epochs))
+    return budgets
+
+
+def successive_halving(pool, configs, min_epochs, max_epochs, eta=3, seed=0, log=print):
+    """
+    Train all trials on the pool, keeping the best 1 / eta of them after every rung.
+    Inputs:
+        pool: multiprocessing pool initialized with _init_worker.
+        configs: list of trial configurations.
+        min_epochs, max_epochs: epochs of the first and the last rung.
+        eta: pruning factor.
+        seed: seed of the initializations and shuffling.
+        log: function printing a progress line.
+    Outputs:
+        records: list of one dict per trial with its config, losses per rung, epochs trained, wall time and status.
+        states: dict mapping the trials of the last rung to their serialized train states.
+    """
+    records = [
+        {"trial": i, "config": config, "epochs": 0, "rungs": [], "wall_time": 0.0, "status": "running"}
+        for i, config in enumerate(configs)
+    ]
+    states = {}
+    active = list(range(len(configs)))
+    budgets = rung_epochs(min_epochs, max_epochs, eta)
+
+    for rung, num_epochs in enumerate(budgets):
+        tasks = [
+            (i, configs[i], records[i]["epochs"], num_epochs, states.pop(i, None), seed)
+            for i in active
+        ]
+        for result in pool.imap_unordered(_train_trial, tasks):
+            record = records[result["trial"]]
+            record["epochs"] = result["epochs"]
+            record["wall_time"] += result["wall_time"]
+            record["val_loss"] = result["val_loss"]
+            record["rungs"].append(
+                {"epochs": result["epochs"], "train_loss": result["train_loss"], "val_loss": result["val_loss"]}
+            )
+            states[result["trial"]] = result["state_bytes"]
+
+        ranked = sorted(active, key=lambda i: records[i]["val_loss"])
+        if rung == len(budgets) - 1:
+            kept = ranked
+        else:
+            kept = ranked[: max(1, len(ranked) // eta)]
+        for i in ranked:
+            if i not in kept:
+                records[i]["status"] = "pruned after rung {}".format(rung)
+                states.pop(i, None)
+        log(
+            "Rung {}: {} trials at {} epochs, best val loss {:.4f} (trial {}), {} kept".format(
+                rung, len(active), num_epochs, records[ranked[0]]["val_loss"], ranked[0], len(kept)
+            )
+        )
+        active = kept
+
+    for i in active:
+        records[i]["status"] = "completed"
+    return records, states
+
+
+def leaderboard(records):
+    """
+    Trials ranked by the rung they reached, then by their validation loss there.
+    """
+    return sorted(records, key=lambda record: (-record["epochs"], record["val_loss"]))
+
+
+def _write_leaderboard(path, ranked):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["rank", "trial", "num_hidden", "batch_size", "learning_rate", "epochs", "val_loss", "wall_time", "status"])
+        for rank, record in enumerate(ranked):
+            config = record["config"]
+            writer.writerow([
+                rank,
+                record["trial"],
+                " ".join(str(n) for n in config["num_hidden"]),
+                config["batch_size"],
+                config["learning_rate"],
+                record["epochs"],
+                record["val_loss"],
+                round(record["wall_time"], 3),
+                record["status"],
+            ])
+
+
+def run_sweep(
+    data,
+    output_dir,
+    space=None,
+    num_trials=None,
+    min_epochs=10,
+    max_epochs=1000,
+    eta=3,
+    num_workers=None,
+    rho=0,
+    val_fraction=0.2,
+    seed=0,
+):
+    """
+    Hyperparameter sweep over a dataset.
+    Inputs:
+        data: path of the dataset, as taken by TrajDataset.
+        output_dir: directory of the leaderboard, sweep record and best bundle.
+        space: search space, see trial_configs. DEFAULT_SPACE if None.
+        num_trials: number of trials, None for the whole grid.
+        min_epochs, max_epochs, eta: successive halving schedule, see successive_halving.
+        num_workers: number of worker processes, by default one per core up to the number of trials.
+        rho: cost column to train on.
+        val_fraction: share of the dataset held out for the validation loss.
+        seed: seed of the trial choice, split, initializations and shuffling.
+    Outputs:
+        ranked: leaderboard records.
+    """
+    space = DEFAULT_SPACE if space is None else space
+    configs = trial_configs(space, num_trials, seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    dataset = TrajDataset(file_path=data, rho=rho)
+    coeffs = dataset.input_transform(np.asarray(dataset.coeffs)).astype(np.float32)
+    costs = np.asarray(dataset.costs, dtype=np.float32)
+    train_idx, val_idx = train_test_split(np.arange(len(dataset)), test_size=val_fraction, random_state=42)
+    # A trial batches its training set with drop_last, so it needs at least one full batch
+    too_large = [config for config in configs if config["batch_size"] > len(train_idx)]
+    if too_large:
+        print("Skipping {} trials with batch_size above the {} training samples".format(len(too_large), len(train_idx)))
+        configs = [config for config in configs if config["batch_size"] <= len(train_idx)]
+    if not configs:
+        raise ValueError("No trial has a batch_size of at most the {} training samples.".format(len(train_idx)))
+
+    shared = SharedArrays(
+        {
+            "train_coeffs": coeffs[train_idx],
+            "train_costs": costs[train_idx],
+            "val_coeffs": coeffs[val_idx],
+            "val_costs": costs[val_idx],
+        }
+    )
+    del coeffs, costs
+
+    num_workers = num_workers if num_workers is not None else min(multiprocessing.cpu_count(), len(configs))
+    print(
+        "Sweeping {} trials on {} workers, epochs {} ({} train / {} validation samples)".format(
+            len(configs), num_workers, rung_epochs(min_epochs, max_epochs, eta), len(train_idx), len(val_idx)
+        )
+    )
+    start_time = time.perf_counter()
+    try:
+        # Spawned workers: a forked worker would inherit the state of JAX's threads
+        pool = multiprocessing.get_context("spawn").Pool(
+            num_workers, initializer=_init_worker, initargs=(shared.specs, num_workers > 1)
+        )
+        try:
+            records, states = successive_halving(pool, configs, min_epochs, max_epochs, eta=eta, seed=seed)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shared.close()
+    elapsed = time.perf_counter() - start_time
+
+    ranked = leaderboard(records)
+    _write_leaderboard(os.path.join(output_dir, LEADERBOARD_FILE), ranked)
+    with open(os.path.join(output_dir, SWEEP_FILE), "w") as f:
+        json.dump(
+            {
+                "data": data,
+                "rho": rho,
+                "space": space,
+                "schedule": {"min_epochs": min_epochs, "max_epochs": max_epochs, "eta": eta},
+                "num_workers": num_workers,
+                "seed": seed,
+                "wall_time": elapsed,
+                "trials": ranked,
+            },
+            f,
+            indent=2,
+        )
+
+    best = ranked[0]
+    save_model(
+        os.path.join(output_dir, BEST_BUNDLE),
+        serialization.msgpack_restore(states[best["trial"]])["params"],
+        best["config"]["num_hidden"],
+        dataset.num_coefficients(),
+        coeff_layout=dataset.coeff_columns,
+        normalization=dataset.input_transform,
+        dataset={
+            "file_path": data,
+            "rho": rho,
+            "num_train": len(train_idx),
+            "num_val": len(val_idx),
+            "num_epochs": best["epochs"],
+            "val_loss": best["val_loss"],
+            "config": best["config"],
+        },
+    )
+
+    print("{:>4} {:>5} {:>16} {:>6} {:>8} {:>6} {:>10} {:>9}  {}".format(
+        "rank", "trial", "num_hidden", "batch", "lr", "epochs", "val_loss", "time [s]", "status"))
+    for rank, record in enumerate(ranked):
+        config = record["config"]
+        print("{:>4} {:>5} {:>16} {:>6} {:>8.1e} {:>6} {:>10.4f} {:>9.1f}  {}".format(
+            rank, record["trial"], str(list(config["num_hidden"])), config["batch_size"], config["learning_rate"],
+            record["epochs"], record["val_loss"], record["wall_time"], record["status"]))
+    trial_time = sum(record["wall_time"] for record in records)
+    print("Sweep took {:.1f} s for {:.1f} s of trial time; best bundle in {}".format(
+        elapsed, trial_time, os.path.join(output_dir, BEST_BUNDLE)))
+    return ranked
+
+
+def main(argv=None):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configs", "params.yaml")) as f:
+        yaml_data = yaml.load(f, Loader=yaml.RoundTripLoader)
+
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep with successive halving.")
+    parser.add_argument("--data", required=True, help="Coefficient dataset, a csv file or a store directory.")
+    parser.add_argument("--output-dir", default=yaml_data["save_path"] + "sweep")
+    parser.add_argument("--space", default=None, help="yaml file mapping hyperparameters to lists of values.")
+    parser.add_argument("--num-trials", type=int, default=None, help="Random subset of the grid, all of it if unset.")
+    parser.add_argument("--min-epochs", type=int, default=10)
+    parser.add_argument("--max-epochs", type=int, default=yaml_data["num_epochs"])
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--num-workers", type=int, default=None)
+    parser.add_argument("--rho", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    space = None
+    if args.space is not None:
+        with open(args.space) as f:
+            space = json.loads(json.dumps(yaml.load(f, Loader=yaml.RoundTripLoader)))
+
+    run_sweep(
+        args.data,
+        args.output_dir,
+        space=space,
+        num_trials=args.num_trials,
+        min_epochs=args.min_epochs,
+        max_epochs=args.max_epochs,
+        eta=args.eta,
+        num_workers=args.num_workers,
+        rho=args.rho,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    main()
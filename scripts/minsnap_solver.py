@@ -0,0 +1,259 @@
+"""
+SYNOPSIS
+    Closed-form min-snap solver with cached KKT factorizations.
+
+DESCRIPTION
+    For a fixed time allocation, the min-snap problem of one axis is the QP
+
+        min 0.5 c^T P c   s.t.   A c = b,   G c <= h
+
+    where P, A and G only depend on the segment durations, b is linear in the
+    keyframes (and boundary velocities), and h is the velocity limit at the
+    segment midpoints. Without the inequalities, the optimum solves the KKT
+    system [[P, A^T], [A, 0]] [c; lambda] = [0; b], so one LU factorization of
+    the KKT matrix serves the x, y, z and yaw axes at once, and every later
+    trajectory with the same durations. Since the problem is convex, the
+    equality-constrained optimum is also the optimum of the full QP whenever
+    it satisfies G c <= h; only the axes where a v_max constraint would be
+    violated are handed to cvxopt_solve_qp as before.
+
+    Factorizations are kept in a bounded least-recently-used cache keyed by
+    the exact durations. Within a process, all trajectories built through the
+    module's default solver share it.
+
+    Contains:
+    a) MinSnapSolver - cached KKT solves with a QP fallback
+    b) CachedMinSnap - drop-in replacement for rotorpy's MinSnap
+"""
+
+from collections import OrderedDict
+
+import cvxopt
+import numpy as np
+from scipy.linalg import block_diag, lu_factor, lu_solve
+from rotorpy.trajectories.minsnap import MinSnap
+
+# Forks of rotorpy keep the QP helpers in traj_template, released versions in minsnap
+try:
+    from rotorpy.trajectories.traj_template import H_fun, cvxopt_solve_qp, get_1d_constraints
+except ImportError:
+    from rotorpy.trajectories.minsnap import H_fun, cvxopt_solve_qp, get_1d_constraints
+
+
+class MinSnapSolver(object):
+    """
+    Solves the min-snap QPs of get_1d_constraints for many axes and trajectories, reusing one KKT factorization per
+    set of segment durations.
+    """
+
+    def __init__(self, poly_degree=7, cache_size=256, tolerance=1e-9):
+        """
+        Inputs:
+            poly_degree: degree of the polynomial of each segment.
+            cache_size: number of factorizations kept.
+            tolerance: relative slack on the velocity limits before an axis is solved with the QP instead.
+        """
+        self.poly_degree = poly_degree
+        self.cache_size = cache_size
+        self.tolerance = tolerance
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "fallbacks": self.fallbacks, "cached": len(self._cache)}
+
+    def problem(self, delta_t):
+        """
+        Keyframe-independent part of the min-snap problem for the durations delta_t, from the cache if possible.
+        Outputs:
+            problem: dict with the cost P, the constraint matrices A and G of one axis (see get_1d_constraints), and
+                the LU factorization of the KKT matrix.
+        """
+        delta_t = np.asarray(delta_t, dtype=float)
+        key = delta_t.tobytes()
+        problem = self._cache.get(key)
+        if problem is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return problem
+
+        self.misses += 1
+        k, m = self.poly_degree, delta_t.shape[0]
+        P = block_diag(*[H_fun(dt, k=k) for dt in delta_t])
+        P = 0.5 * (P + P.T)
+        A, _, G, _ = get_1d_constraints(np.zeros(m + 1), delta_t, m, k=k, vmax=0)
+        n, n_eq = P.shape[0], A.shape[0]
+        kkt = np.zeros((n + n_eq, n + n_eq))
+        kkt[:n, :n] = P
+        kkt[:n, n:] = A.T
+        kkt[n:, :n] = A
+        problem = {"P": P, "A": A, "G": G, "lu": lu_factor(kkt)}
+
+        self._cache[key] = problem
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return problem
+
+    @staticmethod
+    def equality_rhs(keyframes, vstart=0, vend=0):
+        """
+        Right-hand sides b of the equality constraints of get_1d_constraints, for several axes at once.
+        Inputs:
+            keyframes: (m + 1, d) keyframes of d axes.
+            vstart, vend: scalars or (d,) velocities at the start and end.
+        Outputs:
+            b: (6 * m + 2, d) array.
+        """
+        keyframes = np.asarray(keyframes, dtype=float)
+        m, d = keyframes.shape[0] - 1, keyframes.shape[1]
+        rows = []
+        for i in range(m):
+            # Positions at both ends of the segment, then four zero continuity rows for the interior segments
+            rows.extend([keyframes[i], keyframes[i + 1]])
+            if i < m - 1:
+                rows.extend([np.zeros(d)] * 4)
+        rows.extend([np.broadcast_to(vstart, (d,)), np.broadcast_to(vend, (d,))])
+        # Zero acceleration and jerk at both ends
+        rows.extend([np.zeros(d)] * 4)
+        return np.array(rows, dtype=float)
+
+    def solve(self, delta_t, keyframes, vmax, vstart=0, vend=0):
+        """
+        Min-snap coefficients of several axes sharing the durations delta_t.
+        Inputs:
+            delta_t: (m,) segment durations.
+            keyframes: (m + 1, d) keyframes of d axes.
+            vmax: scalar or (d,) velocity limits at the segment midpoints.
+            vstart, vend: scalars or (d,) velocities at the start and end.
+        Outputs:
+            c: (m * (poly_degree + 1), d) coefficients, lowest degree first within each segment, the layout of
+                cvxopt_solve_qp's solution.
+        """
+        problem = self.problem(delta_t)
+        b = self.equality_rhs(keyframes, vstart, vend)
+        n, d = problem["P"].shape[0], b.shape[1]
+        vmax = np.broadcast_to(np.asarray(vmax, dtype=float), (d,))
+
+        rhs = np.zeros((n + b.shape[0], d))
+        rhs[n:] = b
+        c = lu_solve(problem["lu"], rhs)[:n]
+
+        # Axes whose midpoint velocities exceed v_max need the inequality constraints after all
+        active = np.any(problem["G"] @ c > vmax + self.tolerance * np.maximum(np.abs(vmax), 1.0), axis=0)
+        for j in np.flatnonzero(active):
+            self.fallbacks += 1
+            h = np.full(problem["G"].shape[0], vmax[j])
+            c_qp = cvxopt_solve_qp(problem["P"], q=np.zeros((n, 1)), G=problem["G"], h=h, A=problem["A"], b=b[:, j])
+            if c_qp is None:
+                raise ValueError("The min-snap QP with v_max = {} has no optimal solution.".format(vmax[j]))
+            c[:, j] = c_qp
+        return c
+
+
+# One solver per polynomial degree, shared by all trajectories of a process that do not bring their own
+_default_solvers = {}
+
+
+def default_solver(poly_degree=7):
+    if poly_degree not in _default_solvers:
+        _default_solvers[poly_degree] = MinSnapSolver(poly_degree)
+    return _default_solvers[poly_degree]
+
+
+def _polyder(p, order):
+    """
+    Derivative of highest-degree-first polynomial coefficients along the last axis, like np.polyder.
+    """
+    for _ in range(order):
+        degree = p.shape[-1] - 1
+        p = p[..., :-1] * np.arange(degree, 0, -1)
+    return p
+
+
+class CachedMinSnap(MinSnap):
+    """
+    rotorpy's MinSnap, with the four QPs replaced by one MinSnapSolver call. Takes the same arguments and has the
+    same attributes, plus the coefficient vectors c_opt_x, c_opt_y, c_opt_z, c_opt_xyz and c_opt_yaw.
+    """
+
+    def __init__(
+        self,
+        points,
+        yaw_angles=None,
+        yaw_rate_max=2 * np.pi,
+        poly_degree=7,
+        yaw_poly_degree=7,
+        v_max=3,
+        v_avg=1,
+        v_start=[0, 0, 0],
+        v_end=[0, 0, 0],
+        verbose=True,
+        solver=None,
+    ):
+        """
+        Inputs:
+            Same as MinSnap.
+            solver: MinSnapSolver to use. Defaults to the one shared by the process.
+        """
+        if poly_degree != 7 or yaw_poly_degree != 7:
+            raise NotImplementedError("Oops, we haven't implemented cost functions for polynomial degree != 7 yet.")
+        solver = solver if solver is not None else default_solver(poly_degree)
+
+        if yaw_angles is None:
+            self.yaw = np.zeros((points.shape[0]))
+        else:
+            self.yaw = yaw_angles
+        self.v_avg = v_avg
+
+        # Only used if the QP fallback runs
+        cvxopt.solvers.options["show_progress"] = verbose
+
+        # Compute the distances between each waypoint.
+        seg_dist = np.linalg.norm(np.diff(points, axis=0), axis=1)
+        seg_mask = np.append(True, seg_dist > 1e-1)
+        self.points = points[seg_mask, :]
+
+        self.null = False
+
+        m = self.points.shape[0] - 1  # Get the number of segments
+
+        if self.points.shape[0] >= 2:
+            ################## Time allocation
+            self.delta_t = seg_dist / self.v_avg
+            self.t_keyframes = np.concatenate(([0], np.cumsum(self.delta_t)))
+
+            ################## Solve for x, y, z, and yaw together
+            # Same keyframes and durations as MinSnap passes to get_1d_constraints, which only reads the first m
+            # durations and m + 1 yaw angles
+            keyframes = np.column_stack((self.points, np.asarray(self.yaw, dtype=float)[: m + 1]))
+            c = solver.solve(
+                self.delta_t[:m],
+                keyframes,
+                vmax=[v_max, v_max, v_max, yaw_rate_max],
+                vstart=np.append(v_start, 0),
+                vend=np.append(v_end, 0),
+            )
+            self.c_opt_x, self.c_opt_y, self.c_opt_z, self.c_opt_yaw = c.T.copy()
+            self.c_opt_xyz = np.concatenate([self.c_opt_x, self.c_opt_y, self.c_opt_z])
+
+            ################## Construct polynomials from c_opt
+            # (m, poly_degree + 1, 4) lowest degree first -> (m, 4, poly_degree + 1) highest degree first
+            polys = np.flip(c.reshape(m, poly_degree + 1, 4).transpose(0, 2, 1), axis=2)
+            self.x_poly = polys[:, :3, :].copy()
+            self.yaw_poly = polys[:, 3:, :].copy()
+            self.x_dot_poly = _polyder(self.x_poly, 1)
+            self.x_ddot_poly = _polyder(self.x_poly, 2)
+            self.x_dddot_poly = _polyder(self.x_poly, 3)
+            self.x_ddddot_poly = _polyder(self.x_poly, 4)
+            self.yaw_dot_poly = _polyder(self.yaw_poly, 1)
+            self.yaw_ddot_poly = _polyder(self.yaw_poly, 2)
+
+        else:
+            # Otherwise, there is only one waypoint so we just set everything = 0.
+            self.null = True
+            m = 1
+            self.T = np.zeros((m,))
+            self.x_poly = np.zeros((m, 3, 6))
+            self.x_poly[0, :, -1] = points[0, :]
@@ -16,8 +16,12 @@ VERSION
 
 # import flax
 from flax import linen as nn # type: ignore
-import torch.nn as tnn # type: ignore
-import torch.nn.functional as F # type: ignore
+try:
+    # Only needed for MLP_torch
+    import torch.nn as tnn # type: ignore
+    import torch.nn.functional as F # type: ignore
+except ImportError:
+    tnn = None
 # import torch
 # import numpy as np
 
@@ -41,10 +45,12 @@ class MLP(nn.Module):
 
 
 
-class MLP_torch(tnn.Module):
+class MLP_torch(tnn.Module if tnn is not None else object):
     def __init__(self,
                  inp_size=100,
                  num_hidden=[500, 400, 200]):
+      if tnn is None:
+          raise ImportError("MLP_torch requires torch.")
       super(MLP_torch, self).__init__()
 
       self.inp_size = inp_size
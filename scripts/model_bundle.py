@@ -0,0 +1,205 @@
+"""
+SYNOPSIS
+    Self-describing model bundles of trained value-function MLPs.
+
+DESCRIPTION
+    A flax checkpoint only holds a TrainState, so restoring it needs the exact
+    MLP, optimizer and a dummy state rebuilt by hand, and reading it goes
+    through tensorflow's gfile. A bundle is a directory with the parameters
+    in flax's msgpack format (params.msgpack) and a model.json holding
+    everything needed to use them: the hidden layer sizes, the input size,
+    the coefficient layout the inputs follow, the input normalization and
+    metadata of the training data. load_model rebuilds the predictor from the
+    bundle alone, without reading any dataset.
+
+    The per-feature normalization a model was trained with is normally folded
+    into its first layer when it is saved, so the saved parameters take raw
+    coefficients and cost nothing extra to evaluate; model.json still records
+    the constants.
+
+    The predictor maps (N, input_size) polynomial coefficients to (N,)
+    predicted log costs. It also has the `apply(params, coeffs)` of a flax
+    module, so (bundle, bundle.params) can be passed wherever a
+    (model, params) regularizer is expected, e.g. sgd_jax.modify_reference.
+
+    Contains:
+    a) save_model - write a bundle
+    b) load_model - read a bundle into a ModelBundle
+    c) ModelBundle - jitted predictor of a bundle
+    d) fold_normalization - input normalization folded into the first layer
+"""
+
+import json
+import os
+import re
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+from flax import serialization
+
+from mlp_jax import MLP
+
+BUNDLE_FILE = "model.json"
+PARAMS_FILE = "params.msgpack"
+BUNDLE_VERSION = 1
+
+_COEFF_COLUMN = re.compile(r"^(\w+)_poly_seg_(\d+)_coeff_(\d+)$")
+
+
+def layout_from_columns(columns):
+    """
+    Coefficient layout (as in rotorpy_data.coeff_layout) of coefficient column names like x_poly_seg_0_coeff_0.
+    """
+    columns = list(columns)
+    matches = [_COEFF_COLUMN.match(name) for name in columns]
+    if not all(matches):
+        return {"columns": columns}
+    axes = list(dict.fromkeys(m.group(1) for m in matches))
+    return {
+        "axes": axes,
+        "num_segments": max(int(m.group(2)) for m in matches) + 1,
+        "num_coeffs": max(int(m.group(3)) for m in matches) + 1,
+        "columns": columns,
+    }
+
+
+def fold_normalization(params, shift, scale):
+    """
+    Parameters of an MLP on raw coefficients computing what `params` computes on (coeffs - shift) / scale, by
+    rescaling the first layer: kernel / scale[:, None] and bias - (shift / scale) @ kernel.
+    """
+    state_dict = serialization.to_state_dict(jax.device_get(params))
+    layers = dict(state_dict["params"])
+    kernel = np.asarray(layers["linear_0"]["kernel"])
+    bias = np.asarray(layers["linear_0"]["bias"])
+    shift, scale = np.asarray(shift, dtype=float), np.asarray(scale, dtype=float)
+    layers["linear_0"] = {
+        "kernel": (kernel / scale[:, None]).astype(kernel.dtype),
+        "bias": (bias - (shift / scale) @ kernel).astype(bias.dtype),
+    }
+    return dict(state_dict, params=layers)
+
+
+def _write_atomic(path, data, mode="wb"):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, mode) as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def save_model(path, params, num_hidden, input_size, coeff_layout=None, normalization=None, dataset=None, fold=True):
+    """
+    Write a model bundle.
+    Inputs:
+        path: bundle directory, created if needed.
+        params: parameters of the MLP, e.g. a TrainState's params.
+        num_hidden: hidden layer sizes of the MLP.
+        input_size: number of coefficients the MLP takes.
+        coeff_layout: layout of the coefficients, see rotorpy_data.coeff_layout, or a list of column names.
+        normalization: normalization the MLP was trained with, a dict or an object (e.g. TrajDataset.input_transform)
+            with (input_size,) 'shift' and 'scale': the MLP takes (coeffs - shift) / scale. None for raw coefficients.
+        dataset: JSON-serializable description of the training data, e.g. its path, rho and size.
+        fold: fold the normalization into the first layer, so the saved parameters take raw coefficients at no extra
+            cost. Otherwise the predictor normalizes before the MLP.
+    Outputs:
+        metadata: the written model.json content.
+    """
+    if coeff_layout is not None and not isinstance(coeff_layout, dict):
+        coeff_layout = layout_from_columns(coeff_layout)
+    if coeff_layout is not None and len(coeff_layout["columns"]) != input_size:
+        raise ValueError("coeff_layout has {} columns, the model takes {}.".format(len(coeff_layout["columns"]), input_size))
+    if normalization is not None:
+        if not isinstance(normalization, dict):
+            normalization = {"shift": normalization.shift, "scale": normalization.scale}
+        normalization = {key: np.asarray(normalization[key], dtype=float).tolist() for key in ("shift", "scale")}
+        if fold:
+            params = fold_normalization(params, normalization["shift"], normalization["scale"])
+        normalization["folded"] = bool(fold)
+
+    metadata = {
+        "version": BUNDLE_VERSION,
+        "model": "MLP",
+        "num_hidden": [int(n) for n in num_hidden],
+        "num_outputs": 1,
+        "input_size": int(input_size),
+        "output": "log_cost",
+        "coeff_layout": coeff_layout,
+        "normalization": normalization,
+        "dataset": json.loads(json.dumps(dataset, default=lambda o: np.asarray(o).tolist())),
+    }
+
+    os.makedirs(path, exist_ok=True)
+    state_dict = serialization.to_state_dict(jax.device_get(params))
+    _write_atomic(os.path.join(path, PARAMS_FILE), serialization.msgpack_serialize(state_dict))
+    # model.json goes last, a bundle without it is incomplete
+    _write_atomic(os.path.join(path, BUNDLE_FILE), json.dumps(metadata, indent=2), mode="w")
+    return metadata
+
+
+def is_bundle(path):
+    return os.path.isfile(os.path.join(path, BUNDLE_FILE))
+
+
+class ModelBundle(object):
+    """
+    Jitted predictor of the log cost of polynomial coefficients.
+    """
+
+    def __init__(self, metadata, params):
+        """
+        Inputs:
+            metadata: content of model.json.
+            params: parameters of the MLP.
+        """
+        if metadata.get("version") != BUNDLE_VERSION:
+            raise ValueError("Unsupported model bundle version {}.".format(metadata.get("version")))
+        self.metadata = metadata
+        self.input_size = metadata["input_size"]
+        self.model = MLP(num_hidden=metadata["num_hidden"], num_outputs=metadata["num_outputs"])
+        self.params = jax.tree_util.tree_map(jnp.asarray, params)
+        normalization = metadata.get("normalization")
+        # Folded normalization is part of the first layer already
+        if normalization is not None and not normalization.get("folded", False):
+            self._shift = jnp.asarray(normalization["shift"])
+            self._scale = jnp.asarray(normalization["scale"])
+        else:
+            self._shift = self._scale = None
+        self._predict = jax.jit(lambda params, coeffs: self.apply(params, coeffs)[..., 0])
+
+    @property
+    def coeff_layout(self):
+        return self.metadata.get("coeff_layout")
+
+    def apply(self, params, coeffs):
+        """
+        Network output for coefficients, like flax's Module.apply.
+        """
+        if self._shift is not None:
+            coeffs = (coeffs - self._shift) / self._scale
+        return self.model.apply(params, coeffs)
+
+    def __call__(self, coeffs):
+        """
+        Inputs:
+            coeffs: (N, input_size) or (input_size,) polynomial coefficients.
+        Outputs:
+            log_costs: (N,) or scalar predicted log costs.
+        """
+        coeffs = jnp.asarray(coeffs)
+        if coeffs.shape[-1] != self.input_size:
+            raise ValueError("The model takes {} coefficients, got {}.".format(self.input_size, coeffs.shape[-1]))
+        return self._predict(self.params, coeffs)
+
+
+def load_model(path):
+    """
+    Read a model bundle written by save_model.
+    Outputs:
+        bundle: ModelBundle, ready to call on coefficients.
+    """
+    with open(os.path.join(path, BUNDLE_FILE)) as f:
+        metadata = json.load(f)
+    with open(os.path.join(path, PARAMS_FILE), "rb") as f:
+        params = serialization.msgpack_restore(f.read())
+    return ModelBundle(metadata, params)
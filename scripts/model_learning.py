@@ -9,7 +9,6 @@ DESCRIPTION
 """
 from flax import linen as nn
 from flax.training import checkpoints  # need to install tensorflow
-import torch.utils.data as data
 import numpy as np
 import optax
 
@@ -18,62 +17,139 @@ from tqdm.auto import tqdm
 
 import jax
 import jax.numpy as jnp
-from torch.utils.data import Dataset
-import torch
+from jax.sharding import Mesh, NamedSharding, PartitionSpec
+from functools import partial
+import os
 
-from torch.utils.tensorboard import SummaryWriter
+try:
+    # Only needed to feed TrajDataset to a torch DataLoader and for tensorboard logging, training runs on ArrayLoader
+    import torch
+    from torch.utils.data import Dataset
+    from torch.utils.tensorboard import SummaryWriter
+except ImportError:
+    torch = None
+    Dataset = object
+    SummaryWriter = None
 
+from csv_cache import load_csv
+from traj_store import TrajStore
 
-writer = SummaryWriter()
+
+writer = SummaryWriter() if SummaryWriter is not None else None
 
 class NormalizeTransform:
     def __init__(self, min_val, max_val, feature_range=(-1, 1)):
+        """
+        Affine map of [min_val, max_val] onto feature_range, written as (coeffs - shift) / scale
+        :param min_val: scalar or per-feature minimum
+        :param max_val: scalar or per-feature maximum
+        :param feature_range: (0, 1) or (-1, 1)
+        """
         self.min_val = min_val
         self.max_val = max_val
         self.feature_range = feature_range
-
-    def __call__(self, coeffs):
-        coeffs_normalized = (coeffs - self.min_val) / (self.max_val - self.min_val)
+        # Features that never vary are only shifted
+        value_range = np.asarray(max_val, dtype=float) - np.asarray(min_val, dtype=float)
+        value_range = np.where(value_range > 0, value_range, 1.0)
         if self.feature_range == (0, 1):
-            return coeffs_normalized
+            self.shift, self.scale = np.asarray(min_val, dtype=float), value_range
         elif self.feature_range == (-1, 1):
-            return 2 * coeffs_normalized - 1
+            self.shift = 0.5 * (np.asarray(min_val, dtype=float) + np.asarray(max_val, dtype=float))
+            self.scale = 0.5 * value_range
         else:
             raise ValueError("Unsupported feature range. Use (0, 1) or (-1, 1).")
 
+    def __call__(self, coeffs):
+        return (coeffs - self.shift) / self.scale
+
+
+def feature_statistics(coeffs, chunk_size=65536):
+    """
+    Per-feature statistics in one streaming pass over the rows, so memory-mapped data is read chunk by chunk
+    :param coeffs: (N, p) array or memmap
+    :param chunk_size: number of rows read at once
+    :return: dict of (p,) arrays 'min', 'max', 'mean' and 'std'
+    """
+    count, mean, m2 = 0, 0.0, 0.0
+    min_val, max_val = None, None
+    for start in range(0, len(coeffs), chunk_size):
+        chunk = np.asarray(coeffs[start : start + chunk_size], dtype=float)
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        # Pairwise merge of the running moments with those of the chunk
+        total = count + chunk.shape[0]
+        delta = chunk_mean - mean
+        mean = mean + delta * chunk.shape[0] / total
+        m2 = m2 + chunk_m2 + delta**2 * count * chunk.shape[0] / total
+        count = total
+        min_val = chunk.min(axis=0) if min_val is None else np.minimum(min_val, chunk.min(axis=0))
+        max_val = chunk.max(axis=0) if max_val is None else np.maximum(max_val, chunk.max(axis=0))
+    if count == 0:
+        raise ValueError("No rows to compute statistics of.")
+    return {"min": min_val, "max": max_val, "mean": mean, "std": np.sqrt(m2 / count)}
+
 
 class TrajDataset(Dataset):
     """
     Dataset class inherited from torch modules
     """
     # def __init__(self, file_path, device=torch.device('cpu'), transform=None, target_transform=None):
-    def __init__(self, file_path, rho=0, input_transform=None, target_transform=None, feature_range=(-1, 1)):
+    def __init__(self, file_path, rho=0, input_transform=None, target_transform=None, feature_range=(-1, 1), cache_dir=None, normalize=True, drop_censored=False):
         """
         Creating the dataset class for our pipeline
-        :param file_path: path of csv file
+        :param file_path: path of csv file, or of a sharded store directory (see traj_store.py), or a list of store directories
         :param costs: an array containing the costs for each trajectory
         :param input_transform: function to transform the coefficient data, if needed
         :param target_transform: function to transform the costs such as normalization, if needed
         :param feature_range: normalize inputs -> (-1,1) or(0,1)
+        :param cache_dir: directory of the binary cache of a csv file (see csv_cache.py), by default next to the file
+        :param normalize: map every coefficient onto feature_range with the per-feature min and max of the dataset
+        :param drop_censored: leave out the rows a divergence monitor flagged as censored (see divergence.py), whose
+            costs are extrapolated rather than simulated. Files without a 'censored' column are kept whole
         """
-        self.data = np.loadtxt(file_path, delimiter=",",skiprows=1,)
- 
-        # Assuming the first column is 'traj_number', the second is 'cost', and the rest are coefficients
-        self.coeffs = self.data[:, 5:]  # All coefficient columns
-        # self.costs = self.data[:, 4]  # Cost column for rho = 0
-        if rho == 0:
-            self.costs = self.data[:, 1]  # Cost column for rho = 0
-        elif rho == 1:
-            self.costs = self.data[:, 2]  # Cost column for rho = 1
-        # take log of costs
-        self.costs = np.log(self.costs)
-       
-        # Get the global min and max for the entire dataset
-        self.global_min = np.min(self.coeffs)
-        self.global_max = np.max(self.coeffs)
-
-        # The transform provided in the arguments is now a class that will handle normalization
-        self.input_transform = NormalizeTransform(self.global_min, self.global_max, feature_range)
+        self.rho = rho
+        if TrajStore.exists(file_path):
+            # Shards are memory-mapped, coefficients are only read when indexed
+            store = TrajStore(file_path)
+            self.data = store.view()
+            self.coeff_columns = list(store.coeff_columns)
+            self.coeffs = store.view(self.coeff_columns)
+            self.costs = np.log(store.column("cost_{}".format(rho)))
+            if drop_censored and "censored" in store.columns:
+                # Only the kept rows are gathered, and the shard statistics would include the dropped ones
+                keep = np.flatnonzero(store.column("censored") == 0)
+                self.data, self.coeffs, self.costs = self.data[keep], self.coeffs[keep], self.costs[keep]
+                stats = feature_statistics(self.coeffs)
+                self.feature_min, self.feature_max = stats["min"], stats["max"]
+            else:
+                # Min and max come from the per-shard statistics in the schema
+                self.feature_min = store.column_min(self.coeff_columns)
+                self.feature_max = store.column_max(self.coeff_columns)
+        else:
+            # Parsed once, later runs memory-map the binary cache next to the csv file
+            header, self.data = load_csv(file_path, cache_dir=cache_dir)
+            if drop_censored and "censored" in header:
+                self.data = self.data[self.data[:, header.index("censored")] == 0]
+
+            # Columns are found by name, since files written with a divergence monitor hold two more columns
+            # ('censored', 'time_saved') between the costs and the coefficients
+            self.coeff_columns = [name for name in header if "_poly_seg_" in name]
+            self.coeffs = self.data[:, [header.index(name) for name in self.coeff_columns]]
+            self.costs = self.data[:, header.index("cost_{}".format(rho))]
+            # take log of costs
+            self.costs = np.log(self.costs)
+
+            # Per-feature min and max of the entire dataset
+            stats = feature_statistics(self.coeffs)
+            self.feature_min, self.feature_max = stats["min"], stats["max"]
+
+        self.global_min = np.min(self.feature_min)
+        self.global_max = np.max(self.feature_max)
+
+        # Coefficients span many orders of magnitude, so every feature is mapped onto feature_range on its own. The
+        # transform is folded into the first layer of an exported model (see model_bundle.save_model)
+        self.normalize = normalize
+        self.input_transform = NormalizeTransform(self.feature_min, self.feature_max, feature_range)
         self.target_transform = target_transform
         
 
@@ -81,15 +157,15 @@ class TrajDataset(Dataset):
         return len(self.data)
 
     def __getitem__(self, idx):
-        if torch.is_tensor(idx):
+        if torch is not None and torch.is_tensor(idx):
             idx = idx.tolist()
 
         # The first column is 'traj_number' and the second column is 'cost'
         # The rest of the columns are coefficients: x_poly_seg_0_coeff_0,x_poly_seg_0_coeff_1, ..., yaw_poly_seg_2_coeff_7
         coeffs = self.coeffs[idx]
         cost = self.costs[idx]
-        # if self.input_transform:
-        #     coeffs = self.input_transform(coeffs)
+        if self.normalize:
+            coeffs = self.input_transform(coeffs)
         # if self.target_transform:
             # cost = self.target_transform(cost)
 
@@ -100,6 +176,99 @@ class TrajDataset(Dataset):
 
 
 
+@jax.jit
+def _gather_batches(coeffs, costs, idx):
+    """
+    Gather the samples of a whole epoch at once
+    :param coeffs: (N, p) coefficients
+    :param costs: (N,) costs
+    :param idx: (num_batches, batch_size) sample indices
+    :return: (num_batches, batch_size, p) coefficients, (num_batches, batch_size) costs
+    """
+    return coeffs[idx], costs[idx]
+
+
+class ArrayLoader:
+    """
+    Batches of a dataset held as device arrays, a replacement for a torch DataLoader with numpy_collate
+    """
+    def __init__(self, coeffs, costs, batch_size, shuffle=True, drop_last=None, seed=0):
+        """
+        Keeps the coefficient and cost arrays on the device and batches them by index gather, without any per-sample
+        Python call
+        :param coeffs: (N, p) coefficients
+        :param costs: (N,) costs
+        :param batch_size: number of samples in a batch
+        :param shuffle: draw a new permutation of the samples every epoch
+        :param drop_last: drop the last incomplete batch so every batch has the same shape and train_step compiles
+            once. Defaults to shuffle, since the dropped samples then change from epoch to epoch
+        :param seed: seed of the shuffling
+        """
+        self.coeffs = jnp.asarray(coeffs, dtype=jnp.float32)
+        self.costs = jnp.asarray(costs, dtype=jnp.float32).ravel()
+        if self.coeffs.shape[0] != self.costs.shape[0]:
+            raise ValueError("coeffs and costs hold {} and {} samples.".format(self.coeffs.shape[0], self.costs.shape[0]))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = shuffle if drop_last is None else drop_last
+        self.rng = jax.random.PRNGKey(seed)
+        if self.drop_last and len(self) == 0:
+            raise ValueError("Fewer samples ({}) than batch_size ({}).".format(self.num_samples, batch_size))
+
+    @classmethod
+    def from_dataset(cls, dataset, indices=None, **kwargs):
+        """
+        Loader over the samples of a TrajDataset, normalized if the dataset normalizes
+        :param dataset: TrajDataset
+        :param indices: indices of the samples to use, e.g. one side of a train_test_split. All if None
+        :param kwargs: arguments of ArrayLoader
+        :return: ArrayLoader
+        """
+        coeffs, costs = np.asarray(dataset.coeffs), np.asarray(dataset.costs)
+        if indices is not None:
+            coeffs, costs = coeffs[indices], costs[indices]
+        if getattr(dataset, "normalize", False):
+            # Once for the whole array, nothing is left to do per batch
+            coeffs = dataset.input_transform(coeffs)
+        return cls(coeffs, costs, **kwargs)
+
+    @property
+    def num_samples(self):
+        return self.coeffs.shape[0]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return -(-self.num_samples // self.batch_size)
+
+    def _permutation(self):
+        if not self.shuffle:
+            return jnp.arange(self.num_samples)
+        self.rng, perm_rng = jax.random.split(self.rng)
+        return jax.random.permutation(perm_rng, self.num_samples)
+
+    def epoch(self):
+        """
+        All full batches of one epoch, stacked along a leading batch axis
+        :return: (num_batches, batch_size, p) coefficients, (num_batches, batch_size) costs
+        """
+        return self._gather(self._permutation())[:2]
+
+    def _gather(self, idx):
+        num_batches = self.num_samples // self.batch_size
+        coeffs, costs = _gather_batches(
+            self.coeffs, self.costs, idx[: num_batches * self.batch_size].reshape(num_batches, self.batch_size)
+        )
+        return coeffs, costs, idx[num_batches * self.batch_size :]
+
+    def __iter__(self):
+        coeffs, costs, remainder = self._gather(self._permutation())
+        for i in range(coeffs.shape[0]):
+            yield coeffs[i], costs[i]
+        if not self.drop_last and remainder.shape[0] > 0:
+            yield self.coeffs[remainder], self.costs[remainder]
+
+
 def numpy_collate(batch):
     """
     A numpy helper function for efficient batching from JAX documentation
@@ -133,8 +302,7 @@ def calculate_loss(state, params, batch):
     return loss
 
 
-@jax.jit  # Jit the function for efficiency
-def train_step(state, batch):
+def _train_step(state, batch):
     """
     One iteration of training by running the back propagation through the batch
     :param state: weights of the neural network model
@@ -149,13 +317,27 @@ def train_step(state, batch):
     )
     # Determine gradients for current model, parameters and batch
     loss, grads = grad_fn(state, state.params, batch)
-    print(loss)
     # Perform parameter update with gradients and optimizer
     state = state.apply_gradients(grads=grads)
     # Return state and any other value we might want
     return state, loss
 
 
+train_step = jax.jit(_train_step)  # Jit the function for efficiency
+
+
+@partial(jax.jit, donate_argnums=0)
+def train_epoch(state, batches):
+    """
+    One epoch of training as a single compiled scan over its batches. The buffers of the input state are donated to
+    the returned one, so the input state must not be used after the call
+    :param state: weights of the neural network model
+    :param batches: (coeffs, costs) of all batches of the epoch stacked along a leading axis, see ArrayLoader.epoch
+    :return: state, (num_batches,) losses
+    """
+    return jax.lax.scan(_train_step, state, batches)
+
+
 @jax.jit  # Jit the function for efficiency
 def eval_step(state, batch):
     """
@@ -169,24 +351,75 @@ def eval_step(state, batch):
     return loss
 
 
-def train_model(state, data_loader, num_epochs=100):
+def set_host_device_count(num_devices):
+    """
+    Expose num_devices XLA devices on the CPU, for data-parallel training on one machine. Only takes effect before
+    JAX initializes its backends, i.e. before the first computation of the process
+    :param num_devices: number of devices
+    :return: None
+    """
+    flags = [
+        flag for flag in os.environ.get("XLA_FLAGS", "").split()
+        if not flag.startswith("--xla_force_host_platform_device_count")
+    ]
+    flags.append("--xla_force_host_platform_device_count={}".format(num_devices))
+    os.environ["XLA_FLAGS"] = " ".join(flags)
+
+
+def data_parallel_mesh(num_devices=None):
+    """
+    Mesh with one 'data' axis over the first num_devices devices
+    :param num_devices: number of devices, all if None
+    :return: jax.sharding.Mesh
+    """
+    devices = jax.devices()
+    num_devices = len(devices) if num_devices is None else num_devices
+    if len(devices) < num_devices:
+        raise ValueError(
+            "{} devices requested, but JAX has {}. Call set_host_device_count before the first JAX "
+            "computation.".format(num_devices, len(devices))
+        )
+    return Mesh(np.array(devices[:num_devices]), ("data",))
+
+
+def train_model(state, data_loader, num_epochs=100, mesh=None):
     """
     Train the model over the training dataset
     :param state: weights of the neural network model
-    :param data_loader: batched dataset
+    :param data_loader: batched dataset, an ArrayLoader (trained one compiled epoch at a time) or any iterable of batches
     :param num_epochs: number of epochs
+    :param mesh: data_parallel_mesh to split every batch across, None to train on the default device. The state is
+        replicated on all devices of the mesh and XLA all-reduces the gradients, so the result is the same model as
+        without a mesh and is checkpointed the same way
     :return: state
     """
+    if mesh is not None:
+        if not isinstance(data_loader, ArrayLoader):
+            raise ValueError("Data-parallel training needs an ArrayLoader.")
+        if data_loader.batch_size % mesh.size != 0:
+            raise ValueError("batch_size {} is not divisible by {} devices.".format(data_loader.batch_size, mesh.size))
+        state = jax.device_put(state, NamedSharding(mesh, PartitionSpec()))
+        batch_sharding = NamedSharding(mesh, PartitionSpec(None, "data"))
+
     # Training loop
     for epoch in tqdm(range(num_epochs)):
-        epoch_loss = 0
-        for batch in data_loader:
-            state, loss = train_step(state, batch)
-            # Accumulate the loss over the epoch
-            epoch_loss += loss
+        if isinstance(data_loader, ArrayLoader):
+            batches = data_loader.epoch()
+            if mesh is not None:
+                batches = jax.device_put(batches, batch_sharding)
+            # The whole epoch runs in one call, the loss stays on the device unless it is logged
+            state, losses = train_epoch(state, batches)
+            epoch_loss = losses.sum()
+        else:
+            epoch_loss = 0
+            for batch in data_loader:
+                state, loss = train_step(state, batch)
+                # Accumulate the loss over the epoch
+                epoch_loss += loss
 
         # Record the epoch loss at the end of the epoch
-        writer.add_scalar('Train loss', np.array(epoch_loss), epoch)
+        if writer is not None:
+            writer.add_scalar('Train loss', np.array(epoch_loss), epoch)
         
     return state
 
@@ -0,0 +1,344 @@
+"""
+SYNOPSIS
+    Vehicle-parameter sweep for generating one dataset per configuration.
+
+DESCRIPTION
+    A sweep takes a list of quad_params overrides (drag coefficients, mass,
+    inertia) and simulates every sampled trajectory under every configuration.
+    The waypoints and the minsnap trajectory of a seed are built once and
+    reused for all configurations, and all (configuration, seed) pairs run on
+    one worker pool. The output directory holds a configs.json listing the
+    configurations and one sharded store (see traj_store.py) per
+    configuration, in the same layout as rotorpy_data.main writes.
+
+    Contains:
+    a) config_grid - cartesian product of parameter overrides
+    b) generate_sweep - runs the sweep
+    c) main - sweep over the drag configurations used for the drag datasets
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+from rotorpy.controllers.quadrotor_control import SE3Control
+from rotorpy.vehicles.hummingbird_params import quad_params
+from rotorpy.vehicles.multirotor import Multirotor
+from rotorpy.world import World
+
+from batch_rollout import batch_rollout
+from cost_labels import compute_costs
+from result_writer import ResultWriter, bounded_imap_unordered
+from rotorpy_data import (
+    coeff_layout,
+    hover_initial_state,
+    sample_minsnap_trajectory,
+    save_path,
+    simulate_minsnap,
+    summary_columns,
+    summary_row,
+)
+from traj_store import TrajStoreWriter
+
+# Drag configurations 1-5 of the drag datasets
+DRAG_CONFIGS = [
+    {"c_Dx": 0.2e-2, "c_Dy": 0.2e-2, "c_Dz": 0.7e-2},
+    {"c_Dx": 0.35e-2, "c_Dy": 0.35e-2, "c_Dz": 0.9e-2},
+    {"c_Dx": 0.5e-2, "c_Dy": 0.5e-2, "c_Dz": 1e-2},
+    {"c_Dx": 0.65e-2, "c_Dy": 0.65e-2, "c_Dz": 1.1e-2},
+    {"c_Dx": 0.8e-2, "c_Dy": 0.8e-2, "c_Dz": 1.3e-2},
+]
+
+CONFIGS_FILE = "configs.json"
+
+
+def config_grid(drag=None, mass=None, inertia=None):
+    """
+    Cartesian product of quad_params overrides.
+    Inputs:
+        drag: list of dicts with keys c_Dx, c_Dy, c_Dz, or None to keep the base values.
+        mass: list of masses, or None to keep the base value.
+        inertia: list of dicts with keys Ixx, Iyy, Izz, or None to keep the base values.
+    Outputs:
+        configs: list of (name, overrides) tuples, named config_0, config_1, ...
+    """
+    axes = [
+        drag if drag is not None else [{}],
+        [{"mass": m} for m in mass] if mass is not None else [{}],
+        inertia if inertia is not None else [{}],
+    ]
+    configs = []
+    for i, parts in enumerate(itertools.product(*axes)):
+        overrides = {}
+        for part in parts:
+            overrides.update(part)
+        configs.append(("config_{}".format(i), overrides))
+    return configs
+
+
+def make_vehicle_and_controller(base_params, overrides):
+    """
+    Vehicle and controller for one configuration. Both are built from the overridden parameters, like editing
+    quad_params at the top of rotorpy_data.py did.
+    """
+    params = dict(base_params, **overrides)
+    return Multirotor(params), SE3Control(params)
+
+
+def simulate_seed_chunk(world, models, seeds, sampling_args, robust_c, rollout_batch_size=1):
+    """
+    Simulates the trajectories of a chunk of seeds under every configuration.
+    Inputs:
+        world: Instance of World class containing the map extents and any obstacles.
+        models: list of (vehicle, controller), one per configuration.
+        seeds: array of seeds.
+        sampling_args: keyword arguments of sample_minsnap_trajectory other than world and seed.
+        robust_c: Weights of the control cost.
+        rollout_batch_size: if larger than 1, the trajectories are simulated together with batch_rollout.
+    Outputs:
+        rows: (len(models) * len(seeds), 1 + num_columns) array. The first column is the configuration index,
+            the rest is a row of the data file.
+    """
+    # Waypoints and minsnap trajectories are shared by all configurations
+    samples = [sample_minsnap_trajectory(world, seed=seed, **sampling_args) for seed in seeds]
+
+    rows = []
+    for k, (vehicle, controller) in enumerate(models):
+        if rollout_batch_size > 1:
+            costs = []
+            for i in range(0, len(samples), rollout_batch_size):
+                batch = samples[i : i + rollout_batch_size]
+                sim_result = batch_rollout(
+                    vehicle,
+                    controller,
+                    [traj for _, traj in batch],
+                    [hover_initial_state(waypoints) for waypoints, _ in batch],
+                    sim_rate=100,
+                )
+                costs.append(compute_costs(sim_result, robust_c))
+            costs = np.concatenate(costs, axis=0)
+        else:
+            costs = [
+                compute_costs(simulate_minsnap(vehicle, controller, waypoints, traj)[1], robust_c)
+                for waypoints, traj in samples
+            ]
+        for seed, (_, traj), trajectory_cost in zip(seeds, samples, costs):
+            rows.append(np.concatenate(([k], summary_row(seed, trajectory_cost, traj))))
+    return np.array(rows)
+
+
+# Per-process state of the worker pool, set once by _init_worker.
+_worker_context = {}
+
+
+def _init_worker(world, base_params, overrides, sampling_args, robust_c, rollout_batch_size):
+    _worker_context.update(
+        world=world,
+        models=[make_vehicle_and_controller(base_params, o) for o in overrides],
+        sampling_args=sampling_args,
+        robust_c=robust_c,
+        rollout_batch_size=rollout_batch_size,
+    )
+
+
+def _run_seed_chunk(seeds):
+    start_time = time.perf_counter()
+    ctx = _worker_context
+    rows = simulate_seed_chunk(
+        ctx["world"],
+        ctx["models"],
+        seeds,
+        ctx["sampling_args"],
+        ctx["robust_c"],
+        ctx["rollout_batch_size"],
+    )
+    return rows, time.perf_counter() - start_time
+
+
+def generate_sweep(
+    output_dir,
+    world,
+    configs,
+    num_simulations,
+    num_waypoints,
+    vavg,
+    random_yaw,
+    yaw_min,
+    yaw_max,
+    world_buffer,
+    min_distance,
+    max_distance,
+    start_waypoint,
+    end_waypoint,
+    base_params=quad_params,
+    parallel=True,
+    robust_c=[0, 1, 0.1, 0.5],
+    rollout_batch_size=1,
+    chunk_size=None,
+    shard_size=10000,
+):
+    """
+    Generates one dataset per vehicle configuration from a shared set of trajectories.
+    Inputs:
+        output_dir: Directory of the sweep. Must not contain a previous sweep.
+        world: Instance of World class containing the map extents and any obstacles.
+        configs: list of (name, overrides) tuples, e.g. from config_grid.
+        base_params: quad_params the overrides are applied to.
+        chunk_size: Number of seeds per task. If None, chosen from the number of seeds and cores.
+        shard_size: Number of rows per shard of each store.
+        The other inputs are the same as for rotorpy_data.generate_data.
+    Outputs:
+        paths: dict from configuration name to the path of its store.
+    """
+    if os.path.exists(os.path.join(output_dir, CONFIGS_FILE)):
+        raise ValueError("{} already holds a sweep.".format(output_dir))
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, CONFIGS_FILE), "w") as f:
+        json.dump(
+            {
+                "base_params": base_params,
+                "configs": [{"name": name, "overrides": overrides} for name, overrides in configs],
+            },
+            f,
+            indent=2,
+            default=lambda o: np.asarray(o).tolist(),
+        )
+
+    paths = {name: os.path.join(output_dir, name) for name, _ in configs}
+    writers = [
+        TrajStoreWriter(
+            paths[name],
+            columns=summary_columns(num_waypoints, robust_c),
+            seed_column="traj_number",
+            cost_columns=["cost_{}".format(i) for i in robust_c],
+            coeff_layout=coeff_layout(num_waypoints),
+            shard_size=shard_size,
+        )
+        for name, _ in configs
+    ]
+
+    def write_partitioned(rows):
+        for k in np.unique(rows[:, 0]).astype(int):
+            writers[k].append(rows[rows[:, 0] == k, 1:])
+
+    sampling_args = dict(
+        num_waypoints=num_waypoints,
+        start_waypoint=start_waypoint,
+        end_waypoint=end_waypoint,
+        world_buffer=world_buffer,
+        min_distance=min_distance,
+        max_distance=max_distance,
+        vavg=vavg,
+        random_yaw=random_yaw,
+        yaw_min=yaw_min,
+        yaw_max=yaw_max,
+    )
+    overrides = [o for _, o in configs]
+
+    # Use numpy random to generate seeds for each simulation.
+    seeds = np.random.choice(
+        np.arange(num_simulations), size=num_simulations, replace=False
+    )
+
+    if not parallel:
+        _init_worker(world, base_params, overrides, sampling_args, robust_c, rollout_batch_size)
+        chunk_size = chunk_size or max(rollout_batch_size, 1)
+        for i in tqdm(
+            range(0, len(seeds), chunk_size),
+            desc="Running sweep over {} configurations (sequentially)...".format(len(configs)),
+        ):
+            write_partitioned(_run_seed_chunk(seeds[i : i + chunk_size])[0])
+    else:
+        num_cores = min(multiprocessing.cpu_count(), 40)
+        if chunk_size is None:
+            chunk_size = int(np.clip(np.ceil(len(seeds) / (4 * num_cores)), 1, 64))
+        chunk_size = max(chunk_size, rollout_batch_size)
+
+        print(
+            "Running {} simulations ({} seeds x {} configurations) in parallel with up to {} cores.".format(
+                len(seeds) * len(configs), len(seeds), len(configs), num_cores
+            )
+        )
+        pool = multiprocessing.Pool(
+            num_cores,
+            initializer=_init_worker,
+            initargs=(world, base_params, overrides, sampling_args, robust_c, rollout_batch_size),
+        )
+        result_writer = ResultWriter(write_partitioned)
+        chunks = (seeds[i : i + chunk_size] for i in range(0, len(seeds), chunk_size))
+        try:
+            with tqdm(total=len(seeds)) as progress:
+                # A slow output blocks put(), which holds back further tasks
+                for rows, _ in bounded_imap_unordered(pool, _run_seed_chunk, chunks, 2 * num_cores):
+                    result_writer.put(rows)
+                    progress.update(rows.shape[0] // len(configs))
+        except BaseException:
+            # Commit what finished before the error ends the sweep
+            pool.terminate()
+            pool.join()
+            result_writer.close()
+            for writer in writers:
+                writer.flush()
+            raise
+        pool.close()
+        pool.join()
+        result_writer.close()
+
+    for writer in writers:
+        writer.flush()
+
+    return paths
+
+
+def main(num_simulations, parallel_bool, rollout_batch_size=1):
+    """
+    Sweep over the five drag configurations with the datagen settings of rotorpy_data.main.
+    Inputs:
+        num_simulations: The number of trajectories, each simulated under every configuration.
+        parallel_bool: If True, runs the simulations in parallel. If False, runs the simulations sequentially.
+        rollout_batch_size: Number of trajectories each worker simulates together with the batch rollout engine.
+    """
+    world_size = 10
+    world = World.empty(
+        [
+            -world_size / 2,
+            world_size / 2,
+            -world_size / 2,
+            world_size / 2,
+            -world_size / 2,
+            world_size / 2,
+        ]
+    )
+    configs = [("drag{}".format(i + 1), drag) for i, drag in enumerate(DRAG_CONFIGS)]
+
+    start_time = time.time()
+    paths = generate_sweep(
+        os.path.join(save_path, "drag_sweep"),
+        world,
+        configs,
+        num_simulations,
+        num_waypoints=4,
+        vavg=2,
+        random_yaw=False,
+        yaw_min=-0.85 * np.pi,
+        yaw_max=0.85 * np.pi,
+        world_buffer=2,
+        min_distance=1,
+        max_distance=4,
+        start_waypoint=None,
+        end_waypoint=None,
+        parallel=parallel_bool,
+        rollout_batch_size=rollout_batch_size,
+    )
+    print("Time elapsed: %3.2f seconds" % (time.time() - start_time))
+    for name, path in paths.items():
+        print("{}: {}".format(name, path))
+
+
+if __name__ == "__main__":
+    main(num_simulations=200000, parallel_bool=True)
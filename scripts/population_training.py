@@ -0,0 +1,262 @@
+"""
+SYNOPSIS
+    Trains a population of identically shaped value-function MLPs in one run.
+
+DESCRIPTION
+    training.py trains one MLP per cost column (rho) and drag configuration,
+    each with its own full run. Since all of them share the architecture,
+    their parameters and optimizer states can be stacked along a leading
+    member axis and train_step vmapped across it, so K members train in one
+    compiled epoch (see model_learning.train_epoch) in about the wall time of
+    one.
+
+    Every member brings its own inputs and targets, e.g. the cost column of
+    its rho from the dataset of its drag configuration, normalized per feature
+    with the input transform of that dataset, and is shuffled
+    independently. Members may hold different numbers of samples: an epoch
+    has as many batches as the largest member needs, and a smaller member
+    moves on to a fresh permutation of its data once it has seen all of it.
+    Each member is checkpointed on its own, as a regular TrainState that
+    model_learning.restore_checkpoint reads like one from training.py, and
+    main() also writes each member's model bundle with its normalization, as
+    training.py does.
+
+    Contains:
+    a) PopulationLoader - stacked, independently shuffled member datasets
+    b) create_population - stacked train states of the members
+    c) population_train_epoch - one compiled epoch of all members
+    d) train_population - training loop with per-member checkpoints
+    e) held_out_loss - loss of a member on held-out samples
+"""
+
+import os
+from functools import partial
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+import ruamel.yaml as yaml
+from flax.training import train_state
+from sklearn.model_selection import train_test_split
+from tqdm import tqdm
+
+from mlp_jax import MLP
+from model_bundle import save_model
+from model_learning import ArrayLoader, TrajDataset, eval_step, save_checkpoint, train_step
+
+
+@jax.jit
+def _gather_member_batches(coeffs, costs, idx):
+    """
+    (K, N_max, p), (K, N_max) and (K, num_batches, batch_size) -> (num_batches, K, batch_size, p) and
+    (num_batches, K, batch_size), batch-major for the scan over the epoch.
+    """
+    coeffs, costs = jax.vmap(lambda c, y, i: (c[i], y[i]))(coeffs, costs, idx)
+    return jnp.swapaxes(coeffs, 0, 1), jnp.swapaxes(costs, 0, 1)
+
+
+class PopulationLoader(object):
+    """
+    Batches of K member datasets held as stacked device arrays.
+    """
+
+    def __init__(self, coeffs, costs, batch_size, seed=0):
+        """
+        Inputs:
+            coeffs: list of K (N_k, p) member inputs.
+            costs: list of K (N_k,) member targets.
+            batch_size: number of samples in a batch of each member.
+            seed: seed of the shuffling.
+        """
+        if len(coeffs) != len(costs):
+            raise ValueError("Got inputs of {} members and targets of {}.".format(len(coeffs), len(costs)))
+        self.sizes = np.array([len(c) for c in coeffs])
+        if np.any(self.sizes < batch_size):
+            raise ValueError("Every member needs at least batch_size ({}) samples, got {}.".format(batch_size, self.sizes))
+        num_features = {np.shape(c)[1] for c in coeffs}
+        if len(num_features) != 1:
+            raise ValueError("Members have different numbers of coefficients: {}.".format(sorted(num_features)))
+
+        # Padded to the largest member, the padding is never gathered
+        size = self.sizes.max()
+        stacked_coeffs = np.zeros((len(coeffs), size, num_features.pop()), dtype=np.float32)
+        stacked_costs = np.zeros((len(coeffs), size), dtype=np.float32)
+        for k, (c, y) in enumerate(zip(coeffs, costs)):
+            stacked_coeffs[k, : self.sizes[k]] = c
+            stacked_costs[k, : self.sizes[k]] = np.ravel(y)
+        self.coeffs = jnp.asarray(stacked_coeffs)
+        self.costs = jnp.asarray(stacked_costs)
+        self.batch_size = batch_size
+        self.num_batches = int(size // batch_size)
+        self.rng = np.random.default_rng(seed)
+        # Permuted indices not yet used by each member, carried over to the next epoch. They are drawn on the host,
+        # where their varying lengths cost nothing, and gathered on the device with one fixed shape per epoch
+        self._pending = [np.zeros(0, dtype=np.int32) for _ in self.sizes]
+
+    @property
+    def num_members(self):
+        return len(self.sizes)
+
+    def __len__(self):
+        return self.num_batches
+
+    def _member_indices(self, k):
+        needed = self.num_batches * self.batch_size
+        idx = self._pending[k]
+        while idx.shape[0] < needed:
+            idx = np.concatenate([idx, self.rng.permutation(self.sizes[k]).astype(np.int32)])
+        self._pending[k] = idx[needed:]
+        return idx[:needed].reshape(self.num_batches, self.batch_size)
+
+    def epoch(self):
+        """
+        All batches of one epoch of every member.
+        Outputs:
+            coeffs: (num_batches, K, batch_size, p) inputs.
+            costs: (num_batches, K, batch_size) targets.
+        """
+        idx = np.stack([self._member_indices(k) for k in range(self.num_members)])
+        return _gather_member_batches(self.coeffs, self.costs, jnp.asarray(idx))
+
+
+def create_population(model, tx, rngs, sample_input):
+    """
+    Train states of K members initialized from their own keys, stacked along a leading axis.
+    Inputs:
+        model: flax module shared by the members.
+        tx: optax optimizer shared by the members.
+        rngs: (K, 2) PRNG keys of the member initializations.
+        sample_input: (batch_size, p) input for model.init.
+    Outputs:
+        states: TrainState whose leaves have a leading member axis.
+    """
+    return jax.vmap(
+        lambda rng: train_state.TrainState.create(apply_fn=model.apply, params=model.init(rng, sample_input), tx=tx)
+    )(rngs)
+
+
+def member_state(states, k):
+    """
+    Train state of member k, as a single-model TrainState.
+    """
+    return jax.tree_util.tree_map(lambda x: x[k], states)
+
+
+@partial(jax.jit, donate_argnums=0)
+def population_train_epoch(states, batches):
+    """
+    One epoch of training of all members as a single compiled scan. The buffers of the input states are donated.
+    Inputs:
+        states: stacked train states, see create_population.
+        batches: (coeffs, costs) of PopulationLoader.epoch.
+    Outputs:
+        states: updated train states.
+        losses: (num_batches, K) losses.
+    """
+    return jax.lax.scan(jax.vmap(train_step), states, batches)
+
+
+def train_population(states, data_loader, num_epochs=100, workdirs=None, step=0):
+    """
+    Train all members and checkpoint each on its own.
+    Inputs:
+        states: stacked train states, see create_population.
+        data_loader: PopulationLoader over the members' data.
+        num_epochs: number of epochs.
+        workdirs: list of K checkpoint directories, one per member, or None for no checkpoints.
+        step: checkpoint index.
+    Outputs:
+        states: trained stacked train states.
+        epoch_losses: (num_epochs, K) mean batch loss of each member per epoch.
+    """
+    epoch_losses = []
+    for _ in tqdm(range(num_epochs)):
+        states, losses = population_train_epoch(states, data_loader.epoch())
+        epoch_losses.append(losses.mean(axis=0))
+    epoch_losses = np.asarray(jnp.stack(epoch_losses))
+
+    if workdirs is not None:
+        for k, workdir in enumerate(workdirs):
+            save_checkpoint(member_state(states, k), workdir, step)
+    return states, epoch_losses
+
+
+def held_out_loss(state, coeffs, costs, batch_size):
+    """
+    Mean loss of one member over held-out samples, batch by batch in order.
+    """
+    losses, sizes = [], []
+    for batch in ArrayLoader(coeffs, costs, batch_size, shuffle=False):
+        losses.append(float(eval_step(state, batch)))
+        sizes.append(batch[0].shape[0])
+    return float(np.average(losses, weights=sizes))
+
+
+def main(rhos=(0, 1), drag_coeffs=(1, 2, 3, 4), data_pattern=None):
+    """
+    Train the models of every rho and drag configuration of training.py together, with the network of
+    configs/params.yaml. Each member trains on the same 80% split of its dataset as training.py and reports its loss
+    on the held-out 20%. The checkpoint of (rho, drag_coeff) goes to save_path + str(rho) + str(drag_coeff) and its
+    model bundle next to it with a "_bundle" suffix, as in training.py.
+    Inputs:
+        rhos: cost columns to train on.
+        drag_coeffs: drag configurations, each with its own dataset.
+        data_pattern: path of the dataset of a drag configuration, formatted with drag_coeff.
+    """
+    config_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "configs")
+    with open(os.path.join(config_dir, "params.yaml")) as f:
+        yaml_data = yaml.load(f, Loader=yaml.RoundTripLoader)
+    if data_pattern is None:
+        data_pattern = os.path.join(config_dir, "..", "data", "data_diff_rho_drag{}.csv")
+
+    batch_size = yaml_data["batch_size"]
+    coeffs, costs, test_sets, workdirs, datasets = [], [], [], [], []
+    for drag_coeff in drag_coeffs:
+        for rho in rhos:
+            dataset = TrajDataset(file_path=data_pattern.format(drag_coeff), rho=rho)
+            # The split of training.py, so the checkpoints written to the same places stay comparable
+            train_idx, test_idx = train_test_split(np.arange(len(dataset)), test_size=0.2, random_state=42)
+            # Each drag configuration has its own feature ranges, so each member gets its dataset's normalization
+            member_coeffs = dataset.input_transform(np.asarray(dataset.coeffs))
+            member_costs = np.asarray(dataset.costs)
+            coeffs.append(member_coeffs[train_idx])
+            costs.append(member_costs[train_idx])
+            test_sets.append((member_coeffs[test_idx], member_costs[test_idx]))
+            workdirs.append(yaml_data["save_path"] + str(rho) + str(drag_coeff))
+            datasets.append((dataset, drag_coeff))
+    print("Training {} members on {} samples".format(len(workdirs), [len(c) for c in costs]))
+
+    model = MLP(num_hidden=list(yaml_data["num_hidden"]), num_outputs=1)
+    tx = optax.sgd(learning_rate=yaml_data["learning_rate"], momentum=0.9)
+    rngs = jax.random.split(jax.random.PRNGKey(427), len(workdirs))
+    states = create_population(model, tx, rngs, jnp.zeros((batch_size, coeffs[0].shape[1])))
+
+    data_loader = PopulationLoader(coeffs, costs, batch_size)
+    states, epoch_losses = train_population(states, data_loader, num_epochs=yaml_data["num_epochs"], workdirs=workdirs)
+    for k, (workdir, (dataset, drag_coeff), (test_coeffs, test_costs)) in enumerate(zip(workdirs, datasets, test_sets)):
+        state = member_state(states, k)
+        test_loss = held_out_loss(state, test_coeffs, test_costs, batch_size)
+        # Self-describing copy of the model for inference, see model_bundle.load_model
+        save_model(
+            workdir + "_bundle",
+            state.params,
+            list(yaml_data["num_hidden"]),
+            dataset.num_coefficients(),
+            coeff_layout=dataset.coeff_columns,
+            normalization=dataset.input_transform,
+            dataset={
+                "file_path": data_pattern.format(drag_coeff),
+                "rho": dataset.rho,
+                "drag_coeff": drag_coeff,
+                "num_train": len(coeffs[k]),
+                "num_test": len(test_costs),
+                "num_epochs": yaml_data["num_epochs"],
+                "test_loss": test_loss,
+            },
+        )
+        print("{}: final epoch loss {:.4f}, test loss {:.4f}".format(workdir, epoch_losses[-1, k], test_loss))
+
+
+if __name__ == "__main__":
+    main()
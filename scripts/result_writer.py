@@ -0,0 +1,183 @@
+"""
+SYNOPSIS
+    Single-writer pipeline for simulation results.
+
+DESCRIPTION
+    Parallel data generation produces result rows in the pool's result handler.
+    Instead of writing every row under a lock, the rows are put on a bounded
+    queue drained by one writer thread, which batches them and hands them to
+    the output whenever enough rows have accumulated or enough time has passed.
+    When the output is slower than the workers the queue fills up and put()
+    blocks the main process.
+
+    Pool.imap_unordered would not pass that on to the workers: its task
+    handler submits every task up front and its results pile up in an
+    unbounded list. bounded_imap_unordered only submits a new task once a
+    result has been taken, so while put() blocks, no more work is handed out
+    and the workers go idle after the tasks already in flight.
+
+    Results may also carry per-trial time series (see trial_archive.py).
+    They are handed to their own output at every flush, just before the rows
+    they came with.
+
+    Contains:
+    a) ResultWriter - bounded-queue writer thread with flush statistics
+    b) bounded_imap_unordered - pool.imap_unordered with a bounded number of tasks in flight
+"""
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+_STOP = object()
+
+
+class ResultWriter(object):
+    """
+    Writer thread fed by a bounded queue.
+    """
+
+    def __init__(self, write_fn, max_queue_size=256, flush_rows=1000, flush_interval=5.0, trial_fn=None):
+        """
+        Start the writer thread.
+        Inputs:
+            write_fn: function called as write_fn(rows) with a 2D array of rows. Only ever called from the writer thread.
+            max_queue_size: number of queued results after which put() blocks.
+            flush_rows: number of buffered rows that triggers a flush.
+            flush_interval: seconds after which buffered rows are flushed regardless of their number.
+            trial_fn: function called as trial_fn(trials) with the list of trials given to put() since the last flush.
+                Only ever called from the writer thread.
+        """
+        self.write_fn = write_fn
+        self.trial_fn = trial_fn
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.rows_written = 0
+        self.flush_latencies = []
+        self.queue_depths = []
+        self.blocked_time = 0.0
+        self._error = None
+
+        self._thread = threading.Thread(target=self._run, name="ResultWriter", daemon=True)
+        self._thread.start()
+
+    def put(self, rows, trials=None):
+        """
+        Queue one row or a 2D array of rows, and optionally a list of trials. Blocks while the queue is full.
+        """
+        if trials and self.trial_fn is None:
+            raise ValueError("ResultWriter was created without a trial_fn.")
+        if self._error is not None:
+            raise self._error
+        self.queue_depths.append(self.queue.qsize())
+        start = time.perf_counter()
+        self.queue.put((np.atleast_2d(rows), trials or []))
+        self.blocked_time += time.perf_counter() - start
+
+    def close(self):
+        """
+        Flush everything still queued and stop the writer thread.
+        Outputs:
+            dict of statistics, see stats().
+        """
+        self.queue.put(_STOP)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.stats()
+
+    def stats(self):
+        """
+        Outputs:
+            dict with the number of rows written and flushes, mean/max flush latency in seconds, mean/max queue depth
+            seen by put(), and the total time put() spent blocked on a full queue.
+        """
+        latencies = np.asarray(self.flush_latencies) if self.flush_latencies else np.zeros(1)
+        depths = np.asarray(self.queue_depths) if self.queue_depths else np.zeros(1)
+        return {
+            "rows_written": self.rows_written,
+            "num_flushes": len(self.flush_latencies),
+            "mean_flush_latency": float(np.mean(latencies)),
+            "max_flush_latency": float(np.max(latencies)),
+            "mean_queue_depth": float(np.mean(depths)),
+            "max_queue_depth": int(np.max(depths)),
+            "blocked_time": self.blocked_time,
+        }
+
+    def _flush(self, buffer, trials):
+        start = time.perf_counter()
+        rows = np.concatenate(buffer, axis=0)
+        if trials:
+            self.trial_fn(trials)
+        self.write_fn(rows)
+        self.flush_latencies.append(time.perf_counter() - start)
+        self.rows_written += rows.shape[0]
+
+    def _run(self):
+        buffer, trials, buffered_rows = [], [], 0
+        last_flush = time.monotonic()
+        stopping = False
+        while not stopping:
+            timeout = max(self.flush_interval - (time.monotonic() - last_flush), 0.0)
+            try:
+                item = self.queue.get(timeout=timeout)
+                if item is _STOP:
+                    stopping = True
+                else:
+                    rows, item_trials = item
+                    buffer.append(rows)
+                    trials.extend(item_trials)
+                    buffered_rows += rows.shape[0]
+            except queue.Empty:
+                pass
+
+            due = time.monotonic() - last_flush >= self.flush_interval
+            if buffered_rows > 0 and (stopping or due or buffered_rows >= self.flush_rows):
+                try:
+                    self._flush(buffer, trials)
+                except Exception as e:
+                    # Keep draining the queue so producers do not block forever; the error is raised by put()/close()
+                    self._error = e
+                buffer, trials, buffered_rows = [], [], 0
+            if buffered_rows == 0:
+                last_flush = time.monotonic()
+
+
+def bounded_imap_unordered(pool, func, iterable, max_in_flight):
+    """
+    Results of func over iterable on a multiprocessing pool, in the order they finish, like pool.imap_unordered.
+    Inputs:
+        pool: multiprocessing pool.
+        func: function called in the workers with one item of iterable.
+        iterable: task arguments, consumed lazily.
+        max_in_flight: number of tasks submitted whose results have not been taken yet, including finished ones.
+            A new task is only submitted after a result has been taken.
+    """
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be at least 1, got {}.".format(max_in_flight))
+    done = queue.Queue()
+    tasks = iter(iterable)
+    in_flight = 0
+    exhausted = False
+    while True:
+        while not exhausted and in_flight < max_in_flight:
+            try:
+                task = next(tasks)
+            except StopIteration:
+                exhausted = True
+                break
+            pool.apply_async(
+                func, (task,), callback=lambda result: done.put((True, result)), error_callback=lambda e: done.put((False, e))
+            )
+            in_flight += 1
+        if in_flight == 0:
+            return
+        ok, result = done.get()
+        in_flight -= 1
+        if not ok:
+            raise result
+        yield result
@@ -4,41 +4,30 @@ collect data with different penalty values
 
 from rotorpy.controllers.quadrotor_control import SE3Control
 from rotorpy.vehicles.multirotor import Multirotor
-from rotorpy.trajectories.minsnap import MinSnap
 # from rotorpy.vehicles.crazyflie_params import quad_params
 from rotorpy.vehicles.hummingbird_params import quad_params
 from rotorpy.environments import Environment
+from rotorpy.simulate import ExitStatus
 from rotorpy.world import World
 from rotorpy.utils.occupancy_map import OccupancyMap
 import numpy as np  # For array creation/manipulation
 import os  # For path generation
 import multiprocessing
 import csv
+import shutil
+import weakref
 from tqdm import tqdm
 import time
 import datetime
-from scipy.spatial.transform import Rotation as R
-
-# quad_params["c_Dx"] = 0.8e-2  # config 5
-# quad_params["c_Dy"] = 0.8e-2
-# quad_params["c_Dz"] = 1.3e-2
-
-# quad_params["c_Dx"] = 0.65e-2  # config 4
-# quad_params["c_Dy"] = 0.65e-2
-# quad_params["c_Dz"] = 1.1e-2
-
-# quad_params["c_Dx"] = 0.5e-2  # config 3
-# quad_params["c_Dy"] = 0.5e-2
-# quad_params["c_Dz"] = 1e-2
-
-# quad_params["c_Dx"] = 0.35e-2  # config 2
-# quad_params["c_Dy"] = 0.35e-2
-# quad_params["c_Dz"] = 0.9e-2
-
-
-# quad_params["c_Dx"] = 0.2e-2  # config 1
-# quad_params["c_Dy"] = 0.2e-2
-# quad_params["c_Dz"] = 0.7e-2
+from batch_rollout import batch_rollout
+from cost_labels import compute_costs
+from traj_store import MANIFEST_FILE, JobManifest, TrajStoreWriter
+from result_writer import ResultWriter, bounded_imap_unordered
+from trial_archive import TrialArchiveWriter, pack_trial
+from seed_streams import shard_indices, trajectory_generator, trajectory_seed_sequence
+from divergence import censored_costs
+from telemetry import DatagenTelemetry, StageTimer
+from minsnap_solver import CachedMinSnap
 
 cwd = os.getcwd()
 
@@ -52,31 +41,6 @@ save_path = cwd + "/data"
 print("Path to save to", save_path)
 
 
-def compute_yaw_from_quaternion(quaternions):
-    R_matrices = R.from_quat(quaternions).as_matrix()
-    b3 = R_matrices[:, :, 2]
-    H = np.zeros((len(quaternions), 3, 3))
-    for i in range(len(quaternions)):
-        H[i, :, :] = np.array(
-            [
-                [
-                    1 - (b3[i, 0] ** 2) / (1 + b3[i, 2]),
-                    -(b3[i, 0] * b3[i, 1]) / (1 + b3[i, 2]),
-                    b3[i, 0],
-                ],
-                [
-                    -(b3[i, 0] * b3[i, 1]) / (1 + b3[i, 2]),
-                    1 - (b3[i, 1] ** 2) / (1 + b3[i, 2]),
-                    b3[i, 1],
-                ],
-                [-b3[i, 0], -b3[i, 1], b3[i, 2]],
-            ]
-        )
-    Hyaw = np.transpose(H, axes=(0, 2, 1)) @ R_matrices
-    actual_yaw = np.arctan2(Hyaw[:, 1, 0], Hyaw[:, 0, 0])
-    return actual_yaw
-
-
 def sample_waypoints(
     num_waypoints,
     world,
@@ -87,6 +51,7 @@ def sample_waypoints(
     max_attempts=1000,
     start_waypoint=None,
     end_waypoint=None,
+    rng=None,
 ):
     """
     Samples random waypoints (x,y,z) in the world. Ensures waypoints do not collide with objects, although there is no guarantee that
@@ -102,6 +67,7 @@ def sample_waypoints(
         max_attempts: Maximum number of attempts to sample a waypoint.
         start_waypoint: If specified, the first waypoint will be this point.
         end_waypoint: If specified, the last waypoint will be this point.
+        rng: Random number generator (numpy Generator). If None, uses numpy's global random number generator.
     Outputs:
         waypoints: A list of (x,y,z) waypoints. [[waypoint_1], [waypoint_2], ... , [waypoint_n]]
     """
@@ -168,6 +134,7 @@ def sample_waypoints(
         """
 
         num_attempts = 0
+        rng = np.random if rng is None else rng
 
         world_lower_limits = (
             np.array(world.world["bounds"]["extents"][0::2]) + world_buffer
@@ -190,13 +157,13 @@ def sample_waypoints(
             np.vstack((world_upper_limits, max_distance_upper_limits)), axis=0
         )
 
-        waypoint = np.random.uniform(low=lower_limits, high=upper_limits, size=(3,))
+        waypoint = rng.uniform(low=lower_limits, high=upper_limits, size=(3,))
         while check_obstacles(waypoint, occupancy_map) or (
             check_distance(waypoint, current_waypoints, min_distance, max_distance)
             if occupancy_map is not None
             else False
         ):
-            waypoint = np.random.uniform(low=lower_limits, high=upper_limits, size=(3,))
+            waypoint = rng.uniform(low=lower_limits, high=upper_limits, size=(3,))
             num_attempts += 1
             if num_attempts > max_attempts:
                 raise Exception(
@@ -215,10 +182,8 @@ def sample_waypoints(
     waypoints = []
 
     if check_collision:
-        # Create occupancy map from the world. This can potentially be slow, so only do it if the user wants to check for collisions.
-        occupancy_map = OccupancyMap(
-            world=world, resolution=[0.5, 0.5, 0.5], margin=0.1
-        )
+        # The occupancy map can potentially be slow to build, so only get it if the user wants to check for collisions.
+        occupancy_map = get_occupancy_map(world)
     else:
         occupancy_map = None
 
@@ -235,6 +200,7 @@ def sample_waypoints(
                 min_distance,
                 max_distance,
                 max_attempts,
+                rng,
             )
         )
 
@@ -253,6 +219,7 @@ def sample_waypoints(
                 min_distance,
                 max_distance,
                 max_attempts,
+                rng,
             )
         )
 
@@ -262,44 +229,123 @@ def sample_waypoints(
     return np.array(waypoints)
 
 
-def compute_cost(sim_result, robust_c=1.0):
+# Occupancy maps already built, per World and map settings
+_occupancy_maps = weakref.WeakKeyDictionary()
+
+
+def get_occupancy_map(world, resolution=(0.5, 0.5, 0.5), margin=0.1):
     """
-    Computes the cost from the output of a simulator instance.
+    Occupancy map of the world, built on the first call for a World instance and reused afterwards.
     Inputs:
-        sim_result: The output of a simulator instance.
+        world: Instance of World class containing the map extents and any obstacles.
+        resolution: Voxel size in x, y, z.
+        margin: Inflation radius around obstacles.
     Outputs:
-        cost: The cost of the trajectory.
+        occupancy_map: An instance of OccupancyMap.
     """
+    maps = _occupancy_maps.setdefault(world, {})
+    key = (tuple(resolution), margin)
+    if key not in maps:
+        maps[key] = OccupancyMap(world=world, resolution=list(resolution), margin=margin)
+    return maps[key]
 
-    # Some useful values from the trajectory.
-    actual_pos = sim_result["state"]["x"]  # Position
-    actual_vel = sim_result["state"]["v"]  # Velocity
-    actual_q = sim_result["state"]["q"]  # Attitude
-    actual_yaw = compute_yaw_from_quaternion(actual_q)  # Yaw angle
 
-    des_pos = sim_result["flat"]["x"]  # Desired position
-    des_vel = sim_result["flat"]["x_dot"]  # Desired velocity
-    q_des = sim_result["control"]["cmd_q"]  # Desired attitude
-    desired_yaw = compute_yaw_from_quaternion(q_des)
+def sample_waypoints_batch(
+    num_waypoints,
+    world,
+    seeds,
+    world_buffer=2,
+    check_collision=True,
+    min_distance=1,
+    max_distance=3,
+    max_attempts=1000,
+    start_waypoint=None,
+    end_waypoint=None,
+    proposals=32,
+):
+    """
+    Vectorized version of sample_waypoints for many seeds at once. Waypoints are sampled with the same rules:
+    uniformly in the world minus world_buffer and within max_distance of the previous waypoint along each axis,
+    rejected if they hit an obstacle or, when checking collisions, are not within [min_distance, max_distance]
+    of every previous waypoint. Each seed gets its own generator, np.random.default_rng(seed), so the waypoints
+    of a seed do not depend on the other seeds in the call. They differ from the ones sample_waypoints draws
+    from the global numpy seed.
+    Inputs:
+        seeds: (N,) array of seeds, or list of N numpy Generators (e.g. from seed_streams.trajectory_generator).
+        proposals: Number of candidate points drawn per seed and waypoint at once. Seeds without a valid one draw
+            another set, up to max_attempts candidates in total.
+        Other inputs are the same as sample_waypoints.
+    Outputs:
+        waypoints: (N, num_waypoints, 3) array of waypoints.
+    """
+
+    if min_distance > max_distance:
+        raise Exception("min_distance must be less than or equal to max_distance.")
 
-    cmd_thrust = sim_result["control"]["cmd_thrust"]  # Desired thrust
-    cmd_moment = sim_result["control"]["cmd_moment"]  # Desired body moment
+    rngs = [seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed) for seed in seeds]
+    num_seeds = len(rngs)
+    occupancy_map = get_occupancy_map(world) if check_collision else None
 
-    # Cost components by cumulative sum of squared norms
-    position_error = np.linalg.norm(actual_pos - des_pos, axis=1) ** 2
-    velocity_error = np.linalg.norm(actual_vel - des_vel, axis=1) ** 2
-    yaw_error = (actual_yaw - desired_yaw) ** 2
-    # print(f"yaw_error: {yaw_error}")
-    tracking_cost = position_error + velocity_error + yaw_error
+    world_lower_limits = np.array(world.world["bounds"]["extents"][0::2]) + world_buffer
+    world_upper_limits = np.array(world.world["bounds"]["extents"][1::2]) - world_buffer
 
-    # control effort
-    thrust_error = cmd_thrust**2
-    moment_error = np.linalg.norm(cmd_moment, axis=1) ** 2
-    control_cost = thrust_error + moment_error
+    def is_valid(points, previous):
+        """
+        points: (n, K, 3) candidates, previous: (n, i, 3) accepted waypoints. Returns (n, K) validity.
+        """
+        valid = np.ones(points.shape[:2], dtype=bool)
+        if occupancy_map is None:
+            return valid
+        # Points outside the map count as occupied, like OccupancyMap.is_occupied_metric
+        index = np.floor((points - occupancy_map.origin) / occupancy_map.resolution).astype(int)
+        inside = np.all((index >= 0) & (index < np.array(occupancy_map.map.shape)), axis=-1)
+        index = np.clip(index, 0, np.array(occupancy_map.map.shape) - 1)
+        occupied = occupancy_map.map[index[..., 0], index[..., 1], index[..., 2]]
+        valid &= inside & ~occupied
+        if previous.shape[1] > 0:
+            distances = np.linalg.norm(points[:, :, None, :] - previous[:, None, :, :], axis=-1)
+            valid &= np.all((distances >= min_distance) & (distances <= max_distance), axis=-1)
+        return valid
+
+    waypoints = np.zeros((num_seeds, 0, 3))
+    if start_waypoint is not None:
+        waypoints = np.tile(np.asarray(start_waypoint, dtype=float), (num_seeds, 1, 1))
 
-    sim_cost = np.sum(tracking_cost + robust_c * control_cost)
+    num_sampled = num_waypoints - waypoints.shape[1] - (end_waypoint is not None)
+    for _ in range(num_sampled):
+        if waypoints.shape[1] == 0:
+            lower_limits = np.tile(world_lower_limits, (num_seeds, 1))
+            upper_limits = np.tile(world_upper_limits, (num_seeds, 1))
+        else:
+            lower_limits = np.maximum(world_lower_limits, waypoints[:, -1] - max_distance)
+            upper_limits = np.minimum(world_upper_limits, waypoints[:, -1] + max_distance)
 
-    return sim_cost
+        new_waypoints = np.zeros((num_seeds, 3))
+        pending = np.arange(num_seeds)
+        num_attempts = 0
+        while len(pending) > 0:
+            if num_attempts > max_attempts:
+                raise Exception(
+                    "Could not sample a waypoint after {} attempts for {} of {} seeds.".format(
+                        max_attempts, len(pending), num_seeds
+                    )
+                )
+            unit = np.stack([rngs[i].random((proposals, 3)) for i in pending])
+            low, high = lower_limits[pending, None, :], upper_limits[pending, None, :]
+            points = low + unit * (high - low)
+            valid = is_valid(points, waypoints[pending])
+            found = np.any(valid, axis=1)
+            first = np.argmax(valid, axis=1)
+            new_waypoints[pending[found]] = points[found, first[found]]
+            pending = pending[~found]
+            num_attempts += proposals
+        waypoints = np.concatenate((waypoints, new_waypoints[:, None, :]), axis=1)
+
+    if end_waypoint is not None:
+        end = np.tile(np.asarray(end_waypoint, dtype=float), (num_seeds, 1, 1))
+        waypoints = np.concatenate((waypoints, end), axis=1)
+
+    return waypoints
 
 
 def write_to_csv(output_file, row):
@@ -309,6 +355,222 @@ def write_to_csv(output_file, row):
     return None
 
 
+def write_rows(output_file, rows):
+    """
+    Appends rows to the output.
+    Inputs:
+        output_file: Either a TrajStoreWriter, which buffers the rows and writes them out in shards,
+            or the path of a .csv file, which is opened once per call.
+        rows: A single row or a 2D array of rows.
+    Outputs:
+        None.
+    """
+    if isinstance(output_file, TrajStoreWriter):
+        output_file.append(rows)
+    elif np.ndim(rows) == 2:
+        with open(output_file, "a", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerows(rows)
+    else:
+        write_to_csv(output_file, rows)
+    return None
+
+
+def summary_columns(num_waypoints, robust_c, censoring=False):
+    """
+    Column names of the data file. This depends on the number of waypoints and the order of the polynomial.
+    Currently pos is 7th order and yaw is 7th order.
+    With censoring, the costs are followed by the censored flag and the simulated time saved (see divergence.py).
+    """
+    return (
+        ["traj_number"]
+        + ["cost_{}".format(i) for i in robust_c]
+        + (["censored", "time_saved"] if censoring else [])
+        + coeff_layout(num_waypoints)["columns"]
+    )
+
+
+def coeff_layout(num_waypoints, num_coeffs=8):
+    """
+    Layout of the polynomial coefficient columns: for each axis, every segment's coefficients in order.
+    """
+    axes = ["x", "y", "z", "yaw"]
+    return {
+        "axes": axes,
+        "num_segments": num_waypoints - 1,
+        "num_coeffs": num_coeffs,
+        "columns": [
+            "{}_poly_seg_{}_coeff_{}".format(axis, i, j)
+            for axis in axes
+            for i in range(num_waypoints - 1)
+            for j in range(num_coeffs)
+        ],
+    }
+
+
+def hover_initial_state(waypoints):
+    """
+    Initial state at the first waypoint at hover.
+    Inputs:
+        waypoints: (m, 3) array of waypoints.
+    Outputs:
+        x0: RotorPy initial state dict.
+    """
+    x0 = {
+        "x": waypoints[0],
+        "v": np.zeros(
+            3,
+        ),
+        "q": np.array([0, 0, 0, 1]),  # [i,j,k,w]
+        "w": np.zeros(
+            3,
+        ),
+        "wind": np.array(
+            [0, 0, 0]
+        ),  # Since wind is handled elsewhere, this value is overwritten
+        "rotor_speeds": np.array([1788.53, 1788.53, 1788.53, 1788.53]),
+    }
+    return x0
+
+
+def sample_minsnap_trajectory(
+    world,
+    num_waypoints,
+    start_waypoint=None,
+    end_waypoint=None,
+    world_buffer=2,
+    min_distance=1,
+    max_distance=3,
+    vavg=2,
+    random_yaw=True,
+    yaw_min=-0.85 * np.pi,
+    yaw_max=0.85 * np.pi,
+    seed=None,
+    root_seed=None,
+):
+    """
+    Sample the waypoints and yaw angles for one seed and build its minsnap trajectory.
+    Inputs:
+        Same as single_minsnap_instance.
+    Outputs:
+        waypoints: (num_waypoints, 3) array of sampled waypoints.
+        traj: MinSnap trajectory through the waypoints.
+    """
+
+    if root_seed is not None:
+        # Own stream of trajectory `seed`, independent of the global numpy state
+        rng = trajectory_generator(root_seed, seed)
+    else:
+        rng = None
+        if seed is not None:
+            np.random.seed(seed)
+        else:
+            np.random.seed()
+
+    with _stage_timer.stage("sampling"):
+        # First sample the waypoints.
+        waypoints = sample_waypoints(
+            num_waypoints=num_waypoints,
+            world=world,
+            world_buffer=world_buffer,
+            min_distance=min_distance,
+            max_distance=max_distance,
+            start_waypoint=start_waypoint,
+            end_waypoint=end_waypoint,
+            rng=rng,
+        )
+
+        # Sample the yaw angles
+        if random_yaw:
+            yaw_angles = (np.random if rng is None else rng).uniform(low=yaw_min, high=yaw_max, size=len(waypoints))
+        else:
+            yaw_angles = np.zeros(len(waypoints))
+
+    # Generate the minsnap trajectory
+    with _stage_timer.stage("minsnap"):
+        traj = CachedMinSnap(points=waypoints, yaw_angles=yaw_angles, v_avg=vavg)
+
+    return waypoints, traj
+
+
+def simulate_minsnap(vehicle, controller, waypoints, traj, terminate=False):
+    """
+    Simulate one minsnap trajectory with RotorPy, starting from hover at the first waypoint.
+    Inputs:
+        vehicle: Instance of a vehicle class.
+        controller: Instance of a controller class.
+        waypoints: (num_waypoints, 3) array of waypoints of the trajectory.
+        traj: MinSnap trajectory through the waypoints.
+        terminate: terminate argument of Environment.run. By default the trajectory is always flown to its end.
+    Outputs:
+        sim_instance: the Environment that was run.
+        sim_result: the output of Environment.run.
+    """
+
+    # Now create an instance of the simulator and run it.
+    sim_instance = Environment(
+        vehicle=vehicle,
+        controller=controller,
+        trajectory=traj,
+        wind_profile=None,
+        sim_rate=100,
+    )
+
+    sim_instance.vehicle.initial_state = hover_initial_state(waypoints)
+
+    # Now run the simulator for the length of the trajectory.
+    sim_result = sim_instance.run(
+        t_final=traj.t_keyframes[-1],
+        use_mocap=False,
+        terminate=terminate,
+        plot=False,
+        plot_mocap=False,
+        plot_estimator=False,
+        plot_imu=False,
+        animate_bool=False,
+        animate_wind=False,
+        verbose=False,
+    )
+
+    return sim_instance, sim_result
+
+
+def summary_row(seed, trajectory_cost, traj, censoring=None):
+    """
+    Row of the data file: the seed, the costs for each robust_c, then the polynomial coefficients for the position and yaw.
+    If given, censoring is the (censored, time_saved) pair written after the costs.
+    """
+    return np.concatenate(
+        (
+            np.array([int(seed)]),
+            trajectory_cost,
+            np.asarray(censoring if censoring is not None else [], dtype=float),
+            traj.c_opt_xyz.ravel(),
+            traj.c_opt_yaw.ravel(),
+        )
+    )
+
+
+def censor_rollout(trajectory_cost, exit_status, t_stop, t_final, divergence_monitor):
+    """
+    Censoring of a rollout that did not reach the end of its trajectory, because the divergence monitor or one of
+    RotorPy's safety checks stopped it.
+    Inputs:
+        trajectory_cost: (len(robust_c),) costs over the simulated part.
+        exit_status: ExitStatus of the rollout.
+        t_stop: time of the last sample.
+        t_final: end time of the trajectory.
+        divergence_monitor: the DivergenceMonitor of the run, for its cost cap.
+    Outputs:
+        trajectory_cost: the costs, or the capped, always finite cost labels if censored (see divergence.censored_costs).
+        censoring: (censored, time_saved) columns of the summary row.
+    """
+    if exit_status == ExitStatus.TIMEOUT:
+        return trajectory_cost, (0.0, 0.0)
+    trajectory_cost = censored_costs(trajectory_cost, t_stop, t_final, divergence_monitor.cost_cap)
+    return trajectory_cost, (1.0, max(t_final - t_stop, 0.0))
+
+
 def single_minsnap_instance(
     world,
     vehicle,
@@ -326,6 +588,8 @@ def single_minsnap_instance(
     seed=None,
     save_trial=False,
     robust_c=[0, 1, 0.1, 0.5],
+    root_seed=None,
+    divergence_monitor=None,
 ):
     """
     Generate a single instance of the simulator with a minsnap trajectory.
@@ -345,105 +609,278 @@ def single_minsnap_instance(
         yaw_min: The minimum yaw angle to sample.
         yaw_max: The maximum yaw angle to sample.
         seed: The seed for the random number generator. If None, uses numpy's random number generator.
-        save_trial: If True, saves the trial data to a .csv file.
+            With root_seed, the index of the trajectory's stream instead.
+        save_trial: If True, also returns the time series of the trial for the trial archive (see trial_archive.py).
+        root_seed: If given, the trajectory is sampled from its own stream trajectory_generator(root_seed, seed)
+            (see seed_streams.py) instead of reseeding numpy's global random number generator.
+        divergence_monitor: If given, a DivergenceMonitor that stops the rollout once it diverges. The row then also
+            holds the censored and time_saved columns (see summary_columns).
     Outputs:
         output: the cost of the trajectory followed by the polynomial coefficients for the position and yaw.
+        trial: only if save_trial, the (seed, data, columns) arguments of TrialArchiveWriter.append.
     """
 
-    if seed is not None:
-        np.random.seed(seed)
-    else:
-        np.random.seed()
-
-    # First sample the waypoints.
-    waypoints = sample_waypoints(
-        num_waypoints=num_waypoints,
-        world=world,
-        world_buffer=world_buffer,
-        min_distance=min_distance,
-        max_distance=max_distance,
-        start_waypoint=start_waypoint,
-        end_waypoint=end_waypoint,
+    waypoints, traj = sample_minsnap_trajectory(
+        world,
+        num_waypoints,
+        start_waypoint,
+        end_waypoint,
+        world_buffer,
+        min_distance,
+        max_distance,
+        vavg,
+        random_yaw,
+        yaw_min,
+        yaw_max,
+        seed,
+        root_seed,
     )
 
-    # Sample the yaw angles
-    if random_yaw:
-        yaw_angles = np.random.uniform(low=yaw_min, high=yaw_max, size=len(waypoints))
+    if divergence_monitor is not None:
+        terminate = divergence_monitor.terminate_fn(vehicle, traj, t_step=1 / 100)
     else:
-        yaw_angles = np.zeros(len(waypoints))
+        terminate = False
+    with _stage_timer.stage("rollout"):
+        sim_instance, sim_result = simulate_minsnap(vehicle, controller, waypoints, traj, terminate)
+    if sim_result["exit"] != ExitStatus.TIMEOUT:
+        _stage_timer.count_failure(sim_result["exit"].name)
+
+    # Compute the cost of the trajectory from result, for all robust_c at once
+    with _stage_timer.stage("cost"):
+        trajectory_cost = compute_costs(sim_result, robust_c)
+        censoring = None
+        if divergence_monitor is not None:
+            trajectory_cost, censoring = censor_rollout(
+                trajectory_cost, sim_result["exit"], sim_result["time"][-1], traj.t_keyframes[-1], divergence_monitor
+            )
+    print("trajectory_cost: ", trajectory_cost)
 
-    # Generate the minsnap trajectory
-    traj = MinSnap(points=waypoints, yaw_angles=yaw_angles, v_avg=vavg)
+    if save_trial:
+        # Same table as sim_instance.save_to_csv, but kept in memory for the archive writer
+        columns, data = pack_trial(sim_result)
+        return summary_row(seed, trajectory_cost, traj, censoring), (seed, data, columns)
 
-    # Now create an instance of the simulator and run it.
-    sim_instance = Environment(
-        vehicle=vehicle,
-        controller=controller,
-        trajectory=traj,
-        wind_profile=None,
-        sim_rate=100,
-    )
+    return summary_row(seed, trajectory_cost, traj, censoring)
 
-    # Set the initial state to the first waypoint at hover.
-    x0 = {
-        "x": waypoints[0],
-        "v": np.zeros(
-            3,
-        ),
-        "q": np.array([0, 0, 0, 1]),  # [i,j,k,w]
-        "w": np.zeros(
-            3,
-        ),
-        "wind": np.array(
-            [0, 0, 0]
-        ),  # Since wind is handled elsewhere, this value is overwritten
-        "rotor_speeds": np.array([1788.53, 1788.53, 1788.53, 1788.53]),
-    }
 
-    sim_instance.vehicle.initial_state = x0
+def batch_minsnap_instance(
+    world,
+    vehicle,
+    controller,
+    num_waypoints,
+    start_waypoint=None,
+    end_waypoint=None,
+    world_buffer=2,
+    min_distance=1,
+    max_distance=3,
+    vavg=2,
+    random_yaw=True,
+    yaw_min=-0.85 * np.pi,
+    yaw_max=0.85 * np.pi,
+    seeds=None,
+    robust_c=[0, 1, 0.1, 0.5],
+    batched_sampling=False,
+    rollout_engine="numpy",
+    root_seed=None,
+    divergence_monitor=None,
+):
+    """
+    Same as single_minsnap_instance, but simulates the trajectories of all seeds
+    together with the lock-step batch rollout engine.
+    Inputs:
+        seeds: list of seeds, one trajectory per seed.
+        batched_sampling: If True, the waypoints of all seeds are sampled in one call to sample_waypoints_batch.
+            This draws different waypoints for a seed than sample_waypoints.
+        rollout_engine: "numpy" simulates with batch_rollout, "jax" with the compiled jax_rollout, in float64 (this
+            enables JAX's x64 mode for the process).
+        divergence_monitor: See single_minsnap_instance. Only supported by the "numpy" engine.
+        Other inputs are the same as single_minsnap_instance.
+    Outputs:
+        output: (len(seeds), num_columns) array, one summary row per seed in the layout of single_minsnap_instance.
+    """
 
-    # Now run the simulator for the length of the trajectory.
-    sim_result = sim_instance.run(
-        t_final=traj.t_keyframes[-1],
-        use_mocap=False,
-        terminate=False,
-        plot=False,
-        plot_mocap=False,
-        plot_estimator=False,
-        plot_imu=False,
-        animate_bool=False,
-        animate_wind=False,
-        verbose=False,
+    if divergence_monitor is not None and rollout_engine != "numpy":
+        raise ValueError("divergence_monitor is only supported by the numpy rollout engine.")
+
+    trajectories = []
+    initial_states = []
+    if batched_sampling:
+        with _stage_timer.stage("sampling"):
+            all_waypoints = sample_waypoints_batch(
+                num_waypoints=num_waypoints,
+                world=world,
+                seeds=seeds if root_seed is None else [trajectory_generator(root_seed, seed) for seed in seeds],
+                world_buffer=world_buffer,
+                min_distance=min_distance,
+                max_distance=max_distance,
+                start_waypoint=start_waypoint,
+                end_waypoint=end_waypoint,
+            )
+        for seed, waypoints in zip(seeds, all_waypoints):
+            # The yaw angles get their own stream, so they do not depend on how many proposals the waypoints took
+            with _stage_timer.stage("sampling"):
+                if random_yaw:
+                    if root_seed is None:
+                        yaw_rng = np.random.default_rng([1, seed])
+                    else:
+                        yaw_rng = np.random.default_rng(trajectory_seed_sequence(root_seed, seed).spawn(1)[0])
+                    yaw_angles = yaw_rng.uniform(low=yaw_min, high=yaw_max, size=len(waypoints))
+                else:
+                    yaw_angles = np.zeros(len(waypoints))
+            with _stage_timer.stage("minsnap"):
+                trajectories.append(CachedMinSnap(points=waypoints, yaw_angles=yaw_angles, v_avg=vavg))
+            initial_states.append(hover_initial_state(waypoints))
+        seeds_to_sample = []
+    else:
+        seeds_to_sample = seeds
+    for seed in seeds_to_sample:
+        waypoints, traj = sample_minsnap_trajectory(
+            world,
+            num_waypoints,
+            start_waypoint,
+            end_waypoint,
+            world_buffer,
+            min_distance,
+            max_distance,
+            vavg,
+            random_yaw,
+            yaw_min,
+            yaw_max,
+            seed,
+            root_seed,
+        )
+        trajectories.append(traj)
+        initial_states.append(hover_initial_state(waypoints))
+
+    if rollout_engine == "numpy":
+        rollout_fn = batch_rollout
+    elif rollout_engine == "jax":
+        # Imported here so that workers using the NumPy engine never initialize JAX
+        import jax
+
+        # Cost labels in float32 deviate from the NumPy engine by up to ~0.2%, in float64 they match it
+        jax.config.update("jax_enable_x64", True)
+        from jax_rollout import jax_rollout as rollout_fn
+    else:
+        raise ValueError("Invalid rollout_engine. Use 'numpy' or 'jax'.")
+    monitor_kwargs = {} if divergence_monitor is None else {"divergence_monitor": divergence_monitor}
+    with _stage_timer.stage("rollout"):
+        sim_result = rollout_fn(
+            vehicle, controller, trajectories, initial_states, sim_rate=100, **monitor_kwargs
+        )
+    for exit_status in sim_result["exit"]:
+        if exit_status != ExitStatus.TIMEOUT:
+            _stage_timer.count_failure(exit_status.name)
+
+    with _stage_timer.stage("cost"):
+        # (N, len(robust_c)) costs over the valid samples of each rollout
+        costs = compute_costs(sim_result, robust_c)
+
+        if divergence_monitor is None:
+            censoring = [None] * len(seeds)
+        else:
+            t_stop = sim_result["time"][np.arange(len(seeds)), sim_result["num_samples"] - 1]
+            costs, censoring = zip(
+                *[
+                    censor_rollout(trajectory_cost, exit_status, t, traj.t_keyframes[-1], divergence_monitor)
+                    for trajectory_cost, exit_status, t, traj in zip(costs, sim_result["exit"], t_stop, trajectories)
+                ]
+            )
+
+    return np.array(
+        [
+            summary_row(seed, trajectory_cost, traj, censored)
+            for seed, traj, trajectory_cost, censored in zip(seeds, trajectories, costs, censoring)
+        ]
     )
 
-    if save_trial:
-        savepath = os.path.join(save_path, "trial_data_drag1")
-        # savepath = os.path.join(save_path, "trial_data_200000")
-        # savepath = os.path.join(os.path.dirname(__file__), 'trial_data')
-        if not os.path.exists(savepath):
-            os.makedirs(savepath)
-        file_path = os.path.join(savepath, "trial_drag1_{}.csv".format(seed))
-        print("Saving to:", file_path)
-        sim_instance.save_to_csv(os.path.join(savepath, "trial_drag1_{}.csv".format(seed)))
 
-    # Compute the cost of the trajectory from result
-    trajectory_cost = [compute_cost(sim_result, robust_c=rho) for rho in robust_c]
-    print("trajectory_cost: ", trajectory_cost)
+# Per-process state of the worker pool, set once by _init_worker.
+_worker_context = {}
+# Per-process stage timing and failure counts, reported with every task (see telemetry.py).
+_stage_timer = StageTimer()
 
-    # Now extract the polynomial coefficients for the trajectory.
-    pos_poly = traj.c_opt_xyz
-    yaw_poly = traj.c_opt_yaw
 
-    # summary
-    summary_output = np.concatenate(
-        (np.array([int(seed)]), trajectory_cost, pos_poly.ravel(), yaw_poly.ravel())
+def _init_worker(
+    world,
+    vehicle,
+    controller,
+    sampling_args,
+    rollout_batch_size,
+    save_trial,
+    batched_sampling=False,
+    rollout_engine="numpy",
+    divergence_monitor=None,
+):
+    """
+    Pool initializer: keeps the objects shared by all tasks in the worker process.
+    """
+    _worker_context.update(
+        world=world,
+        vehicle=vehicle,
+        controller=controller,
+        sampling_args=sampling_args,
+        rollout_batch_size=rollout_batch_size,
+        save_trial=save_trial,
+        batched_sampling=batched_sampling,
+        rollout_engine=rollout_engine,
+        divergence_monitor=divergence_monitor,
     )
 
-    return summary_output
+
+def _run_seed_chunk(seeds):
+    """
+    Pool task: simulates the trajectories of a chunk of seeds.
+    Inputs:
+        seeds: array of seeds.
+    Outputs:
+        rows: (len(seeds), num_columns) array of summary rows.
+        trials: list of trials for the trial archive, empty unless save_trial.
+        task_stats: dict with the worker's pid, the task_time in seconds and the StageTimer snapshot of the task.
+    """
+    start_time = time.perf_counter()
+    ctx = _worker_context
+    args = ctx["sampling_args"]
+    trials = []
+    if ctx["rollout_batch_size"] > 1:
+        rows = np.concatenate(
+            [
+                batch_minsnap_instance(
+                    ctx["world"],
+                    ctx["vehicle"],
+                    ctx["controller"],
+                    seeds=seeds[i : i + ctx["rollout_batch_size"]],
+                    batched_sampling=ctx["batched_sampling"],
+                    rollout_engine=ctx["rollout_engine"],
+                    divergence_monitor=ctx["divergence_monitor"],
+                    **args
+                )
+                for i in range(0, len(seeds), ctx["rollout_batch_size"])
+            ],
+            axis=0,
+        )
+    else:
+        results = [
+            single_minsnap_instance(
+                ctx["world"],
+                ctx["vehicle"],
+                ctx["controller"],
+                seed=seed,
+                save_trial=ctx["save_trial"],
+                divergence_monitor=ctx["divergence_monitor"],
+                **args
+            )
+            for seed in seeds
+        ]
+        if ctx["save_trial"]:
+            results, trials = zip(*results)
+        rows = np.array(results)
+    task_stats = dict(worker=os.getpid(), task_time=time.perf_counter() - start_time, **_stage_timer.snapshot())
+    return rows, list(trials), task_stats
 
 
 def generate_data(
-    output_csv_file,
+    output_file,
     world,
     vehicle,
     controller,
@@ -461,11 +898,25 @@ def generate_data(
     parallel=True,
     save_individual_trials=False,
     robust_c=[0, 1, 0.1, 0.5],
+    rollout_batch_size=1,
+    writer_queue_size=256,
+    writer_flush_rows=1000,
+    writer_flush_interval=5.0,
+    chunk_size=None,
+    seeds=None,
+    batched_sampling=False,
+    rollout_engine="numpy",
+    trial_archive=None,
+    root_seed=None,
+    num_workers=None,
+    divergence_monitor=None,
+    metrics_file=None,
+    metrics_interval=10.0,
 ):
     """
     Generates data for training.
     Inputs:
-        output_file: The name of the output file.
+        output_file: A TrajStoreWriter, or the name of a .csv output file.
         world: Instance of World class containing the map extents and any obstacles.
         vehicle: Instance of a vehicle class.
         controller: Instance of a controller class.
@@ -481,14 +932,148 @@ def generate_data(
         max_distance: Maximum distance between consecutive waypoints.
         start_waypoint: If specified, the first waypoint will be this point.
         end_waypoint: If specified, the last waypoint will be this point.
+        rollout_batch_size: Number of trajectories simulated together by one call to batch_minsnap_instance.
+            If 1, each trajectory is simulated with its own RotorPy Environment.
+        writer_queue_size: In parallel mode, number of results waiting for the writer thread after which no more
+            tasks are handed to the workers.
+        writer_flush_rows: In parallel mode, number of rows the writer thread buffers before writing them out.
+        writer_flush_interval: In parallel mode, seconds after which buffered rows are written out regardless.
+        chunk_size: In parallel mode, number of seeds per task. If None, chosen from the number of seeds and cores.
+        seeds: Seeds to simulate. If None, num_simulations seeds are drawn from range(num_simulations), or, with
+            root_seed, the trajectory indices 0, ..., num_simulations - 1.
+        batched_sampling: If True, the waypoints of each batch are sampled together with sample_waypoints_batch.
+            Requires rollout_batch_size > 1. Seeds map to different waypoints than with sample_waypoints.
+        rollout_engine: Engine of the batched rollouts, "numpy" (batch_rollout) or "jax" (jax_rollout, compiled once
+            per worker). Requires rollout_batch_size > 1 if not "numpy".
+        trial_archive: With save_individual_trials, a TrialArchiveWriter or the directory of the trial archive the
+            time series of every trial are written to. Defaults to trial_data_drag1 under save_path.
+        root_seed: If given, seeds are trajectory indices and each trajectory is sampled from its own stream,
+            the seed sequence SeedSequence(root_seed).spawn(index + 1)[index] (see seed_streams.py). Any index can
+            then be reproduced on its own, so a run can be split into shards or extended with new indices.
+        num_workers: In parallel mode, number of worker processes. Defaults to min(cpu_count(), 40).
+        divergence_monitor: If given, a DivergenceMonitor (see divergence.py) that stops diverging rollouts early.
+            The rows then hold the censored and time_saved columns, so the output must have been created with
+            summary_columns(..., censoring=True). Not supported by the "jax" engine.
+        metrics_file: If given, the JSON-lines file the telemetry (throughput, ETA, per-worker rates, stage timing
+            and failure counts, see telemetry.py) is appended to. It is printed to the console either way.
+        metrics_interval: Seconds between two telemetry reports.
     Outputs:
-        None. It writes to the output file.
+        None. It writes to the output file. When writing to a store, the seed list is recorded in the store's job
+        manifest, and calling generate_data again on the same store only runs the seeds not yet committed.
     """
 
-    if not parallel:
-        for _ in tqdm(
-            range(num_simulations), desc="Running simulations (sequentially)..."
+    if rollout_batch_size > 1 and save_individual_trials:
+        raise ValueError("save_individual_trials is not supported with rollout_batch_size > 1.")
+    if batched_sampling and rollout_batch_size <= 1:
+        raise ValueError("batched_sampling requires rollout_batch_size > 1.")
+    if rollout_engine != "numpy" and rollout_batch_size <= 1:
+        raise ValueError("rollout_engine {} requires rollout_batch_size > 1.".format(rollout_engine))
+
+    if save_individual_trials and not isinstance(trial_archive, TrialArchiveWriter):
+        trial_archive = TrialArchiveWriter(
+            trial_archive if trial_archive is not None else os.path.join(save_path, "trial_data_drag1")
+        )
+
+    if seeds is None and root_seed is not None:
+        seeds = shard_indices(num_simulations)
+    elif seeds is None:
+        # Use numpy random to generate seeds for each simulation.
+        seeds = np.random.choice(
+            np.arange(num_simulations), size=num_simulations, replace=False
+        )
+    else:
+        seeds = np.asarray(seeds, dtype=int)
+        num_simulations = len(seeds)
+
+    if isinstance(output_file, TrajStoreWriter):
+        # The manifest keeps the seed list of the job, so that a restarted job only runs the missing seeds.
+        manifest = JobManifest(
+            output_file,
+            seeds,
+            config=dict(
+                num_simulations=num_simulations,
+                num_waypoints=num_waypoints,
+                vavg=vavg,
+                random_yaw=random_yaw,
+                yaw_min=yaw_min,
+                yaw_max=yaw_max,
+                world_buffer=world_buffer,
+                min_distance=min_distance,
+                max_distance=max_distance,
+                start_waypoint=start_waypoint,
+                end_waypoint=end_waypoint,
+                robust_c=robust_c,
+                batched_sampling=batched_sampling,
+                rollout_engine=rollout_engine,
+                root_seed=root_seed,
+                divergence_monitor=divergence_monitor.config() if divergence_monitor is not None else None,
+            ),
+        )
+        if save_individual_trials:
+            # Seeds in a committed shard count as done on resume, so their trials must be on disk by then. Every
+            # trial is appended to the archive before its row reaches the store.
+            output_file.before_commit = trial_archive.flush
+        seeds = manifest.pending_seeds()
+        if len(seeds) < num_simulations:
+            print(
+                "Resuming job: {} of {} simulations already completed.".format(
+                    num_simulations - len(seeds), num_simulations
+                )
+            )
+
+    # Tally of the censored rows, read off the rows on their way to the output.
+    censored_column = 1 + len(robust_c)
+    censoring_stats = {"num_rows": 0, "num_censored": 0, "time_saved": 0.0}
+
+    telemetry = DatagenTelemetry(len(seeds), metrics_file=metrics_file, interval=metrics_interval, log=tqdm.write)
+
+    def write(rows):
+        if divergence_monitor is not None:
+            rows_2d = np.atleast_2d(rows)
+            censoring_stats["num_rows"] += rows_2d.shape[0]
+            censoring_stats["num_censored"] += int(np.sum(rows_2d[:, censored_column]))
+            censoring_stats["time_saved"] += float(np.sum(rows_2d[:, censored_column + 1]))
+        start_time = time.perf_counter()
+        write_rows(output_file, rows)
+        telemetry.add_stage_time("write", time.perf_counter() - start_time)
+
+    def record_sequential(num_sims, start_time):
+        telemetry.record(os.getpid(), num_sims, time.perf_counter() - start_time, _stage_timer.snapshot())
+        telemetry.maybe_report()
+
+    if not parallel and rollout_batch_size > 1:
+        for i in tqdm(
+            range(0, len(seeds), rollout_batch_size),
+            desc="Running simulations (sequentially, in batches)...",
         ):
+            start_time = time.perf_counter()
+            results = batch_minsnap_instance(
+                world,
+                vehicle,
+                controller,
+                num_waypoints,
+                start_waypoint,
+                end_waypoint,
+                world_buffer,
+                min_distance,
+                max_distance,
+                vavg,
+                random_yaw,
+                yaw_min,
+                yaw_max,
+                seeds=seeds[i : i + rollout_batch_size],
+                robust_c=robust_c,
+                batched_sampling=batched_sampling,
+                rollout_engine=rollout_engine,
+                root_seed=root_seed,
+                divergence_monitor=divergence_monitor,
+            )
+            write(results)
+            record_sequential(results.shape[0], start_time)
+
+    elif not parallel:
+        for seed in tqdm(seeds, desc="Running simulations (sequentially)..."):
+            start_time = time.perf_counter()
             result = single_minsnap_instance(
                 world,
                 vehicle,
@@ -503,96 +1088,191 @@ def generate_data(
                 random_yaw,
                 yaw_min,
                 yaw_max,
-                seed=None,
+                seed=seed,
                 save_trial=save_individual_trials,
                 robust_c=robust_c,
+                root_seed=root_seed,
+                divergence_monitor=divergence_monitor,
             )
 
-            write_to_csv(output_csv_file, result)
+            if save_individual_trials:
+                result, trial = result
+                trial_archive.append(*trial)
+            write(result)
+            record_sequential(1, start_time)
 
     else:
         # Use multiprocessing to run multiple simulations in parallel.
 
-        num_cores = min(multiprocessing.cpu_count(), 40)
+        num_cores = num_workers if num_workers is not None else min(multiprocessing.cpu_count(), 40)
 
         print(
             "Running {} simulations in parallel with up to {} cores.".format(
-                num_simulations, num_cores
+                len(seeds), num_cores
             )
         )
 
-        pool = multiprocessing.Pool(num_cores)
+        if chunk_size is None:
+            # A few chunks per worker keeps the load balanced while amortizing the per-task cost.
+            chunk_size = int(np.clip(np.ceil(len(seeds) / (4 * num_cores)), 1, 64))
+        chunk_size = max(chunk_size, rollout_batch_size)
 
-        # Use numpy random to generate seeds for each simulation.
-        seeds = np.random.choice(
-            np.arange(num_simulations), size=num_simulations, replace=False
+        # The world, vehicle and controller are sent to each worker once, tasks only carry their seeds.
+        pool = multiprocessing.Pool(
+            num_cores,
+            initializer=_init_worker,
+            initargs=(
+                world,
+                vehicle,
+                controller,
+                dict(
+                    num_waypoints=num_waypoints,
+                    start_waypoint=start_waypoint,
+                    end_waypoint=end_waypoint,
+                    world_buffer=world_buffer,
+                    min_distance=min_distance,
+                    max_distance=max_distance,
+                    vavg=vavg,
+                    random_yaw=random_yaw,
+                    yaw_min=yaw_min,
+                    yaw_max=yaw_max,
+                    robust_c=robust_c,
+                    root_seed=root_seed,
+                ),
+                rollout_batch_size,
+                save_individual_trials,
+                batched_sampling,
+                rollout_engine,
+                divergence_monitor,
+            ),
         )
 
-        manager = multiprocessing.Manager()
-
-        lock = manager.Lock()
+        # Results are handed to a single writer thread through a bounded queue, which batches them into few large
+        # writes. If the output falls behind, the queue fills up and blocks the loop below, which then stops
+        # submitting tasks, so the workers idle instead of results piling up.
+        def write_trials(trials):
+            for trial in trials:
+                trial_archive.append(*trial)
+
+        result_writer = ResultWriter(
+            write,
+            max_queue_size=writer_queue_size,
+            flush_rows=writer_flush_rows,
+            flush_interval=writer_flush_interval,
+            trial_fn=write_trials if save_individual_trials else None,
+        )
 
-        def update_results(result):
-            with lock:
-                write_to_csv(output_file=output_csv_file, row=result)
+        # The ETA is reported by the telemetry once the first tasks have finished and the rate of this machine is known.
+        current_time = datetime.datetime.now()
+        print(f"Start time: {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
 
-        code_rate = 1.33  # simulations per second, emperically determined.
-        expected_duration_seconds = num_simulations / code_rate
+        print("Running simulations (in parallel, {} seeds per task)...".format(chunk_size))
+        chunks = (seeds[i : i + chunk_size] for i in range(0, len(seeds), chunk_size))
+        num_tasks = int(np.ceil(len(seeds) / chunk_size))
+        compute_time = 0.0
+        start_time = time.perf_counter()
+        try:
+            with tqdm(total=len(seeds)) as progress:
+                # Two tasks per worker keep every worker busy while the next result is taken
+                for rows, trials, task_stats in bounded_imap_unordered(pool, _run_seed_chunk, chunks, 2 * num_cores):
+                    result_writer.put(rows, trials)
+                    compute_time += task_stats["task_time"]
+                    telemetry.record(task_stats["worker"], rows.shape[0], task_stats["task_time"], task_stats)
+                    telemetry.maybe_report()
+                    progress.update(rows.shape[0])
+        except BaseException as e:
+            # A failed task ends the run, but everything finished so far is committed first, so a resumed job only
+            # reruns the seeds that are really missing.
+            if isinstance(e, Exception):
+                telemetry.count_failure("TASK_ERROR")
+            pool.terminate()
+            pool.join()
+            result_writer.close()
+            telemetry.close()
+            if save_individual_trials:
+                trial_archive.flush()
+            if isinstance(output_file, TrajStoreWriter):
+                output_file.flush()
+            raise
+        wall_time = time.perf_counter() - start_time
 
-        current_time = datetime.datetime.now()
-        end_time = current_time + datetime.timedelta(seconds=expected_duration_seconds)
+        pool.close()
+        pool.join()
 
-        print(f"Start time: {current_time.strftime('%Y-%m-%d %H:%M:%S')}")
+        # Whatever the workers spent outside the simulations themselves: pickling, IPC, scheduling and idle time.
+        overhead = max(wall_time * num_cores - compute_time, 0.0)
         print(
-            "Expected duration: %3.2f seconds (%3.2f minutes, or %3.2f hours)"
-            % (
-                expected_duration_seconds,
-                expected_duration_seconds / 60,
-                expected_duration_seconds / 3600,
+            "Scheduler: {} tasks of up to {} seeds, {:.3f} s compute per task, ~{:.4f} s overhead per task "
+            "({:.1f}% of worker time).".format(
+                num_tasks,
+                chunk_size,
+                compute_time / max(num_tasks, 1),
+                overhead / max(num_tasks, 1),
+                100 * overhead / max(wall_time * num_cores, 1e-12),
             )
         )
+
+        writer_stats = result_writer.close()
         print(
-            f"Program *may* end around, depending on number of waypoints, distance between waypoints, etc.: {end_time.strftime('%Y-%m-%d %H:%M:%S')}"
+            "Result writer: {} rows in {} flushes, flush latency mean {:.4f} s / max {:.4f} s, "
+            "queue depth mean {:.1f} / max {}, blocked on full queue for {:.2f} s.".format(
+                writer_stats["rows_written"],
+                writer_stats["num_flushes"],
+                writer_stats["mean_flush_latency"],
+                writer_stats["max_flush_latency"],
+                writer_stats["mean_queue_depth"],
+                writer_stats["max_queue_depth"],
+                writer_stats["blocked_time"],
+            )
         )
 
-        print("Running simulations (in parallel)...")
-        for _ in range(num_simulations):
-            pool.apply_async(
-                single_minsnap_instance,
-                args=(
-                    world,
-                    vehicle,
-                    controller,
-                    num_waypoints,
-                    start_waypoint,
-                    end_waypoint,
-                    world_buffer,
-                    min_distance,
-                    max_distance,
-                    vavg,
-                    random_yaw,
-                    yaw_min,
-                    yaw_max,
-                    seeds[_],
-                    save_individual_trials,
-                    robust_c,
-                ),
-                callback=update_results,
+    telemetry.close()
+    if divergence_monitor is not None:
+        print(
+            "Divergence monitor: {} of {} rollouts censored, {:.1f} s of simulated time saved.".format(
+                censoring_stats["num_censored"], censoring_stats["num_rows"], censoring_stats["time_saved"]
             )
+        )
 
-        pool.close()
-        pool.join()
+    if save_individual_trials:
+        trial_archive.flush()
+    if isinstance(output_file, TrajStoreWriter):
+        output_file.flush()
 
     return None
 
 
-def main(num_simulations, parallel_bool, save_trials=False):
+def main(
+    num_simulations,
+    parallel_bool,
+    save_trials=False,
+    rollout_batch_size=1,
+    output_format="store",
+    shard_size=10000,
+    resume=True,
+    batched_sampling=False,
+    rollout_engine="numpy",
+    root_seed=None,
+    divergence_monitor=None,
+    metrics_file=None,
+):
     """
     Main function for generating data.
     Inputs:
         num_simulations: The number of simulations to run.
         parallel_bool: If True, runs the simulations in parallel. If False, runs the simulations sequentially.
-        save_trials: If True, saves each trial data to a separate .csv file. Uses more memory, but allows you to see the results of each trial at a later date.
+        save_trials: If True, saves the time series of each trial to a compressed archive indexed by seed (see trial_archive.py). Uses more disk space, but allows you to see the results of each trial at a later date.
+        rollout_batch_size: Number of trajectories each worker simulates together with the batch rollout engine.
+        output_format: "store" writes a sharded columnar store (see traj_store.py), "csv" writes a single .csv file.
+        shard_size: Number of rows per shard of the store.
+        resume: If True and the store already holds a job manifest, resumes that job instead of asking to delete it.
+        batched_sampling: If True, samples the waypoints of each rollout batch together (see sample_waypoints_batch).
+        rollout_engine: "numpy" or "jax", the engine of the batched rollouts (see generate_data).
+        root_seed: If given, trajectory i is sampled from its own seed stream of root_seed (see seed_streams.py).
+        divergence_monitor: If given, a DivergenceMonitor that stops diverging rollouts early and marks their rows as
+            censored (see divergence.py).
+        metrics_file: JSON-lines file the datagen telemetry is appended to. Defaults to datagen_metrics.jsonl under
+            save_path.
 
     """
 
@@ -616,22 +1296,36 @@ def main(num_simulations, parallel_bool, save_trials=False):
 
     # Create the output file
     # output_csv_file = os.path.dirname(__file__) + '/data.csv'
-    output_csv_file = os.path.join(save_path, "data_diff_rho_drag1.csv")
+    if output_format == "csv":
+        output_path = os.path.join(save_path, "data_diff_rho_drag1.csv")
+    elif output_format == "store":
+        output_path = os.path.join(save_path, "data_diff_rho_drag1")
+    else:
+        raise ValueError("Invalid output_format. Use 'store' or 'csv'.")
+
+    resuming = (
+        resume
+        and output_format == "store"
+        and os.path.exists(os.path.join(output_path, MANIFEST_FILE))
+    )
 
-    if os.path.exists(output_csv_file):
+    if os.path.exists(output_path) and not resuming:
         # Ask the user if they want to remove the existing file.
         user_input = input(
             "The file {} already exists. Do you want to remove the existing file? (y/n)".format(
-                output_csv_file
+                output_path
             )
         )
         if user_input == "y":
             # Remove the existing file
-            os.remove(output_csv_file)
+            if os.path.isdir(output_path):
+                shutil.rmtree(output_path)
+            else:
+                os.remove(output_path)
         elif user_input == "n":
             raise Exception(
                 "Please delete or rename the file {} before running this script.".format(
-                    output_csv_file
+                    output_path
                 )
             )
         else:
@@ -643,7 +1337,7 @@ def main(num_simulations, parallel_bool, save_trials=False):
         savepath = os.path.join(save_path, "trial_data_drag1")
         if not os.path.exists(savepath):
             os.makedirs(savepath)
-        else:
+        elif not resuming:
             # Ask the user if they want to remove the existing files in the directory.
             user_input = input(
                 "The directory {} already exists. Do you want to remove the existing files? (y/n)".format(
@@ -663,33 +1357,21 @@ def main(num_simulations, parallel_bool, save_trials=False):
             else:
                 raise Exception("Invalid input. Please enter 'y' or 'n'.")
 
-    # Append headers to the output file
-    with open(output_csv_file, "w", newline="") as file:
-        writer = csv.writer(file)
-        # This depends on the number of waypoints and the order of the polynomial. Currently pos is 7th order and yaw is 7th order.
-        writer.writerow(
-            ["traj_number"]
-            + ["cost_{}".format(i) for i in robust_c]
-            + [
-                "x_poly_seg_{}_coeff_{}".format(i, j)
-                for i in range(num_waypoints - 1)
-                for j in range(8)
-            ]
-            + [
-                "y_poly_seg_{}_coeff_{}".format(i, j)
-                for i in range(num_waypoints - 1)
-                for j in range(8)
-            ]
-            + [
-                "z_poly_seg_{}_coeff_{}".format(i, j)
-                for i in range(num_waypoints - 1)
-                for j in range(8)
-            ]
-            + [
-                "yaw_poly_seg_{}_coeff_{}".format(i, j)
-                for i in range(num_waypoints - 1)
-                for j in range(8)
-            ]
+    columns = summary_columns(num_waypoints, robust_c, censoring=divergence_monitor is not None)
+    if output_format == "csv":
+        # Append headers to the output file
+        with open(output_path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(columns)
+        output_file = output_path
+    else:
+        output_file = TrajStoreWriter(
+            output_path,
+            columns=columns,
+            seed_column="traj_number",
+            cost_columns=["cost_{}".format(i) for i in robust_c],
+            coeff_layout=coeff_layout(num_waypoints),
+            shard_size=shard_size,
         )
 
     # Now create the world, vehicle, and controller objects.
@@ -711,7 +1393,7 @@ def main(num_simulations, parallel_bool, save_trials=False):
     # Generate the data
     start_time = time.time()
     generate_data(
-        output_csv_file,
+        output_file,
         world,
         vehicle,
         controller,
@@ -729,6 +1411,12 @@ def main(num_simulations, parallel_bool, save_trials=False):
         parallel=parallel_bool,
         save_individual_trials=save_trials,
         robust_c=robust_c,
+        rollout_batch_size=rollout_batch_size,
+        batched_sampling=batched_sampling,
+        rollout_engine=rollout_engine,
+        root_seed=root_seed,
+        divergence_monitor=divergence_monitor,
+        metrics_file=metrics_file if metrics_file is not None else os.path.join(save_path, "datagen_metrics.jsonl"),
     )
     end_time = time.time()
     print(
@@ -0,0 +1,413 @@
+"""
+SYNOPSIS
+    Multi-fidelity data generation: coarse screening rollouts before full simulation.
+
+DESCRIPTION
+    Candidate seeds are first simulated together with batch_rollout at a
+    coarse simulator rate with few RK4 substeps, which is several times
+    cheaper than the full-fidelity rollout. The coarse costs are rescaled to
+    the full rate (costs are sums over samples) and used to flag candidates
+    whose coarse rollout failed (a non-TIMEOUT exit), whose estimated cost is
+    above a threshold, or whose coefficients are near-duplicates of an
+    earlier candidate. Only the remaining candidates, plus a small random
+    audit share of the rejected ones, are then simulated at full fidelity with
+    generate_data.
+
+    The coarse rollouts (coefficients, cost estimates and failures) and the
+    full store are written under the output directory, so an interrupted run
+    resumes. The coarse results are only reused with the same candidates,
+    coarse settings and sampling arguments; the near-duplicate check and the
+    selection are redone on every call, so the thresholds can be changed
+    without simulating the candidates again. The report compares the coarse
+    and full costs of every simulated candidate (Pearson correlation of the
+    log costs and Spearman rank correlation, overall and on the audit share),
+    which is what the thresholds are tuned with.
+
+    Contains:
+    a) coarse_screen - coarse rollouts of candidate seeds
+    b) find_near_duplicates - candidates close to an earlier one
+    c) screen_candidates - selection and audit share
+    d) screened_generation - screening, full simulation and report
+"""
+
+import json
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.stats import pearsonr, spearmanr
+from rotorpy.controllers.quadrotor_control import SE3Control
+from rotorpy.simulate import ExitStatus
+from rotorpy.vehicles.multirotor import Multirotor
+from rotorpy.world import World
+
+from batch_rollout import batch_rollout
+from cost_labels import compute_costs
+from rotorpy_data import (
+    coeff_layout,
+    generate_data,
+    hover_initial_state,
+    quad_params,
+    sample_minsnap_trajectory,
+    save_path,
+    summary_columns,
+)
+from traj_store import MANIFEST_FILE, TrajStore, TrajStoreWriter
+
+SCREENING_FILE = "screening.npz"
+REPORT_FILE = "report.json"
+FULL_SIM_RATE = 100
+
+
+def _screening_config(robust_c, coarse_rate, coarse_substeps, sampling_args):
+    """
+    Settings the coarse results depend on, as the JSON string recorded in the screening file.
+    """
+    config = dict(robust_c=robust_c, coarse_rate=coarse_rate, coarse_substeps=coarse_substeps, sampling_args=sampling_args)
+    return json.dumps(config, sort_keys=True, default=lambda o: np.asarray(o).tolist())
+
+
+def _coarse_seeds(world, vehicle, controller, seeds, sampling_args, robust_c, sim_rate, substeps):
+    trajectories, initial_states, features = [], [], []
+    for seed in seeds:
+        waypoints, traj = sample_minsnap_trajectory(world, seed=seed, **sampling_args)
+        trajectories.append(traj)
+        initial_states.append(hover_initial_state(waypoints))
+        features.append(np.concatenate((traj.c_opt_xyz.ravel(), traj.c_opt_yaw.ravel())))
+    result = batch_rollout(vehicle, controller, trajectories, initial_states, sim_rate=sim_rate, substeps=substeps)
+    # Costs are sums over samples, so the coarse ones are rescaled to the sample count of the full rate
+    costs = compute_costs(result, robust_c) * FULL_SIM_RATE / sim_rate
+    failed = np.array([exit_status != ExitStatus.TIMEOUT for exit_status in result["exit"]])
+    return np.array(features), costs, failed
+
+
+def _coarse_task(args):
+    return _coarse_seeds(*args)
+
+
+def coarse_screen(
+    world,
+    vehicle,
+    controller,
+    seeds,
+    sampling_args,
+    robust_c=[0, 1, 0.1, 0.5],
+    sim_rate=50,
+    substeps=2,
+    batch_size=256,
+    parallel=True,
+):
+    """
+    Coarse rollouts of the candidate seeds.
+    Inputs:
+        world, vehicle, controller: as for rotorpy_data.generate_data.
+        seeds: array of candidate seeds.
+        sampling_args: keyword arguments of sample_minsnap_trajectory other than world and seed.
+        robust_c: robust_c values of the costs.
+        sim_rate: simulator rate of the coarse rollouts in Hz.
+        substeps: RK4 steps per simulator step of the coarse rollouts. The motor time constant limits how large a
+            step stays stable; sim_rate * substeps should be at least 100.
+        batch_size: Number of trajectories simulated together.
+        parallel: If True, the batches run on a worker pool.
+    Outputs:
+        features: (len(seeds), num_coefficients) polynomial coefficients, in the column order of the data file.
+        costs: (len(seeds), len(robust_c)) coarse estimates of the full-rate costs.
+        failed: (len(seeds),) True where the coarse rollout hit a safety exit.
+    """
+    tasks = [
+        (world, vehicle, controller, seeds[i : i + batch_size], sampling_args, robust_c, sim_rate, substeps)
+        for i in range(0, len(seeds), batch_size)
+    ]
+    if parallel:
+        with multiprocessing.Pool(min(multiprocessing.cpu_count(), 40)) as pool:
+            results = pool.map(_coarse_task, tasks)
+    else:
+        results = [_coarse_task(task) for task in tasks]
+    features, costs, failed = zip(*results)
+    return np.concatenate(features), np.concatenate(costs), np.concatenate(failed)
+
+
+def find_near_duplicates(features, tolerance=0.05):
+    """
+    Flags every candidate that lies within `tolerance` of an earlier candidate, in RMS distance over the
+    coefficients standardized per column.
+    Inputs:
+        features: (N, num_coefficients) polynomial coefficients.
+        tolerance: RMS distance, in standard deviations, below which two candidates are near-duplicates.
+    Outputs:
+        duplicate: (N,) boolean array.
+    """
+    scale = np.std(features, axis=0)
+    scaled = features / np.where(scale > 0, scale, 1.0)
+    pairs = cKDTree(scaled).query_pairs(r=tolerance * np.sqrt(features.shape[1]), output_type="ndarray")
+    duplicate = np.zeros(features.shape[0], dtype=bool)
+    # query_pairs returns i < j, so the later candidate of each pair is the duplicate
+    duplicate[pairs[:, 1]] = True
+    return duplicate
+
+
+def screen_candidates(log_costs, failed, duplicate, cost_threshold=None, audit_fraction=0.05, rng=None):
+    """
+    Candidates to simulate at full fidelity.
+    Inputs:
+        log_costs: (N,) coarse log cost estimates.
+        failed, duplicate: (N,) boolean flags from coarse_screen and find_near_duplicates.
+        cost_threshold: Candidates with a larger coarse log cost are rejected. None to keep all costs.
+        audit_fraction: Share of the rejected candidates simulated anyway, to check the screening.
+        rng: numpy Generator.
+    Outputs:
+        selected: (N,) boolean array of the candidates that pass the screening.
+        audit: (N,) boolean array of the rejected candidates chosen for the audit.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    rejected = failed | duplicate
+    if cost_threshold is not None:
+        rejected |= ~(log_costs <= cost_threshold)
+    audit = np.zeros(len(rejected), dtype=bool)
+    candidates = np.flatnonzero(rejected)
+    num_audit = int(round(audit_fraction * len(candidates)))
+    audit[rng.choice(candidates, size=num_audit, replace=False)] = True
+    return ~rejected, audit
+
+
+def _correlations(coarse, full):
+    """
+    Pearson correlation of the log costs and Spearman rank correlation of coarse and full costs.
+    """
+    if len(coarse) < 3:
+        return {"num_samples": int(len(coarse)), "pearson_log": None, "spearman": None}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_coarse, log_full = np.log(coarse), np.log(full)
+    finite = np.isfinite(log_coarse) & np.isfinite(log_full)
+    return {
+        "num_samples": int(len(coarse)),
+        "pearson_log": float(pearsonr(log_coarse[finite], log_full[finite])[0]) if finite.sum() >= 3 else None,
+        "spearman": float(spearmanr(coarse, full)[0]),
+    }
+
+
+def screened_generation(
+    output_dir,
+    world,
+    vehicle,
+    controller,
+    num_candidates,
+    sampling_args,
+    rho=0,
+    robust_c=[0, 1, 0.1, 0.5],
+    coarse_rate=50,
+    coarse_substeps=2,
+    duplicate_tolerance=0.05,
+    cost_threshold=None,
+    audit_fraction=0.05,
+    parallel=True,
+    rollout_batch_size=1,
+    seed=0,
+):
+    """
+    Screens num_candidates seeds with coarse rollouts and simulates the selected ones at full fidelity.
+    Inputs:
+        output_dir: Directory holding the coarse results (screening.npz), the store of the full rollouts ('full') and
+            report.json.
+        world, vehicle, controller: as for rotorpy_data.generate_data.
+        num_candidates: Number of candidate seeds, range(num_candidates).
+        sampling_args: keyword arguments of sample_minsnap_trajectory other than world and seed.
+        rho: robust_c of the cost column cost_threshold applies to.
+        coarse_rate, coarse_substeps: sim_rate and substeps of the coarse rollouts (see coarse_screen).
+        duplicate_tolerance: see find_near_duplicates. None to keep near-duplicates.
+        cost_threshold: see screen_candidates.
+        audit_fraction: see screen_candidates.
+        parallel, rollout_batch_size: as for rotorpy_data.generate_data.
+        seed: Seed of the audit choice.
+    Outputs:
+        report: dict with the screening counts, timings and coarse/full cost correlations, also written to
+            report.json.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    seeds = np.arange(num_candidates)
+    screening_path = os.path.join(output_dir, SCREENING_FILE)
+    config = _screening_config(robust_c, coarse_rate, coarse_substeps, sampling_args)
+
+    if os.path.exists(screening_path):
+        with np.load(screening_path) as screening:
+            screening = dict(screening)
+        if not np.array_equal(screening["seeds"], seeds):
+            raise ValueError("{} holds the screening of different candidates.".format(screening_path))
+        if "config" not in screening or str(screening["config"]) != config:
+            raise ValueError(
+                "{} holds coarse rollouts with different settings or sampling arguments.".format(screening_path)
+            )
+        print("Reusing the coarse rollouts of {} candidates.".format(num_candidates))
+    else:
+        start_time = time.perf_counter()
+        features, costs, failed = coarse_screen(
+            world,
+            vehicle,
+            controller,
+            seeds,
+            sampling_args,
+            robust_c=robust_c,
+            sim_rate=coarse_rate,
+            substeps=coarse_substeps,
+            parallel=parallel,
+        )
+        coarse_time = time.perf_counter() - start_time
+        # Only what the coarse rollouts produced, the selection depends on the thresholds of the call
+        screening = dict(
+            seeds=seeds,
+            features=features,
+            costs=costs,
+            failed=failed,
+            coarse_time=coarse_time,
+            config=np.array(config),
+        )
+        np.savez(screening_path, **screening)
+
+    if duplicate_tolerance is not None:
+        screening["duplicate"] = find_near_duplicates(screening["features"], duplicate_tolerance)
+    else:
+        screening["duplicate"] = np.zeros(num_candidates, dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_costs = np.log(screening["costs"][:, robust_c.index(rho)])
+    screening["selected"], screening["audit"] = screen_candidates(
+        log_costs,
+        screening["failed"],
+        screening["duplicate"],
+        cost_threshold,
+        audit_fraction,
+        rng=np.random.default_rng(seed),
+    )
+
+    run_seeds = seeds[screening["selected"] | screening["audit"]]
+    print(
+        "Screening: {} of {} candidates selected ({} failed, {} near-duplicates, {} over the cost threshold), "
+        "{} rejected ones audited.".format(
+            int(screening["selected"].sum()),
+            num_candidates,
+            int(screening["failed"].sum()),
+            int(screening["duplicate"].sum()),
+            int((~screening["selected"] & ~screening["failed"] & ~screening["duplicate"]).sum()),
+            int(screening["audit"].sum()),
+        )
+    )
+
+    full_path = os.path.join(output_dir, "full")
+    manifest_path = os.path.join(full_path, MANIFEST_FILE)
+    if os.path.exists(manifest_path):
+        # A resumed store keeps the seed list it was started with
+        with open(manifest_path) as f:
+            if sorted(json.load(f)["seeds"]) != sorted(run_seeds.tolist()):
+                raise ValueError(
+                    "The full store at {} was started for a different selection; remove it to simulate this "
+                    "one.".format(full_path)
+                )
+    writer = TrajStoreWriter(
+        full_path,
+        columns=summary_columns(sampling_args["num_waypoints"], robust_c),
+        seed_column="traj_number",
+        cost_columns=["cost_{}".format(i) for i in robust_c],
+        coeff_layout=coeff_layout(sampling_args["num_waypoints"]),
+    )
+    start_time = time.perf_counter()
+    generate_data(
+        writer,
+        world,
+        vehicle,
+        controller,
+        len(run_seeds),
+        parallel=parallel,
+        robust_c=robust_c,
+        rollout_batch_size=rollout_batch_size,
+        seeds=run_seeds,
+        **sampling_args
+    )
+    full_time = time.perf_counter() - start_time
+
+    # Match the full rollouts to their coarse estimates by seed
+    store = TrajStore(full_path)
+    full_seeds = store.column("traj_number").astype(int)
+    full_costs = np.stack([store.column("cost_{}".format(i)) for i in robust_c], axis=1)
+    coarse_costs = screening["costs"][full_seeds]
+    audited = screening["audit"][full_seeds]
+
+    report = {
+        "num_candidates": int(num_candidates),
+        "num_selected": int(screening["selected"].sum()),
+        "num_failed": int(screening["failed"].sum()),
+        "num_duplicates": int(screening["duplicate"].sum()),
+        "num_audited": int(screening["audit"].sum()),
+        "coarse_rate": coarse_rate,
+        "coarse_substeps": coarse_substeps,
+        "cost_threshold": cost_threshold,
+        "duplicate_tolerance": duplicate_tolerance,
+        "coarse_seconds_per_candidate": float(screening["coarse_time"]) / max(num_candidates, 1),
+        # Only meaningful when this call ran all full rollouts, not when it resumed a finished store
+        "full_seconds_per_rollout": full_time / max(len(run_seeds), 1),
+        "correlation": {
+            "cost_{}".format(c): {
+                "all": _correlations(coarse_costs[:, i], full_costs[:, i]),
+                "audit": _correlations(coarse_costs[audited, i], full_costs[audited, i]),
+            }
+            for i, c in enumerate(robust_c)
+        },
+    }
+    with open(os.path.join(output_dir, REPORT_FILE), "w") as f:
+        json.dump(report, f, indent=2)
+
+    for column, correlation in report["correlation"].items():
+        print(
+            "{}: coarse/full correlation over {} rollouts, Pearson (log) {}, Spearman {}.".format(
+                column,
+                correlation["all"]["num_samples"],
+                correlation["all"]["pearson_log"],
+                correlation["all"]["spearman"],
+            )
+        )
+    return report
+
+
+def main(num_candidates=20000, cost_threshold=None):
+    """
+    Screened data generation with the datagen settings of rotorpy_data.main.
+    """
+    world_size = 10
+    world = World.empty(
+        [
+            -world_size / 2,
+            world_size / 2,
+            -world_size / 2,
+            world_size / 2,
+            -world_size / 2,
+            world_size / 2,
+        ]
+    )
+    vehicle = Multirotor(quad_params)
+    controller = SE3Control(quad_params)
+    sampling_args = dict(
+        num_waypoints=4,
+        start_waypoint=None,
+        end_waypoint=None,
+        world_buffer=2,
+        min_distance=1,
+        max_distance=4,
+        vavg=2,
+        random_yaw=False,
+        yaw_min=-0.85 * np.pi,
+        yaw_max=0.85 * np.pi,
+    )
+
+    screened_generation(
+        os.path.join(save_path, "screened_drag1"),
+        world,
+        vehicle,
+        controller,
+        num_candidates,
+        sampling_args,
+        cost_threshold=cost_threshold,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+SYNOPSIS
+    Reproducible per-trajectory random streams from a single root seed.
+
+DESCRIPTION
+    Every trajectory of a dataset gets a global index k and its own random
+    stream, the k-th child of numpy.random.SeedSequence(root_seed), i.e.
+    SeedSequence(root_seed).spawn(k + 1)[k]. The child is built directly from
+    its spawn key, so a stream depends only on (root_seed, k): not on which
+    process, shard or machine draws it, nor on how many other trajectories
+    were drawn before. A run can be split into shards that own disjoint
+    blocks of indices, or extended later with indices past the ones already
+    used, and the results merge into the same dataset a single run would have
+    produced.
+
+    The index k is what the datasets record as traj_number.
+
+    Contains:
+    a) trajectory_seed_sequence - SeedSequence of a trajectory
+    b) trajectory_generator - Generator of a trajectory
+    c) shard_indices - block of indices owned by one shard
+"""
+
+import numpy as np
+
+
+def trajectory_seed_sequence(root_seed, index):
+    """
+    Seed sequence of trajectory `index`, identical to SeedSequence(root_seed).spawn(index + 1)[index].
+    Inputs:
+        root_seed: non-negative integer root seed of the dataset.
+        index: global index of the trajectory.
+    Outputs:
+        seed_sequence: numpy.random.SeedSequence.
+    """
+    return np.random.SeedSequence(root_seed, spawn_key=(int(index),))
+
+
+def trajectory_generator(root_seed, index):
+    """
+    Random generator of trajectory `index`, see trajectory_seed_sequence.
+    """
+    return np.random.Generator(np.random.PCG64(trajectory_seed_sequence(root_seed, index)))
+
+
+def shard_indices(num_simulations, shard=0, num_shards=1, start=0):
+    """
+    Global trajectory indices owned by one shard: the indices start, ..., start + num_simulations - 1 are split into
+    num_shards contiguous blocks whose sizes differ by at most one.
+    Inputs:
+        num_simulations: total number of trajectories of the run.
+        shard: index of the shard, in [0, num_shards).
+        num_shards: number of shards.
+        start: first global index of the run, e.g. the number of trajectories of the run being extended.
+    Outputs:
+        indices: array of global indices.
+    """
+    if not 0 <= shard < num_shards:
+        raise ValueError("shard must be in [0, {}), got {}.".format(num_shards, shard))
+    bounds = np.linspace(0, num_simulations, num_shards + 1).round().astype(int)
+    return start + np.arange(bounds[shard], bounds[shard + 1])
@@ -0,0 +1,378 @@
+"""
+SYNOPSIS
+    Sharded data generation across machines, and merging of the shards.
+
+DESCRIPTION
+    A run of num_simulations trajectories with a given root seed is split into
+    N shards that own disjoint, contiguous blocks of trajectory indices (see
+    seed_streams.py). Each shard is an independent process, on any machine,
+    that writes its own partition: a resumable store (see traj_store.py)
+    named shard_{i}_of_{N} under a shared output directory, plus a shard.json
+    describing its place in the run. Because every trajectory is drawn from
+    its own seed stream, a shard's rows do not depend on how the run is split.
+
+    The merge step checks that the partitions belong to the same run and
+    cover it, drops duplicate trajectories (e.g. from a shard that was run
+    twice), and compacts everything into a single store ordered by trajectory
+    index, with a completed job manifest like a single-machine run would have.
+
+    Nothing beyond a shared (or copied) output directory is needed, so a run
+    can be tried locally by launching several shard processes on one machine.
+
+    Usage:
+        python sharded_datagen.py run --shard 0/4 --num-simulations 200000 --output-dir DIR
+        python sharded_datagen.py merge --output-dir DIR --merged PATH
+        python sharded_datagen.py local --num-shards 4 --num-simulations 1000 --output-dir DIR --merged PATH
+
+    Contains:
+    a) run_shard - generates one partition
+    b) merge_shards - validates, deduplicates and compacts the partitions
+    c) launch_local - runs all shards as local processes, then merges them
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from rotorpy.controllers.quadrotor_control import SE3Control
+from rotorpy.vehicles.multirotor import Multirotor
+from rotorpy.world import World
+
+from rotorpy_data import coeff_layout, generate_data, quad_params, save_path, summary_columns
+from seed_streams import shard_indices
+from traj_store import MANIFEST_FILE, JobManifest, TrajStore, TrajStoreWriter
+
+SHARD_FILE = "shard.json"
+PARTITION_PATTERN = re.compile(r"^shard_(\d+)_of_(\d+)$")
+
+
+def parse_shard(text):
+    """
+    Parse a shard specification "i/N" into (i, N).
+    """
+    match = re.match(r"^(\d+)/(\d+)$", text.strip())
+    if match is None:
+        raise ValueError("Invalid shard {}. Use i/N, e.g. 0/4.".format(text))
+    shard, num_shards = int(match.group(1)), int(match.group(2))
+    if not 0 <= shard < num_shards:
+        raise ValueError("Invalid shard {}: i must be in [0, N).".format(text))
+    return shard, num_shards
+
+
+def partition_path(output_dir, shard, num_shards):
+    return os.path.join(output_dir, "shard_{:03d}_of_{:03d}".format(shard, num_shards))
+
+
+def run_shard(
+    output_dir,
+    shard,
+    num_shards,
+    num_simulations,
+    root_seed=0,
+    parallel=True,
+    rollout_batch_size=1,
+    num_workers=None,
+    shard_size=10000,
+):
+    """
+    Generates the partition of one shard with the datagen settings of rotorpy_data.main. Running a shard again
+    resumes it. A shard without trajectories (more shards than trajectories) writes an empty partition.
+    Inputs:
+        output_dir: Directory holding the partitions of the run.
+        shard, num_shards: This shard is shard `shard` of `num_shards`.
+        num_simulations: Number of trajectories of the whole run.
+        root_seed: Root seed of the run.
+        parallel, rollout_batch_size, num_workers: as for rotorpy_data.generate_data.
+        shard_size: Number of rows per shard file of the partition's store.
+    Outputs:
+        path: path of the partition.
+    """
+    path = partition_path(output_dir, shard, num_shards)
+    info = {
+        "shard": shard,
+        "num_shards": num_shards,
+        "num_simulations": num_simulations,
+        "root_seed": root_seed,
+    }
+    info_path = os.path.join(path, SHARD_FILE)
+    if os.path.exists(info_path):
+        with open(info_path) as f:
+            if json.load(f) != info:
+                raise ValueError("{} holds a shard of a different run.".format(path))
+
+    robust_c = [0, 1, 0.1, 0.5]
+    num_waypoints = 4
+    writer = TrajStoreWriter(
+        path,
+        columns=summary_columns(num_waypoints, robust_c),
+        seed_column="traj_number",
+        cost_columns=["cost_{}".format(i) for i in robust_c],
+        coeff_layout=coeff_layout(num_waypoints),
+        shard_size=shard_size,
+    )
+    with open(info_path, "w") as f:
+        json.dump(info, f, indent=2)
+
+    world_size = 10
+    world = World.empty(
+        [
+            -world_size / 2,
+            world_size / 2,
+            -world_size / 2,
+            world_size / 2,
+            -world_size / 2,
+            world_size / 2,
+        ]
+    )
+    vehicle = Multirotor(quad_params)
+    controller = SE3Control(quad_params)
+
+    seeds = shard_indices(num_simulations, shard, num_shards)
+    if len(seeds) == 0:
+        # More shards than trajectories. The empty partition still gets its job manifest, so the merge sees the run
+        print("Shard {}/{}: no trajectories.".format(shard, num_shards))
+        parallel = False
+    else:
+        print("Shard {}/{}: trajectories {} to {}.".format(shard, num_shards, seeds[0], seeds[-1]))
+    generate_data(
+        writer,
+        world,
+        vehicle,
+        controller,
+        len(seeds),
+        num_waypoints=num_waypoints,
+        vavg=2,
+        random_yaw=False,
+        yaw_min=-0.85 * np.pi,
+        yaw_max=0.85 * np.pi,
+        world_buffer=2,
+        min_distance=1,
+        max_distance=4,
+        start_waypoint=None,
+        end_waypoint=None,
+        parallel=parallel,
+        robust_c=robust_c,
+        rollout_batch_size=rollout_batch_size,
+        seeds=seeds,
+        root_seed=root_seed,
+        num_workers=num_workers,
+        metrics_file=os.path.join(path, "metrics.jsonl"),
+    )
+    return path
+
+
+def find_partitions(output_dir):
+    """
+    Partitions of the run in output_dir.
+    Outputs:
+        partitions: list of (shard info dict, path), ordered by shard.
+    """
+    partitions = []
+    for name in sorted(os.listdir(output_dir)):
+        path = os.path.join(output_dir, name)
+        if PARTITION_PATTERN.match(name) and os.path.exists(os.path.join(path, SHARD_FILE)):
+            with open(os.path.join(path, SHARD_FILE)) as f:
+                partitions.append((json.load(f), path))
+    return sorted(partitions, key=lambda partition: partition[0]["shard"])
+
+
+def merge_shards(output_dir, merged_path, shard_size=10000, allow_incomplete=False):
+    """
+    Validates the partitions of a run and compacts them into one store, ordered by trajectory index.
+    Inputs:
+        output_dir: Directory holding the partitions.
+        merged_path: Directory of the merged store. Must not exist.
+        shard_size: Number of rows per shard file of the merged store.
+        allow_incomplete: If True, missing partitions and trajectories are reported instead of raising.
+    Outputs:
+        report: dict with the number of partitions, rows written, duplicates dropped and missing trajectories.
+    Raises:
+        ValueError if the partitions belong to different runs, hold rows outside their block of indices or
+        non-finite values, or, unless allow_incomplete, do not cover the run.
+    """
+    if os.path.exists(merged_path):
+        raise ValueError("{} already exists.".format(merged_path))
+    partitions = find_partitions(output_dir)
+    if not partitions:
+        raise ValueError("No shard partitions in {}.".format(output_dir))
+
+    # All partitions must come from the same run
+    run = {k: partitions[0][0][k] for k in ("num_shards", "num_simulations", "root_seed")}
+    for info, path in partitions:
+        if {k: info[k] for k in run} != run:
+            raise ValueError("{} belongs to a different run than {}.".format(path, partitions[0][1]))
+    missing_shards = sorted(set(range(run["num_shards"])) - set(info["shard"] for info, _ in partitions))
+    if missing_shards and not allow_incomplete:
+        raise ValueError("Missing partitions for shards {} of {}.".format(missing_shards, run["num_shards"]))
+
+    stores, configs = [], []
+    for info, path in partitions:
+        stores.append(TrajStore(path))
+        with open(os.path.join(path, MANIFEST_FILE)) as f:
+            config = json.load(f)["config"]
+        # The job of a shard only knows its own number of trajectories
+        configs.append({k: v for k, v in config.items() if k != "num_simulations"})
+        if stores[-1].columns != stores[0].columns or configs[-1] != configs[0]:
+            raise ValueError("{} was generated with different settings than {}.".format(path, partitions[0][1]))
+
+    schema = stores[0].schema
+    seed_column = stores[0].columns.index(schema["seed_column"])
+
+    # Validate every partition before writing anything
+    num_duplicates, missing, keep = 0, [], []
+    for (info, path), store in zip(partitions, stores):
+        expected = shard_indices(run["num_simulations"], info["shard"], run["num_shards"])
+        indices = np.asarray(store.column(schema["seed_column"])).astype(int)
+        outside = np.setdiff1d(indices, expected)
+        if outside.size > 0:
+            raise ValueError("{} holds trajectories {} outside its block of indices.".format(path, outside[:10].tolist()))
+        if not all(np.all(np.isfinite(shard)) for shard in store.shards):
+            raise ValueError("{} holds non-finite values.".format(path))
+        # np.unique keeps the first occurrence of each index, in index order
+        _, first = np.unique(indices, return_index=True)
+        keep.append(first)
+        num_duplicates += len(indices) - len(first)
+        missing.extend(np.setdiff1d(expected, indices).tolist())
+    for shard in missing_shards:
+        missing.extend(shard_indices(run["num_simulations"], shard, run["num_shards"]).tolist())
+    if missing and not allow_incomplete:
+        raise ValueError("{} trajectories are missing, e.g. {}.".format(len(missing), sorted(missing)[:10]))
+
+    writer = TrajStoreWriter(
+        merged_path,
+        columns=schema["columns"],
+        seed_column=schema["seed_column"],
+        cost_columns=schema["cost_columns"],
+        coeff_layout=schema["coeff_layout"],
+        shard_size=shard_size,
+        dtype=schema["dtype"],
+    )
+    JobManifest(writer, shard_indices(run["num_simulations"]), config=dict(configs[0], num_simulations=run["num_simulations"]))
+    # Partitions hold consecutive blocks of indices, so appending them in shard order keeps the store ordered
+    for store, first in zip(stores, keep):
+        writer.append(store.view()[first])
+    writer.flush()
+
+    report = {
+        "num_partitions": len(partitions),
+        "num_rows": writer.schema["num_rows"],
+        "num_duplicates": num_duplicates,
+        "num_missing": len(missing),
+    }
+    print(
+        "Merged {} partitions into {}: {} rows, {} duplicates dropped, {} trajectories missing.".format(
+            report["num_partitions"], merged_path, report["num_rows"], report["num_duplicates"], report["num_missing"]
+        )
+    )
+    return report
+
+
+def launch_local(
+    output_dir,
+    num_shards,
+    num_simulations,
+    root_seed=0,
+    rollout_batch_size=1,
+    merged_path=None,
+):
+    """
+    Runs all shards of a run as separate processes on this machine, splitting its cores between them, then merges
+    the partitions if merged_path is given.
+    Outputs:
+        report: the merge report, or None if not merged.
+    """
+    num_workers = max(min(multiprocessing.cpu_count(), 40) // num_shards, 1)
+    start_time = time.time()
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                os.path.abspath(__file__),
+                "run",
+                "--shard",
+                "{}/{}".format(shard, num_shards),
+                "--num-simulations",
+                str(num_simulations),
+                "--root-seed",
+                str(root_seed),
+                "--output-dir",
+                output_dir,
+                "--rollout-batch-size",
+                str(rollout_batch_size),
+                "--num-workers",
+                str(num_workers),
+            ]
+        )
+        for shard in range(num_shards)
+    ]
+    failed = [shard for shard, process in enumerate(processes) if process.wait() != 0]
+    if failed:
+        raise RuntimeError("Shards {} failed. Run them again to resume.".format(failed))
+    print("All {} shards done in {:.2f} seconds.".format(num_shards, time.time() - start_time))
+
+    if merged_path is not None:
+        return merge_shards(output_dir, merged_path)
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sharded trajectory data generation.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="Generate the partition of one shard.")
+    run.add_argument("--shard", required=True, help="Shard to run, as i/N.")
+    run.add_argument("--num-simulations", type=int, required=True, help="Number of trajectories of the whole run.")
+    run.add_argument("--root-seed", type=int, default=0)
+    run.add_argument("--output-dir", default=os.path.join(save_path, "data_diff_rho_drag1_shards"))
+    run.add_argument("--rollout-batch-size", type=int, default=1)
+    run.add_argument("--num-workers", type=int, default=None)
+    run.add_argument("--sequential", action="store_true", help="Run the simulations in this process only.")
+
+    merge = commands.add_parser("merge", help="Validate and compact the partitions into one store.")
+    merge.add_argument("--output-dir", default=os.path.join(save_path, "data_diff_rho_drag1_shards"))
+    merge.add_argument("--merged", default=os.path.join(save_path, "data_diff_rho_drag1"))
+    merge.add_argument("--allow-incomplete", action="store_true")
+
+    local = commands.add_parser("local", help="Run all shards on this machine, then merge them.")
+    local.add_argument("--num-shards", type=int, required=True)
+    local.add_argument("--num-simulations", type=int, required=True)
+    local.add_argument("--root-seed", type=int, default=0)
+    local.add_argument("--output-dir", default=os.path.join(save_path, "data_diff_rho_drag1_shards"))
+    local.add_argument("--rollout-batch-size", type=int, default=1)
+    local.add_argument("--merged", default=None)
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        shard, num_shards = parse_shard(args.shard)
+        run_shard(
+            args.output_dir,
+            shard,
+            num_shards,
+            args.num_simulations,
+            root_seed=args.root_seed,
+            parallel=not args.sequential,
+            rollout_batch_size=args.rollout_batch_size,
+            num_workers=args.num_workers,
+        )
+    elif args.command == "merge":
+        merge_shards(args.output_dir, args.merged, allow_incomplete=args.allow_incomplete)
+    else:
+        launch_local(
+            args.output_dir,
+            args.num_shards,
+            args.num_simulations,
+            root_seed=args.root_seed,
+            rollout_batch_size=args.rollout_batch_size,
+            merged_path=args.merged,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ import sys
 import os
 
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# model_learning imports its sibling modules without the package prefix
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import matplotlib.pyplot as plt
 import numpy as np
 import sys
@@ -17,8 +19,9 @@ import optax
 from flax.training import train_state
 import jax
 from scripts.mlp_jax import MLP
-from scripts.model_learning import restore_checkpoint, train_model, numpy_collate, TrajDataset
-import torch.utils.data as data
+from scripts.model_learning import restore_checkpoint, train_model, ArrayLoader, TrajDataset
+from scripts.model_bundle import is_bundle, load_model, save_model
+from scripts.cost_labels import compute_costs, compute_yaw_from_quaternion
 from sklearn.model_selection import train_test_split 
 from scipy.spatial.transform import Rotation as R
 import time
@@ -279,31 +282,6 @@ def compute_cost_mean(sim_result):
     return sim_cost
 
 
-def compute_yaw_from_quaternion(quaternions):
-    R_matrices = R.from_quat(quaternions).as_matrix()
-    b3 = R_matrices[:, :, 2]
-    H = np.zeros((len(quaternions), 3, 3))
-    for i in range(len(quaternions)):
-        H[i, :, :] = np.array(
-            [
-                [
-                    1 - (b3[i, 0] ** 2) / (1 + b3[i, 2]),
-                    -(b3[i, 0] * b3[i, 1]) / (1 + b3[i, 2]),
-                    b3[i, 0],
-                ],
-                [
-                    -(b3[i, 0] * b3[i, 1]) / (1 + b3[i, 2]),
-                    1 - (b3[i, 1] ** 2) / (1 + b3[i, 2]),
-                    b3[i, 1],
-                ],
-                [-b3[i, 0], -b3[i, 1], b3[i, 2]],
-            ]
-        )
-    Hyaw = np.transpose(H, axes=(0, 2, 1)) @ R_matrices
-    actual_yaw = np.arctan2(Hyaw[:, 1, 0], Hyaw[:, 0, 0])
-    return actual_yaw
-
-
 def compute_cost(sim_result, robust_c=1.0):
     """
     Computes the cost from the output of a simulator instance.
@@ -407,6 +385,9 @@ def run_simulation_and_compute_cost(
         fname="trial_29",  # Filename is specified if you want to save the animation. Default location is the home directory.
     )
     trajectory_cost = compute_cost(sim_result, robust_c=robust_c)
+    # Same cost the value function is trained on, for comparison with its predictions
+    label_cost = compute_costs(sim_result, [robust_c])[0]
+    print(f"Training label cost (robust_c={robust_c}): {label_cost}")
 
     # Now extract the polynomial coefficients for the trajectory.
     pos_poly = traj.c_opt_xyz
@@ -1373,7 +1354,6 @@ def main():
     # Initialize neural network
     rho = 0
     drag_coeff = 3
-    input_size = 96  # number of coeff
 
     with open(
         # r"/home/user/code/quadrotor-drag-exp/AeroWrenchPlanner/learning/params.yaml"
@@ -1400,57 +1380,71 @@ def main():
     # csv_file_path = cwd + "/../../data/data_diff_rho_drag" + str(drag_coeff) + ".csv"
     # csv_file_path = "/home/user/code/quadrotor-drag-exp/data/data_diff_rho.csv"
 
-    train_dataset = TrajDataset(file_path=csv_file_path, feature_range=(-1, 1))
-
-    # Split the dataset into training and testing subsets
-    train_data, test_data = train_test_split(
-        train_dataset,
-        test_size=0.2,  # Specify the proportion of the dataset to use for testing (e.g., 0.2 for 20%)
-        random_state=42,  # Set a random seed for reproducibility
-    )
-
-    print("Training data length: ", len(train_data))
-    print("Testing data length: ", len(test_data))
-
-    # Initialize the model
-    number_of_coefficients = train_dataset.num_coefficients()
-    p = number_of_coefficients  # Set this to the number of coefficients in your dataset
-    print("Number of coefficients:", number_of_coefficients)
+    # The bundle written by training.py (or by an earlier run of this script) holds everything needed to predict, so
+    # the network is only trained here if there is none yet
+    bundle_path = model_save + "_bundle"
+    if not is_bundle(bundle_path):
+        train_dataset = TrajDataset(file_path=csv_file_path, feature_range=(-1, 1))
+
+        # Split the dataset into training and testing subsets
+        train_data, test_data = train_test_split(
+            np.arange(len(train_dataset)),
+            test_size=0.2,  # Specify the proportion of the dataset to use for testing (e.g., 0.2 for 20%)
+            random_state=42,  # Set a random seed for reproducibility
+        )
 
-    rng = jax.random.PRNGKey(427)
-    rng, inp_rng, init_rng = jax.random.split(rng, 3)
-    inp = jax.random.normal(inp_rng, (batch_size, p))  # Batch size 64, input size p
-    # Initialize the model
-    model = MLP(num_hidden=num_hidden, num_outputs=1)
-    # model = FICNN(num_hidden_c=num_hidden, num_outputs=1, input_features_c=p, seed=rng)
-    params = model.init(init_rng, inp)
+        print("Training data length: ", len(train_data))
+        print("Testing data length: ", len(test_data))
 
-    # Printing the model shows its attributes
-    print(model)
+        # Initialize the model
+        number_of_coefficients = train_dataset.num_coefficients()
+        p = number_of_coefficients  # Set this to the number of coefficients in your dataset
+        print("Number of coefficients:", number_of_coefficients)
 
-    # rng = jax.random.PRNGKey(427)
-    # rng, inp_rng, init_rng = jax.random.split(rng, 3)
-    # inp = jax.random.normal(inp_rng, (batch_size, p))  # Batch size 64, input size p
-    # Initialize the model
-    # params = model.init(init_rng, inp)
+        rng = jax.random.PRNGKey(427)
+        rng, inp_rng, init_rng = jax.random.split(rng, 3)
+        inp = jax.random.normal(inp_rng, (batch_size, p))  # Batch size 64, input size p
+        # Initialize the model
+        model = MLP(num_hidden=num_hidden, num_outputs=1)
+        # model = FICNN(num_hidden_c=num_hidden, num_outputs=1, input_features_c=p, seed=rng)
+        params = model.init(init_rng, inp)
 
-    optimizer = optax.sgd(learning_rate=learning_rate, momentum=0.9)
-    # optimizer = optax.adam(learning_rate=learning_rate, b1=0.9, b2=0.999, eps=1e-08)
+        # Printing the model shows its attributes
+        print(model)
 
-    model_state = train_state.TrainState.create(
-        apply_fn=model.apply, params=params, tx=optimizer
-    )
+        optimizer = optax.sgd(learning_rate=learning_rate, momentum=0.9)
+        # optimizer = optax.adam(learning_rate=learning_rate, b1=0.9, b2=0.999, eps=1e-08)
 
-    train_data_loader = data.DataLoader(
-        train_data, batch_size=batch_size, shuffle=True, collate_fn=numpy_collate
-    )
-    trained_model_state = train_model(
-        model_state, train_data_loader, num_epochs=num_epochs
-    )
+        model_state = train_state.TrainState.create(
+            apply_fn=model.apply, params=params, tx=optimizer
+        )
 
-    trained_model = model.bind(trained_model_state.params)
+        train_data_loader = ArrayLoader.from_dataset(
+            train_dataset, train_data, batch_size=batch_size, shuffle=True, seed=42
+        )
+        trained_model_state = train_model(
+            model_state, train_data_loader, num_epochs=num_epochs
+        )
+        save_model(
+            bundle_path,
+            trained_model_state.params,
+            num_hidden,
+            p,
+            coeff_layout=train_dataset.coeff_columns,
+            normalization=train_dataset.input_transform,
+            dataset={
+                "file_path": csv_file_path,
+                "rho": train_dataset.rho,
+                "drag_coeff": drag_coeff,
+                "num_train": len(train_data),
+                "num_test": len(test_data),
+                "num_epochs": num_epochs,
+            },
+        )
 
-    vf = (trained_model, trained_model_state.params)
+    bundle = load_model(bundle_path)
+    print("Loaded model bundle {} ({} coefficients)".format(bundle_path, bundle.input_size))
+    vf = (bundle, bundle.params)
 
     # Load the trained model
     # model = MLP(num_hidden=num_hidden, num_outputs=1)
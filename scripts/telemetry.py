@@ -0,0 +1,239 @@
+"""
+SYNOPSIS
+    Live throughput, ETA and per-worker telemetry for data generation.
+
+DESCRIPTION
+    Each process keeps a StageTimer that accumulates the seconds spent in the
+    stages of a simulation (waypoint sampling, MinSnap QP, rollout, cost) and
+    counts failed rollouts by exit status. Workers hand a snapshot of it back
+    with every task, and the main process feeds the snapshots to a
+    DatagenTelemetry, which measures the overall and per-worker simulation
+    rates, estimates the remaining time from the recent rate, and periodically
+    reports all of it to the console and as one JSON object per line to a
+    metrics file.
+
+    Worker stages are summed over all workers and reported as shares of that
+    total. Time the main process spends on its own stages, e.g. writing the
+    results, is wall time, so it is kept apart and reported as a share of the
+    elapsed time: a writer busy half of the run shows as 50% however many
+    workers feed it.
+
+    Contains:
+    a) StageTimer - per-process stage timing and failure counts
+    b) DatagenTelemetry - aggregation and periodic reporting in the main process
+"""
+
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+# Worker stages in the order they run for one simulation
+STAGES = ["sampling", "minsnap", "rollout", "cost"]
+
+
+class StageTimer(object):
+    """
+    Seconds spent per stage and failure counts of one process since the last snapshot.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = defaultdict(float)
+        self.failures = Counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager adding the time spent in its body to stage `name`.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start_time
+
+    def count_failure(self, kind, count=1):
+        self.failures[kind] += count
+
+    def snapshot(self):
+        """
+        Stage seconds and failure counts since the last snapshot, as plain dicts, and reset.
+        """
+        stats = {"stages": dict(self.seconds), "failures": dict(self.failures)}
+        self.reset()
+        return stats
+
+
+def _format_duration(seconds):
+    if seconds is None:
+        return "?"
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+
+class DatagenTelemetry(object):
+    """
+    Aggregates task statistics in the main process and reports them every `interval` seconds.
+    """
+
+    def __init__(self, num_simulations, metrics_file=None, interval=10.0, log=print):
+        """
+        Inputs:
+            num_simulations: Number of simulations the run has to complete.
+            metrics_file: Path of the JSON-lines file the reports are appended to, or None for console output only.
+            interval: Seconds between two reports.
+            log: Function printing a console line, e.g. tqdm.write while a progress bar is shown.
+        """
+        self.num_simulations = num_simulations
+        self.metrics_file = metrics_file
+        self.interval = interval
+        self.log = log
+        self.start_time = time.perf_counter()
+        self.last_report_time = self.start_time
+        self.last_report_completed = 0
+        self.completed = 0
+        self.stages = defaultdict(float)
+        self.main_stages = defaultdict(float)
+        # The result writer thread adds its stage time while the main process reports
+        self._stages_lock = threading.Lock()
+        self.failures = Counter()
+        self.workers = {}
+        if metrics_file is not None:
+            directory = os.path.dirname(metrics_file)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def record(self, worker, num_sims, task_time, stats):
+        """
+        Add the statistics of one finished task.
+        Inputs:
+            worker: Identifier of the process that ran the task, e.g. its pid.
+            num_sims: Number of simulations in the task.
+            task_time: Seconds the worker spent on the task.
+            stats: StageTimer.snapshot() of the worker after the task.
+        """
+        self.completed += num_sims
+        with self._stages_lock:
+            for name, seconds in stats["stages"].items():
+                self.stages[name] += seconds
+        self.failures.update(stats["failures"])
+        worker_stats = self.workers.setdefault(worker, {"sims": 0, "tasks": 0, "busy_seconds": 0.0})
+        worker_stats["sims"] += num_sims
+        worker_stats["tasks"] += 1
+        worker_stats["busy_seconds"] += task_time
+
+    def add_stage_time(self, name, seconds):
+        """
+        Add wall time spent by the main process, e.g. writing results. Safe to call from another thread.
+        """
+        with self._stages_lock:
+            self.main_stages[name] += seconds
+
+    def count_failure(self, kind, count=1):
+        """
+        Count failures the workers could not report, e.g. a task that raised.
+        """
+        self.failures[kind] += count
+
+    def maybe_report(self):
+        """
+        Report if at least `interval` seconds passed since the last report.
+        """
+        if time.perf_counter() - self.last_report_time >= self.interval:
+            self.report()
+
+    def metrics(self, final=False):
+        """
+        Current metrics as a JSON-serializable dict.
+        """
+        now = time.perf_counter()
+        elapsed = now - self.start_time
+        window = now - self.last_report_time
+        sims_per_second = self.completed / elapsed if elapsed > 0 else 0.0
+        recent_sims_per_second = (self.completed - self.last_report_completed) / window if window > 0 else 0.0
+        # The recent rate follows slowdowns, the overall rate covers the start-up before the first completions
+        rate = recent_sims_per_second if recent_sims_per_second > 0 else sims_per_second
+        remaining = max(self.num_simulations - self.completed, 0)
+        with self._stages_lock:
+            stages = dict(self.stages)
+            main_stages = dict(self.main_stages)
+        total_stage_seconds = sum(stages.values())
+        return {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "final": final,
+            "elapsed_seconds": elapsed,
+            "completed": self.completed,
+            "total": self.num_simulations,
+            "sims_per_second": sims_per_second,
+            "recent_sims_per_second": recent_sims_per_second,
+            "eta_seconds": remaining / rate if rate > 0 else None,
+            "workers": {
+                str(worker): dict(
+                    stats,
+                    # Rate while busy, so a straggler shows up even if it got fewer tasks
+                    sims_per_second=stats["sims"] / stats["busy_seconds"] if stats["busy_seconds"] > 0 else 0.0,
+                )
+                for worker, stats in self.workers.items()
+            },
+            "stage_seconds": stages,
+            "stage_fractions": {
+                name: seconds / total_stage_seconds for name, seconds in stages.items()
+            } if total_stage_seconds > 0 else {},
+            "main_stage_seconds": main_stages,
+            "main_stage_fractions": {
+                name: seconds / elapsed for name, seconds in main_stages.items()
+            } if elapsed > 0 else {},
+            "failures": dict(self.failures),
+            "num_failures": sum(self.failures.values()),
+        }
+
+    def report(self, final=False):
+        """
+        Print a summary line and append the metrics to the metrics file.
+        Outputs:
+            metrics: the reported metrics.
+        """
+        metrics = self.metrics(final=final)
+        self.last_report_time = time.perf_counter()
+        self.last_report_completed = self.completed
+
+        worker_rates = [stats["sims_per_second"] for stats in metrics["workers"].values()]
+        fractions = metrics["stage_fractions"]
+        ordered_stages = [name for name in STAGES if name in fractions] + sorted(set(fractions) - set(STAGES))
+        self.log(
+            "Telemetry: {}/{} sims, {:.2f} sims/s (recent {:.2f}), elapsed {}, ETA {} | {} workers, "
+            "{:.2f}-{:.2f} sims/s each | worker stages: {} | main process: {} of wall time | failures: {}".format(
+                metrics["completed"],
+                metrics["total"],
+                metrics["sims_per_second"],
+                metrics["recent_sims_per_second"],
+                _format_duration(metrics["elapsed_seconds"]),
+                _format_duration(metrics["eta_seconds"]),
+                len(worker_rates),
+                min(worker_rates, default=0.0),
+                max(worker_rates, default=0.0),
+                ", ".join(
+                    "{} {:.0f}%".format(name, 100 * fractions[name]) for name in ordered_stages
+                ) or "-",
+                ", ".join(
+                    "{} {:.0f}%".format(name, 100 * fraction)
+                    for name, fraction in metrics["main_stage_fractions"].items()
+                ) or "-",
+                ", ".join("{} {}".format(kind, count) for kind, count in sorted(self.failures.items())) or "0",
+            )
+        )
+        if self.metrics_file is not None:
+            with open(self.metrics_file, "a") as f:
+                f.write(json.dumps(metrics) + "\n")
+        return metrics
+
+    def close(self):
+        """
+        Final report.
+        """
+        return self.report(final=True)
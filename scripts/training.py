@@ -6,18 +6,20 @@ import numpy as np
 import matplotlib.pyplot as plt
 from model_learning import (
     TrajDataset,
+    ArrayLoader,
     train_model,
     eval_model,
-    numpy_collate,
     save_checkpoint,
     restore_checkpoint,
+    set_host_device_count,
+    data_parallel_mesh,
 )
 import ruamel.yaml as yaml
-import torch.utils.data as data
 from flax.training import train_state
 import optax
 import jax
 from mlp_jax import MLP
+from model_bundle import save_model
 # from ficnn_jax import FICNN
 # import pandas as pd
 # import torch
@@ -163,6 +165,10 @@ def main():
     learning_rate = yaml_data["learning_rate"]
     num_epochs = yaml_data["num_epochs"]
     model_save = yaml_data["save_path"] + str(rho) + str(drag_coeff)
+    # Data-parallel training over this many CPU devices, before anything runs on JAX's default device
+    num_devices = yaml_data.get("num_devices", 1)
+    if num_devices > 1:
+        set_host_device_count(num_devices)
     # Construct augmented states
     """
     cost_traj = cost_traj.ravel()
@@ -233,9 +239,9 @@ def main():
 
     train_dataset = TrajDataset(file_path=csv_file_path, feature_range=(-1, 1))
 
-    # Split the dataset into training and testing subsets
+    # Split the dataset into training and testing subsets, by index so the samples are gathered from the arrays
     train_data, test_data = train_test_split(
-        train_dataset,
+        np.arange(len(train_dataset)),
         test_size=0.2,  # Specify the proportion of the dataset to use for testing (e.g., 0.2 for 20%)
         random_state=42,  # Set a random seed for reproducibility
     )
@@ -272,18 +278,41 @@ def main():
         apply_fn=model.apply, params=params, tx=optimizer
     )
 
-    train_data_loader = data.DataLoader(
-        train_data, batch_size=batch_size, shuffle=True, collate_fn=numpy_collate
+    train_data_loader = ArrayLoader.from_dataset(
+        train_dataset, train_data, batch_size=batch_size, shuffle=True, seed=42
     )
     trained_model_state = train_model(
-        model_state, train_data_loader, num_epochs=num_epochs
+        model_state,
+        train_data_loader,
+        num_epochs=num_epochs,
+        mesh=data_parallel_mesh(num_devices) if num_devices > 1 else None,
     )
 
-    # Evaluation of trained network
+    # Evaluation of trained network, over every training sample in order
+    train_data_loader = ArrayLoader.from_dataset(
+        train_dataset, train_data, batch_size=batch_size, shuffle=False
+    )
 
     eval_model(trained_model_state, train_data_loader, batch_size)
 
     trained_model = model.bind(trained_model_state.params)
+    # Self-describing copy of the model for inference, see model_bundle.load_model
+    save_model(
+        model_save + "_bundle",
+        trained_model_state.params,
+        num_hidden,
+        p,
+        coeff_layout=train_dataset.coeff_columns,
+        normalization=train_dataset.input_transform,
+        dataset={
+            "file_path": csv_file_path,
+            "rho": train_dataset.rho,
+            "drag_coeff": drag_coeff,
+            "num_train": len(train_data),
+            "num_test": len(test_data),
+            "num_epochs": num_epochs,
+        },
+    )
     # save checkpoint
     # save_checkpoint(trained_model_state, model_save, 0)
 
@@ -456,8 +485,8 @@ def main():
     """
     # Evaluation of test and train dataset
     
-    test_data_loader = data.DataLoader(
-        test_data, batch_size=batch_size, shuffle=False, collate_fn=numpy_collate
+    test_data_loader = ArrayLoader.from_dataset(
+        train_dataset, test_data, batch_size=batch_size, shuffle=False
     )
 
     eval_model(trained_model_state, test_data_loader, batch_size)
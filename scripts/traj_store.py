@@ -0,0 +1,379 @@
+"""
+SYNOPSIS
+    Sharded, columnar binary store for the trajectory cost/coefficient dataset.
+
+DESCRIPTION
+    A store is a directory holding fixed-size .npy shards plus a schema.json
+    describing the columns (seed, cost columns and polynomial coefficient
+    layout), the shard list and per-column min/max statistics. Shards are saved
+    in column-major (Fortran) order, so each column of a shard is contiguous on
+    disk, and are opened with memory-mapping so that nothing is read until it
+    is touched.
+
+    A store can also carry a manifest.json for the data-generation job writing
+    it: the full ordered seed list and, for every committed shard, the seeds it
+    contains. A crashed job reopens the store, repairs it and only runs the
+    seeds that are not in a committed shard.
+
+    Contains:
+    a) TrajStoreWriter - batched appends into fixed-size shards
+    b) TrajStore - memory-mapped reader
+    c) ShardedView - lazy row/column view across shards
+    d) JobManifest - seed bookkeeping for resumable data generation
+"""
+
+import json
+import os
+
+import numpy as np
+
+SCHEMA_FILE = "schema.json"
+MANIFEST_FILE = "manifest.json"
+SCHEMA_VERSION = 1
+
+
+def _atomic_write_json(path, obj, indent=2):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=indent)
+    os.replace(tmp_path, path)
+
+
+class TrajStoreWriter(object):
+    """
+    Appends rows to a store in batches. Rows are buffered in memory and written
+    out as a shard every `shard_size` rows; the remaining rows are written as a
+    final, smaller shard by flush() or close(). Shards and the schema are
+    written to a temporary file first and renamed, so a crash never leaves a
+    half-written shard referenced by the schema. Reopening an existing store
+    repairs whatever an interrupted writer left behind.
+    """
+
+    def __init__(self, path, columns=None, seed_column="traj_number", cost_columns=None, coeff_layout=None, shard_size=10000, dtype="float64", on_commit=None, before_commit=None):
+        """
+        Open a store for appending, creating it if it does not exist.
+        Inputs:
+            path: directory of the store.
+            columns: list of column names. Required when creating a new store.
+            seed_column: name of the column holding the trajectory seed.
+            cost_columns: names of the cost columns.
+            coeff_layout: dict describing the coefficient columns (axes, num_segments, num_coeffs, columns).
+            shard_size: number of rows per shard.
+            dtype: numpy dtype of the stored values.
+            on_commit: optional function called as on_commit(shard_entry, rows) after each shard is committed.
+            before_commit: optional function called without arguments before each shard is written, e.g. to persist
+                data the committed rows depend on.
+        """
+        self.path = path
+        self.on_commit = on_commit
+        self.before_commit = before_commit
+        schema_path = os.path.join(path, SCHEMA_FILE)
+        if os.path.exists(schema_path):
+            with open(schema_path) as f:
+                self.schema = json.load(f)
+            if columns is not None and list(columns) != self.schema["columns"]:
+                raise ValueError("Columns do not match the existing store at {}.".format(path))
+            self.repair()
+        else:
+            if columns is None:
+                raise ValueError("columns must be given to create a new store.")
+            os.makedirs(path, exist_ok=True)
+            self.schema = {
+                "version": SCHEMA_VERSION,
+                "columns": list(columns),
+                "seed_column": seed_column,
+                "cost_columns": list(cost_columns) if cost_columns is not None else [],
+                "coeff_layout": coeff_layout,
+                "dtype": dtype,
+                "shard_size": shard_size,
+                "num_rows": 0,
+                "shards": [],
+            }
+            _atomic_write_json(schema_path, self.schema)
+
+        self.shard_size = self.schema["shard_size"]
+        self.num_columns = len(self.schema["columns"])
+        self._buffer = []
+        self._buffered_rows = 0
+
+    def repair(self):
+        """
+        Bring the store back to its last committed state: remove temporary files
+        and shard files the schema does not reference, and drop the first shard
+        that is missing or has the wrong shape together with everything after it.
+        Outputs:
+            Number of shards dropped from the schema.
+        """
+        num_columns = len(self.schema["columns"])
+        valid = []
+        for shard in self.schema["shards"]:
+            try:
+                rows = np.load(os.path.join(self.path, shard["file"]), mmap_mode="r")
+            except (OSError, ValueError):
+                break
+            if rows.shape != (shard["num_rows"], num_columns):
+                break
+            valid.append(shard)
+
+        dropped = len(self.schema["shards"]) - len(valid)
+        referenced = set(shard["file"] for shard in valid)
+        for file_name in os.listdir(self.path):
+            is_shard = file_name.startswith("shard_") and file_name.endswith(".npy")
+            if file_name.endswith(".tmp") or (is_shard and file_name not in referenced):
+                os.remove(os.path.join(self.path, file_name))
+
+        if dropped > 0:
+            self.schema["shards"] = valid
+            self.schema["num_rows"] = sum(shard["num_rows"] for shard in valid)
+            _atomic_write_json(os.path.join(self.path, SCHEMA_FILE), self.schema)
+        return dropped
+
+    def append(self, rows):
+        """
+        Append one row or a 2D array of rows.
+        """
+        rows = np.atleast_2d(np.asarray(rows, dtype=self.schema["dtype"]))
+        if rows.shape[1] != self.num_columns:
+            raise ValueError(
+                "Expected rows with {} columns, got {}.".format(self.num_columns, rows.shape[1])
+            )
+        self._buffer.append(rows)
+        self._buffered_rows += rows.shape[0]
+        while self._buffered_rows >= self.shard_size:
+            buffered = np.concatenate(self._buffer, axis=0)
+            self._write_shard(buffered[: self.shard_size])
+            self._buffer = [buffered[self.shard_size :]]
+            self._buffered_rows = self._buffer[0].shape[0]
+
+    def flush(self):
+        """
+        Write all buffered rows as a (possibly partial) shard.
+        """
+        if self._buffered_rows > 0:
+            self._write_shard(np.concatenate(self._buffer, axis=0))
+        self._buffer = []
+        self._buffered_rows = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_shard(self, rows):
+        if self.before_commit is not None:
+            self.before_commit()
+        index = len(self.schema["shards"])
+        file_name = "shard_{:05d}.npy".format(index)
+        tmp_path = os.path.join(self.path, file_name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, np.asfortranarray(rows))
+        os.replace(tmp_path, os.path.join(self.path, file_name))
+
+        self.schema["shards"].append(
+            {
+                "file": file_name,
+                "num_rows": int(rows.shape[0]),
+                "min": np.min(rows, axis=0).tolist(),
+                "max": np.max(rows, axis=0).tolist(),
+            }
+        )
+        self.schema["num_rows"] += int(rows.shape[0])
+        _atomic_write_json(os.path.join(self.path, SCHEMA_FILE), self.schema)
+        if self.on_commit is not None:
+            self.on_commit(self.schema["shards"][-1], rows)
+
+
+class ShardedView(object):
+    """
+    Lazy view over a subset of columns of all shards. Indexing with an integer,
+    slice or index array gathers only the requested rows; np.asarray(view)
+    materializes the whole view.
+    """
+
+    def __init__(self, shards, offsets, column_index):
+        self.shards = shards
+        self.offsets = offsets
+        self.column_index = column_index
+        self.shape = (int(offsets[-1]), len(column_index))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            shard = np.searchsorted(self.offsets, idx, side="right") - 1
+            return np.asarray(self.shards[shard][idx - self.offsets[shard], self.column_index])
+        if isinstance(idx, slice):
+            idx = np.arange(len(self))[idx]
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        idx = np.where(idx < 0, idx + len(self), idx)
+        out = np.empty((idx.shape[0], self.shape[1]), dtype=self.shards[0].dtype if self.shards else float)
+        shard_of = np.searchsorted(self.offsets, idx, side="right") - 1
+        for shard in np.unique(shard_of):
+            mask = shard_of == shard
+            out[mask] = self.shards[shard][idx[mask] - self.offsets[shard]][:, self.column_index]
+        return out
+
+    def __array__(self, dtype=None, copy=None):
+        out = np.concatenate(
+            [shard[:, self.column_index] for shard in self.shards], axis=0
+        ) if self.shards else np.empty(self.shape)
+        return out.astype(dtype) if dtype is not None else out
+
+
+class TrajStore(object):
+    """
+    Memory-mapped reader for a store written by TrajStoreWriter.
+    """
+
+    def __init__(self, path):
+        """
+        Open the store at `path`, or a list of stores with the same columns read as one. Only the schemas are
+        read; shards are memory-mapped.
+        """
+        self.path = path
+        paths = [path] if isinstance(path, str) else list(path)
+        schemas = []
+        for p in paths:
+            with open(os.path.join(p, SCHEMA_FILE)) as f:
+                schemas.append(json.load(f))
+            if schemas[-1]["columns"] != schemas[0]["columns"]:
+                raise ValueError("Store {} has different columns than {}.".format(p, paths[0]))
+        self.schema = dict(
+            schemas[0],
+            shards=[shard for schema in schemas for shard in schema["shards"]],
+            num_rows=sum(schema["num_rows"] for schema in schemas),
+        )
+        self.columns = self.schema["columns"]
+        self.shards = [
+            np.load(os.path.join(p, shard["file"]), mmap_mode="r")
+            for p, schema in zip(paths, schemas)
+            for shard in schema["shards"]
+        ]
+        self.offsets = np.concatenate(
+            ([0], np.cumsum([shard["num_rows"] for shard in self.schema["shards"]]))
+        ).astype(int)
+
+    @staticmethod
+    def exists(path):
+        paths = [path] if isinstance(path, str) else list(path)
+        return all(os.path.exists(os.path.join(p, SCHEMA_FILE)) for p in paths)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def column_index(self, names):
+        return [self.columns.index(name) for name in names]
+
+    def view(self, names=None):
+        """
+        Lazy view over the given columns (all columns if None).
+        """
+        index = list(range(len(self.columns))) if names is None else self.column_index(names)
+        return ShardedView(self.shards, self.offsets, index)
+
+    def column(self, name):
+        """
+        Materialize a single column as a 1D array.
+        """
+        return np.asarray(self.view([name]))[:, 0]
+
+    @property
+    def cost_columns(self):
+        return self.schema["cost_columns"]
+
+    @property
+    def coeff_columns(self):
+        return self.schema["coeff_layout"]["columns"]
+
+    def column_min(self, names=None):
+        """
+        Per-column minimum over the whole store, from the shard statistics.
+        """
+        index = list(range(len(self.columns))) if names is None else self.column_index(names)
+        return np.min([np.asarray(shard["min"])[index] for shard in self.schema["shards"]], axis=0)
+
+    def column_max(self, names=None):
+        """
+        Per-column maximum over the whole store, from the shard statistics.
+        """
+        index = list(range(len(self.columns))) if names is None else self.column_index(names)
+        return np.max([np.asarray(shard["max"])[index] for shard in self.schema["shards"]], axis=0)
+
+
+class JobManifest(object):
+    """
+    Records the seed list of a data-generation job writing to a store, and which
+    seeds have been committed to which shard. The schema is the source of truth
+    for what is committed: on open, the seed-to-shard map is rebuilt from the
+    seed column of the committed shards, so a crash between writing a shard and
+    updating the manifest loses nothing.
+    """
+
+    def __init__(self, writer, seeds, config=None):
+        """
+        Attach a manifest to an open TrajStoreWriter.
+        Inputs:
+            writer: TrajStoreWriter of the job's output store.
+            seeds: ordered seed list of a new job. Ignored when resuming, where the recorded list is used.
+            config: optional dict of job parameters. When resuming it must match the recorded one.
+        Raises:
+            ValueError if the store holds a different job.
+        """
+        self.writer = writer
+        self.path = os.path.join(writer.path, MANIFEST_FILE)
+        # Round trip through JSON so the config compares equal to the recorded one
+        config = json.loads(json.dumps(config, default=lambda o: np.asarray(o).tolist()))
+        seed_column = writer.schema["columns"].index(writer.schema["seed_column"])
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                manifest = json.load(f)
+            if config is not None and manifest["config"] != config:
+                raise ValueError(
+                    "The store at {} was written by a job with a different configuration.".format(writer.path)
+                )
+            self.seeds = manifest["seeds"]
+            self.config = manifest["config"]
+        else:
+            if writer.schema["num_rows"] > 0:
+                raise ValueError("The store at {} has data but no job manifest.".format(writer.path))
+            self.seeds = [int(seed) for seed in seeds]
+            self.config = config
+
+        self.shards = {}
+        for shard in writer.schema["shards"]:
+            rows = np.load(os.path.join(writer.path, shard["file"]), mmap_mode="r")
+            self.shards[shard["file"]] = [int(seed) for seed in rows[:, seed_column]]
+        self.seed_column = seed_column
+        self._save()
+        writer.on_commit = self.record_shard
+
+    def record_shard(self, shard_entry, rows):
+        self.shards[shard_entry["file"]] = [int(seed) for seed in rows[:, self.seed_column]]
+        self._save()
+
+    def completed_seeds(self):
+        return set(seed for seeds in self.shards.values() for seed in seeds)
+
+    def pending_seeds(self):
+        """
+        Seeds that are not in a committed shard, in the order of the job's seed list.
+        """
+        completed = self.completed_seeds()
+        return np.array([seed for seed in self.seeds if seed not in completed], dtype=int)
+
+    def _save(self):
+        _atomic_write_json(
+            self.path,
+            {"seeds": self.seeds, "config": self.config, "shards": self.shards},
+            indent=None,
+        )
@@ -0,0 +1,251 @@
+"""
+SYNOPSIS
+    Compressed, seed-indexed archive of per-trial simulation time series.
+
+DESCRIPTION
+    Replaces one .csv file per trial with a directory holding a few large
+    chunk files plus an archive.json index. Each chunk is a zip file
+    (np.savez_compressed) with one compressed member per trial, so reading a
+    single trial only decompresses that trial, and the index maps every seed
+    to its chunk, so nothing has to be listed or scanned to find it.
+
+    A trial is stored as the (T, num_columns) table Environment.save_to_csv
+    writes, with the same column names (rotorpy.utils.postprocessing.
+    unpack_sim_data). Chunks and the index are written to a temporary file
+    first and renamed, like the shards of traj_store.py, and reopening an
+    archive removes whatever an interrupted writer left behind. If a seed is
+    written more than once, e.g. by a resumed job, the latest copy is read.
+
+    Contains:
+    a) pack_trial - time series table of a simulation result
+    b) TrialArchiveWriter - appends trials in compressed chunks
+    c) TrialArchive - random access and bulk reads by seed
+"""
+
+import json
+import os
+
+import numpy as np
+from rotorpy.utils.postprocessing import unpack_sim_data
+
+ARCHIVE_FILE = "archive.json"
+ARCHIVE_VERSION = 1
+
+
+def _atomic_write_json(path, obj, indent=2):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f, indent=indent)
+    os.replace(tmp_path, path)
+
+
+def pack_trial(sim_result):
+    """
+    Time series table of a simulation, as written by Environment.save_to_csv.
+    Inputs:
+        sim_result: The output of a simulator instance.
+    Outputs:
+        columns: list of column names.
+        data: (T, num_columns) array.
+    """
+    dataframe = unpack_sim_data(sim_result)
+    return list(dataframe.columns), dataframe.to_numpy()
+
+
+class TrialArchiveWriter(object):
+    """
+    Appends trials to an archive. Trials are buffered in memory and written
+    out as a chunk every `chunk_trials` trials; the remaining ones are written
+    as a final, smaller chunk by flush() or close().
+    """
+
+    def __init__(self, path, columns=None, chunk_trials=256, dtype="float64"):
+        """
+        Open an archive for appending, creating it if it does not exist.
+        Inputs:
+            path: directory of the archive.
+            columns: list of column names. If None, taken from the first trial appended to a new archive.
+            chunk_trials: number of trials per chunk file.
+            dtype: numpy dtype of the stored values.
+        """
+        self.path = path
+        self.chunk_trials = chunk_trials
+        index_path = os.path.join(path, ARCHIVE_FILE)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                self.index = json.load(f)
+            if columns is not None and list(columns) != self.index["columns"]:
+                raise ValueError("Columns do not match the existing archive at {}.".format(path))
+            self.repair()
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.index = {
+                "version": ARCHIVE_VERSION,
+                "columns": list(columns) if columns is not None else None,
+                "dtype": str(np.dtype(dtype)),
+                "chunks": [],
+            }
+        self._buffer = []
+
+    def repair(self):
+        """
+        Bring the archive back to its last committed state: remove temporary files and chunk files the index does
+        not reference, and drop the first chunk that is missing or unreadable together with everything after it.
+        Outputs:
+            Number of chunks dropped from the index.
+        """
+        valid = []
+        for chunk in self.index["chunks"]:
+            try:
+                with np.load(os.path.join(self.path, chunk["file"])) as members:
+                    complete = set(members.files) == set(str(seed) for seed in chunk["seeds"])
+            except (OSError, ValueError):
+                break
+            if not complete:
+                break
+            valid.append(chunk)
+
+        dropped = len(self.index["chunks"]) - len(valid)
+        referenced = set(chunk["file"] for chunk in valid)
+        for file_name in os.listdir(self.path):
+            is_chunk = file_name.startswith("chunk_") and file_name.endswith(".npz")
+            if file_name.endswith(".tmp") or (is_chunk and file_name not in referenced):
+                os.remove(os.path.join(self.path, file_name))
+
+        if dropped > 0:
+            self.index["chunks"] = valid
+            _atomic_write_json(os.path.join(self.path, ARCHIVE_FILE), self.index)
+        return dropped
+
+    def append(self, seed, data, columns=None):
+        """
+        Append the time series of one trial.
+        Inputs:
+            seed: seed of the trial.
+            data: (T, num_columns) array.
+            columns: column names of data, checked against the archive's (and recorded by the first append).
+        """
+        if columns is not None:
+            if self.index["columns"] is None:
+                self.index["columns"] = list(columns)
+            elif list(columns) != self.index["columns"]:
+                raise ValueError("Trial columns do not match the archive at {}.".format(self.path))
+        data = np.asarray(data, dtype=self.index["dtype"])
+        if self.index["columns"] is not None and data.shape[1] != len(self.index["columns"]):
+            raise ValueError(
+                "Expected trials with {} columns, got {}.".format(len(self.index["columns"]), data.shape[1])
+            )
+        self._buffer.append((int(seed), data))
+        if len(self._buffer) >= self.chunk_trials:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered trials as a (possibly partial) chunk.
+        """
+        if self._buffer:
+            self._write_chunk(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _write_chunk(self, trials):
+        index = len(self.index["chunks"])
+        file_name = "chunk_{:05d}.npz".format(index)
+        tmp_path = os.path.join(self.path, file_name + ".tmp")
+        # Later trials of a repeated seed replace earlier ones within the chunk
+        members = {str(seed): data for seed, data in trials}
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **members)
+        os.replace(tmp_path, os.path.join(self.path, file_name))
+
+        self.index["chunks"].append({"file": file_name, "seeds": [int(seed) for seed in members]})
+        _atomic_write_json(os.path.join(self.path, ARCHIVE_FILE), self.index, indent=None)
+
+
+class TrialArchive(object):
+    """
+    Reader for an archive written by TrialArchiveWriter.
+    """
+
+    def __init__(self, path):
+        """
+        Open the archive at `path`. Only the index is read.
+        """
+        self.path = path
+        with open(os.path.join(path, ARCHIVE_FILE)) as f:
+            self.index = json.load(f)
+        self.columns = self.index["columns"]
+        # Later chunks override earlier ones for repeated seeds
+        self.chunk_of_seed = {}
+        for i, chunk in enumerate(self.index["chunks"]):
+            for seed in chunk["seeds"]:
+                self.chunk_of_seed[seed] = i
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, ARCHIVE_FILE))
+
+    def __len__(self):
+        return len(self.chunk_of_seed)
+
+    def __contains__(self, seed):
+        return int(seed) in self.chunk_of_seed
+
+    @property
+    def seeds(self):
+        return np.array(sorted(self.chunk_of_seed), dtype=int)
+
+    def column_index(self, names):
+        return [self.columns.index(name) for name in names]
+
+    def _chunk_path(self, i):
+        return os.path.join(self.path, self.index["chunks"][i]["file"])
+
+    def read(self, seed, columns=None):
+        """
+        Time series of one trial.
+        Inputs:
+            seed: seed of the trial.
+            columns: list of column names to return, or None for all columns.
+        Outputs:
+            data: (T, num_columns) array.
+        """
+        if int(seed) not in self.chunk_of_seed:
+            raise KeyError("Seed {} is not in the archive at {}.".format(seed, self.path))
+        with np.load(self._chunk_path(self.chunk_of_seed[int(seed)])) as members:
+            data = members[str(int(seed))]
+        return data if columns is None else data[:, self.column_index(columns)]
+
+    def read_many(self, seeds=None, columns=None):
+        """
+        Time series of many trials, opening each chunk once.
+        Inputs:
+            seeds: seeds of the trials, or None for all trials.
+            columns: list of column names to return, or None for all columns.
+        Outputs:
+            trials: dict from seed to (T, num_columns) array, in the order of seeds.
+        """
+        seeds = self.seeds if seeds is None else [int(seed) for seed in seeds]
+        missing = [seed for seed in seeds if seed not in self.chunk_of_seed]
+        if missing:
+            raise KeyError("Seeds {} are not in the archive at {}.".format(missing[:10], self.path))
+        column_index = None if columns is None else self.column_index(columns)
+
+        by_chunk = {}
+        for seed in seeds:
+            by_chunk.setdefault(self.chunk_of_seed[seed], []).append(seed)
+        trials = {}
+        for i, chunk_seeds in sorted(by_chunk.items()):
+            with np.load(self._chunk_path(i)) as members:
+                for seed in chunk_seeds:
+                    data = members[str(seed)]
+                    trials[seed] = data if column_index is None else data[:, column_index]
+        return {seed: trials[seed] for seed in seeds}
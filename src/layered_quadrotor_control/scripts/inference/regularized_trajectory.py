@@ -1,8 +1,10 @@
-from rotorpy.trajectories.traj_template import TrajTemplate, H_fun, get_1d_constraints, cvxopt_solve_qp
+from rotorpy.trajectories.traj_template import TrajTemplate
 from scipy.linalg import block_diag
 import numpy as np
 import matplotlib.pyplot as plt
 import cvxopt
+# Closed-form min-snap solves with cached KKT factorizations, from the scripts directory
+from minsnap_solver import default_solver
 
 class RegularizedTrajectory(TrajTemplate):
     def __init__(self, points, yaw_angles=None, yaw_rate_max=2*np.pi, 
@@ -56,55 +58,24 @@ class RegularizedTrajectory(TrajTemplate):
             loc_delta_t = self.delta_t
             self.t_keyframes = np.concatenate(([0], np.cumsum(self.delta_t)))  # Construct time array which indicates when the quad should be at the i'th waypoint.
 
-            ################## Cost function
-            # First get the cost segment for each matrix:
-            H_pos = [H_fun(loc_delta_t[i], k=poly_degree) for i in range(m)]
-            H_yaw = [H_fun(loc_delta_t[i], k=yaw_poly_degree) for i in range(m)]
-
-            # Now concatenate these costs using block diagonal form:
-            P_pos = block_diag(*H_pos)
-            P_yaw = block_diag(*H_yaw)
-
-            # Lastly the linear term in the cost function is 0
-            q_pos = np.zeros(((poly_degree + 1) * m, 1))
-            q_yaw = np.zeros(((yaw_poly_degree + 1) * m, 1))
-
-            ################## Constraints for each axis
-            (Ax, bx, Gx, hx) = get_1d_constraints(
-                loc_points[:, 0],
-                loc_delta_t,
-                m,
-                k=poly_degree,
-                vmax=v_max,
-                vstart=v_start[0],
-                vend=v_end[0],
-            )
-            (Ay, by, Gy, hy) = get_1d_constraints(
-                loc_points[:, 1],
-                loc_delta_t,
-                m,
-                k=poly_degree,
-                vmax=v_max,
-                vstart=v_start[1],
-                vend=v_end[1],
-            )
-            (Az, bz, Gz, hz) = get_1d_constraints(
-                loc_points[:, 2],
-                loc_delta_t,
-                m,
-                k=poly_degree,
-                vmax=v_max,
-                vstart=v_start[2],
-                vend=v_end[2],
-            )
-            (Ayaw, byaw, Gyaw, hyaw) = get_1d_constraints(
-                self.yaw, loc_delta_t, m, k=yaw_poly_degree, vmax=yaw_rate_max
-            )
-
-            c_opt_x = cvxopt_solve_qp(P_pos, q=q_pos, G=Gx, h=hx, A=Ax, b=bx)
-            c_opt_y = cvxopt_solve_qp(P_pos, q=q_pos, G=Gy, h=hy, A=Ay, b=by)
-            c_opt_z = cvxopt_solve_qp(P_pos, q=q_pos, G=Gz, h=hz, A=Az, b=bz)
-            c_opt_yaw = cvxopt_solve_qp(P_yaw, q=q_yaw, G=Gyaw, h=hyaw, A=Ayaw, b=byaw)
+            ################## Cost function and constraints
+            # P, A and the KKT factorization only depend on the durations, and are cached across trajectories
+            pos_solver = default_solver(poly_degree)
+            yaw_solver = default_solver(yaw_poly_degree)
+            pos_problem = pos_solver.problem(loc_delta_t[:m])
+            yaw_problem = yaw_solver.problem(loc_delta_t[:m])
+            P_pos, A_pos = pos_problem["P"], pos_problem["A"]
+            P_yaw, A_yaw = yaw_problem["P"], yaw_problem["A"]
+            yaw_keyframes = np.asarray(self.yaw, dtype=float)[: m + 1, None]
+            bx, by, bz = pos_solver.equality_rhs(loc_points, vstart=v_start, vend=v_end).T
+            byaw = yaw_solver.equality_rhs(yaw_keyframes)[:, 0]
+
+            ################## Solve for x, y, z, and yaw
+            # Closed form, unless the v_max constraints of an axis are active, which is then solved as a QP
+            c_opt_x, c_opt_y, c_opt_z = pos_solver.solve(
+                loc_delta_t[:m], loc_points, vmax=v_max, vstart=v_start, vend=v_end
+            ).T
+            c_opt_yaw = yaw_solver.solve(loc_delta_t[:m], yaw_keyframes, vmax=yaw_rate_max)[:, 0]
 
             # call modify_reference directly after computing the min snap coeffs and use the returned coeffs in the rest of the class
             self.nan_encountered = False
@@ -121,7 +92,7 @@ class RegularizedTrajectory(TrajTemplate):
             )  # cost function is the same for x, y, z
 
             # get A by concatenating Ax, Ay, Az, Ayaw
-            A = block_diag(*[Ax, Ay, Az, Ayaw])
+            A = block_diag(*[A_pos, A_pos, A_pos, A_yaw])
 
             # get b by concatenating bx, by, bz, byaw
             b = np.concatenate((bx, by, bz, byaw))
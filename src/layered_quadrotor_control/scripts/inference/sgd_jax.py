@@ -76,6 +76,9 @@ def modify_reference(
 ):
     """
     Running projected gradient descent on the neural network cost + min snap cost with constraints
+    :param regularizer: (model, params) of the value function, applied to the raw coefficients. With the (bundle,
+        bundle.params) of a model bundle (scripts/model_bundle.py), the input normalization used in training is folded
+        into the first layer, so the network sees the same inputs as in training at no extra cost
     """
     @jit
     def nn_cost(coeffs):